@@ -0,0 +1,151 @@
+# encoding=utf8
+
+""" The shared client registry
+    Author: lipixun
+    Created Time : 日 10/18 19:42:16 2026
+
+    File Name: clients.py
+    Description:
+
+        The refer sections of the same type and the same connection config share one referenced value (the backend client),
+        the client is released by the last section which stops using it. A broken client is renewed once by the section
+        which finds it, and the other sections using it switch to the new one
+
+"""
+
+import logging
+
+from threading import Lock
+
+from util import json
+
+class SharedClient(object):
+    """The shared client
+    """
+    def __init__(self, key):
+        """Create a new SharedClient
+        """
+        self.key = key
+        self.lock = Lock()          # Only one section creates the client
+        self.value = None
+        self.refs = 0
+        self.holders = []           # The sections referencing the client, one for each reference
+
+class ClientRegistry(object):
+    """The registry of shared clients
+    """
+    logger = logging.getLogger("configmslib.clients")
+
+    def __init__(self):
+        """Create a new ClientRegistry
+        """
+        self._lock = Lock()
+        self._clients = {}          # The shared clients, key --> SharedClient
+        self._values = {}           # The created clients, id(value) --> SharedClient
+
+    @classmethod
+    def getKey(cls, section, config):
+        """Get the key of the config of section
+        Returns:
+            The key, None if the config could not be shared
+        """
+        keys = section.ReloadKeys
+        if keys is None:
+            keys = [ key for key in config if not key in section.BehaviorKeys ]
+        try:
+            return (section.Type, json.dumps(dict((key, config.get(key)) for key in keys), sort_keys = True))
+        except (TypeError, ValueError):
+            return None
+
+    def reference(self, section, config):
+        """Reference the shared client of config, create it by section if not exist
+        Parameters:
+            section                         The refer section
+            config                          The config
+        Returns:
+            (value, created)
+        """
+        key = self.getKey(section, config)
+        if key is None:
+            return section.reference(config), True
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = SharedClient(key)
+                self._clients[key] = client
+            client.refs += 1
+            client.holders.append(section)
+        try:
+            with client.lock:
+                if not client.value is None:
+                    return client.value, False
+                self.logger.debug("[%s] Create the shared client of [%s]", section.Type, key[1])
+                value = section.reference(config)
+                with self._lock:
+                    client.value = value
+                    self._values[id(value)] = client
+                return value, True
+        except:
+            with self._lock:
+                client.refs -= 1
+                client.holders.remove(section)
+                if client.refs == 0 and self._clients.get(key) is client:
+                    del self._clients[key]
+            raise
+
+    def renew(self, section, config, value):
+        """Renew the shared client of config which is broken, the other sections using it are notified to switch to the new one
+        Parameters:
+            section                         The refer section
+            config                          The config
+            value                           The broken value of section
+        Returns:
+            (value, created)
+        NOTE:
+            The client already renewed by another section is referenced instead of creating another one
+        """
+        key = self.getKey(section, config)
+        if key is None:
+            return section.reference(config), True
+        broken = None
+        with self._lock:
+            client = self._clients.get(key)
+            if not client is None and not value is None and client.value is value:
+                # Detach the broken client, it's released by its holders as usual
+                del self._clients[key]
+                broken = client
+        value, created = self.reference(section, config)
+        if created and not broken is None:
+            with self._lock:
+                holders = dict((id(x), x) for x in broken.holders if not x is section)
+            for holder in holders.itervalues():
+                holder.sharedRenewed(broken.value)
+        return value, created
+
+    def release(self, section, value):
+        """Release the client, it's released by section if no one is using it
+        Parameters:
+            section                         The refer section
+            value                           The value returned by reference
+        Returns:
+            True if released, False if it's still used by other sections
+        """
+        with self._lock:
+            client = self._values.get(id(value))
+            if not client is None:
+                client.refs -= 1
+                if section in client.holders:
+                    client.holders.remove(section)
+                if client.refs > 0:
+                    return False
+                del self._values[id(value)]
+                if self._clients.get(client.key) is client:
+                    del self._clients[client.key]
+        section.release(value)
+        return True
+
+    def getShares(self, value):
+        """Get the number of users of the value
+        """
+        client = self._values.get(id(value))
+        return client.refs if client else 1
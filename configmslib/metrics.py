@@ -0,0 +1,159 @@
+# encoding=utf8
+
+""" The metrics
+    Author: lipixun
+    Created Time : 日 10/18 16:05:47 2026
+
+    File Name: metrics.py
+    Description:
+
+        The metrics of config sections, each metric value is labeled by the section key
+
+        Known metrics:
+            - update_lag_seconds            (summary) From the config value received from etcd to applied (reloaded)
+            - reload_seconds                (summary) The duration of reload
+            - reload_failures               (counter) The failed reloads
+            - instance_hold_seconds         (summary) The duration of instance() is held, only recorded with the holdMetrics config
+            - instance_holders              (gauge) The concurrent holders of instance()
+            - referenced_value_refcount     (gauge) The reference count of current referenced value
+            - superseded_values             (gauge) The superseded referenced values waiting for release
+            - referenced_value_shares       (gauge) The sections sharing current referenced value
+            - breaker_state                 (gauge) The circuit breaker state, 0 closed, 1 half open, 2 open
+            - breaker_rejections            (counter) The instance() calls rejected by the circuit breaker
+            - bulkhead_active               (gauge) The holders in the bulkhead
+            - bulkhead_waiting              (gauge) The callers waiting for the bulkhead
+            - bulkhead_rejections           (counter) The instance() calls rejected by the bulkhead
+
+"""
+
+from threading import Lock
+
+class Metrics(object):
+    """The metrics interface, implement it to send the metrics to other systems
+    NOTE:
+        This implementation records nothing
+    """
+    def increase(self, name, section, value = 1):
+        """Increase a counter
+        Parameters:
+            name                            The metric name
+            section                         The section key
+            value                           The value to increase
+        """
+        pass
+
+    def observe(self, name, section, value):
+        """Observe a value of a summary
+        """
+        pass
+
+    def gauge(self, name, section, value):
+        """Set the value of a gauge
+        """
+        pass
+
+    def stats(self):
+        """Get the recorded metrics
+        Returns:
+            A dict, metric name --> section key --> value
+        """
+        return {}
+
+    def exposition(self):
+        """Get the recorded metrics in text exposition format
+        """
+        return ""
+
+class MetricsRegistry(Metrics):
+    """The in-process metrics registry
+    """
+    Prefix = "configms_"
+
+    def __init__(self):
+        """Create a new MetricsRegistry
+        """
+        self._lock = Lock()
+        self._counters = {}         # (name, section) --> value
+        self._summaries = {}        # (name, section) --> [ count, sum, max ]
+        self._gauges = {}           # (name, section) --> value
+
+    def increase(self, name, section, value = 1):
+        """Increase a counter
+        """
+        key = (name, section)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, section, value):
+        """Observe a value of a summary
+        """
+        key = (name, section)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [ 1, value, value ]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                if value > summary[2]:
+                    summary[2] = value
+
+    def gauge(self, name, section, value):
+        """Set the value of a gauge
+        """
+        with self._lock:
+            self._gauges[(name, section)] = value
+
+    def stats(self):
+        """Get the recorded metrics
+        Returns:
+            A dict, metric name --> section key --> value. The value of summary is a dict of count, sum, avg and max
+        """
+        stats = {}
+        with self._lock:
+            for (name, section), value in self._counters.iteritems():
+                stats.setdefault(name, {})[section] = value
+            for (name, section), value in self._gauges.iteritems():
+                stats.setdefault(name, {})[section] = value
+            for (name, section), (count, total, maximum) in self._summaries.iteritems():
+                stats.setdefault(name, {})[section] = {
+                    "count": count,
+                    "sum": total,
+                    "avg": total / count,
+                    "max": maximum,
+                    }
+        return stats
+
+    def exposition(self):
+        """Get the recorded metrics in the prometheus text exposition format
+        """
+        lines = []
+        def label(section):
+            """Get the label of section key
+            """
+            return '{section="%s"}' % ("" if section is None else str(section)).replace("\\", "\\\\").replace('"', '\\"')
+        def group(values):
+            """Group the values by metric name
+            """
+            groups = {}
+            for (name, section), value in values.iteritems():
+                groups.setdefault(name, []).append((section, value))
+            return sorted(groups.iteritems())
+        with self._lock:
+            for name, values in group(self._counters):
+                lines.append("# TYPE %s%s counter" % (self.Prefix, name))
+                for section, value in sorted(values):
+                    lines.append("%s%s%s %s" % (self.Prefix, name, label(section), value))
+            for name, values in group(self._gauges):
+                lines.append("# TYPE %s%s gauge" % (self.Prefix, name))
+                for section, value in sorted(values):
+                    lines.append("%s%s%s %s" % (self.Prefix, name, label(section), value))
+            for name, values in group(self._summaries):
+                lines.append("# TYPE %s%s summary" % (self.Prefix, name))
+                for section, (count, total, _) in sorted(values):
+                    lines.append("%s%s_count%s %s" % (self.Prefix, name, label(section), count))
+                    lines.append("%s%s_sum%s %s" % (self.Prefix, name, label(section), total))
+                lines.append("# TYPE %s%s_max gauge" % (self.Prefix, name))
+                for section, (_, _, maximum) in sorted(values):
+                    lines.append("%s%s_max%s %s" % (self.Prefix, name, label(section), maximum))
+        return "\n".join(lines) + "\n" if lines else ""
@@ -9,17 +9,25 @@
 
 """
 
+import time
 import logging
 
 from sets import Set
+from threading import Lock
 from os.path import dirname, abspath, join, basename
 
 import yaml
 
+from etcd import EtcdKeyNotFound
+
 from spec import ConfigEtcd, ConfigEnviron
 from config import GlobalConfigs, EnvironConfig
 from section import ConfigSection
 from sections import SECTIONS
+from watcher import EtcdWatcher
+from scheduler import Scheduler
+from metrics import MetricsRegistry
+from clients import ClientRegistry
 
 KNOWN_SECTION_TYPES = {
         None: ConfigSection,
@@ -31,13 +39,29 @@ class ConfigRepository(object):
     """
     logger = logging.getLogger('configmslib.repository')
 
-    def __init__(self, sectionTypes = None, enableEtcd = True):
+    def __init__(self, sectionTypes = None, enableEtcd = True, sharedWatch = True, reloadWorkers = Scheduler.DefaultWorkers, loadWorkers = Scheduler.DefaultLoadWorkers, metrics = None):
         """Create a new ConfigRepository
+        Parameters:
+            sectionTypes                The known section types
+            enableEtcd                  Whether to enable etcd or not
+            sharedWatch                 Whether to watch all auto update sections by one watcher per environ or not
+            reloadWorkers               The number of worker threads to reload sections
+            loadWorkers                 The number of worker threads to reload the slow loading sections (e.g. dicts)
+            metrics                     The Metrics object to record the section metrics, use an in-process MetricsRegistry when not specified
         """
         self.sectionTypes = sectionTypes or KNOWN_SECTION_TYPES
         self.enableEtcd = enableEtcd
+        self.sharedWatch = sharedWatch
         self.globals = {}           # The global configs
         self.sections = {}
+        self.watchers = {}          # The etcd watchers, etcd path --> watcher
+        self.prefetched = {}        # The prefetched configs, etcd path --> (etcd key --> node, etcd index)
+        self.scheduler = Scheduler(reloadWorkers)
+        self.loadScheduler = Scheduler(loadWorkers)     # The dedicated lane of the slow loading sections, never blocks the others
+        self.metrics = metrics or MetricsRegistry()
+        self.clients = ClientRegistry()     # The shared clients of refer sections
+        self._prefetching = False
+        self._watchLock = Lock()
 
     def __getitem__(self, section):
         """Get config section
@@ -93,26 +117,146 @@ class ConfigRepository(object):
         """
         return self[name]
 
-    def loadSchema(self, filename, environPath = None, noSections = False):
+    def stats(self):
+        """Get the metrics of sections
+        Returns:
+            A dict, metric name --> section key --> value
+        """
+        for section in self.sections.values():
+            section.collectMetrics(self.metrics)
+        return self.metrics.stats()
+
+    def exposition(self):
+        """Get the metrics of sections in text exposition format
+        """
+        for section in self.sections.values():
+            section.collectMetrics(self.metrics)
+        return self.metrics.exposition()
+
+    def watch(self, section):
+        """Watch the config of section by the shared watcher of its environ
+        Parameters:
+            section                     The config section
+        Returns:
+            The watcher
+        """
+        path = section.environ.getEtcdPath("")
+        with self._watchLock:
+            watcher = self.watchers.get(path)
+            if not watcher:
+                # Start the watch after the prefetched configs if available
+                _, index = self.prefetched.get(path, (None, None))
+                watcher = EtcdWatcher(self, section.environ, index)
+                self.watchers[path] = watcher
+        watcher.register(section)
+        return watcher
+
+    def prefetch(self, environ = None):
+        """Read all configs of the environ by one recursive etcd read
+        Parameters:
+            environ                     The environ config, use the environ of this repository when not specified
+        Returns:
+            Nothing
+        """
+        client = self.etcd
+        if client is None:
+            return
+        environ = environ or self.environ
+        path = environ.getEtcdPath("")
+        try:
+            result = client.read(path, recursive = True)
+            nodes = dict((self.normalizeEtcdKey(node.key), node) for node in result.leaves if not node.dir)
+            self.prefetched[path] = (nodes, result.etcd_index)
+        except EtcdKeyNotFound as error:
+            index = (error.payload or {}).get("index")
+            if not index is None:
+                self.prefetched[path] = ({}, index)
+        except:
+            self.logger.exception("Failed to prefetch configs at path [%s], will read them one by one", path)
+        else:
+            self.logger.debug("Prefetched [%d] configs at path [%s]", len(nodes), path)
+
+    def readConfig(self, environ, key):
+        """Read a config from the prefetched configs or etcd
+        Parameters:
+            environ                     The environ config
+            key                         The config key
+        Returns:
+            (etcd result, the etcd index when it's read)
+        NOTE:
+            The changes should be watched after the etcd index instead of the modified index of the result,
+            since the modified index of a config which is not changed for a long time may be cleared from the etcd history
+        """
+        path = environ.getEtcdPath("")
+        if self._prefetching and not path in self.prefetched:
+            self.prefetch(environ)
+        if path in self.prefetched:
+            nodes, index = self.prefetched[path]
+            node = nodes.get(self.normalizeEtcdKey(environ.getEtcdPath(key)))
+            if node is None:
+                raise EtcdKeyNotFound("Key not found in prefetched configs: [%s]" % environ.getEtcdPath(key))
+            return node, index
+        result = self.etcd.read(environ.getEtcdPath(key))
+        return result, result.etcd_index
+
+    @classmethod
+    def normalizeEtcdKey(cls, key):
+        """Normalize the etcd key
+        """
+        return "/" + key.strip("/")
+
+    def loadSchema(self, filename, environPath = None, noSections = False, timeout = None):
         """Load a schema from filename
         Parameters:
             filename                    The schema filename, should be in yaml format
             environPath                 The environment path, used when resolving includes. Use the same directory as the filename when not specified
             noSections                  Whether to load sections or not
+            timeout                     The deadline in seconds for all sections to be ready, wait forever if not specified
         Returns:
-            Nothing
+            The keys of the sections which are not ready before the deadline
         NOTE:
             - The schema specifys config sections and how to load them
             - The latest schema will overrwrite the section which is loaded previously
+            - The configs of each environ are prefetched by one recursive etcd read when loading sections
+            - The sections are loaded without waiting, then all the sections require waiting are waited together
         """
         if not environPath:
             environPath = dirname(abspath(filename))
             filename = basename(filename)
         # Load the file
-        self._loadSchemaFile(filename, environPath, noSections, Set())
+        self._prefetching = not noSections
+        pendings = []
+        try:
+            self._loadSchemaFile(filename, environPath, noSections, Set(), pendings)
+        finally:
+            # The prefetched configs are only valid when loading
+            self._prefetching = False
+            self.prefetched.clear()
+        # Wait for the sections
+        return self.waitSections(pendings, timeout)
+
+    def waitSections(self, sections, timeout = None):
+        """Wait for the sections ready
+        Parameters:
+            sections                    The sections to wait
+            timeout                     The deadline in seconds for all the sections, wait forever if not specified
+        Returns:
+            The keys of the sections which are not ready before the deadline
+        """
+        deadline = time.time() + timeout if not timeout is None else None
+        missed = []
+        for section in sections:
+            if not section.ready(max(deadline - time.time(), 0.0) if not deadline is None else None):
+                missed.append(section.key)
+        if missed:
+            self.logger.error("Sections [%s] are not ready in [%s]s", ",".join(map(str, missed)), timeout)
+        # Done
+        return missed
 
-    def _loadSchemaFile(self, filename, environPath, noSections, loadedFiles):
+    def _loadSchemaFile(self, filename, environPath, noSections, loadedFiles, pendings):
         """Load the schema file
+        Parameters:
+            pendings                    The list to add the loaded sections which require waiting to
         Returns:
             Nothing
         """
@@ -130,7 +274,7 @@ class ConfigRepository(object):
                         includeFilename = join(dirname(filename), includeFilename)
                     # Load it if not loaded
                     if not includeFilename in loadedFiles:
-                        self._loadSchemaFile(includeFilename, environPath, noSections, loadedFiles)
+                        self._loadSchemaFile(includeFilename, environPath, noSections, loadedFiles, pendings)
             # Read global configs
             globalConfigs = schema.get("globals")
             if globalConfigs:
@@ -154,13 +298,15 @@ class ConfigRepository(object):
                 sections = schema.get("sections")
                 if sections:
                     for sectionConfig in sections:
-                        # Load the section
-                        section = self.loadSection(sectionConfig)
+                        # Load the section without waiting
+                        section = self.loadSection(sectionConfig, defer = True)
                         if section.key in self.sections:
                             raise ValueError("Conflict section [%s]", section.key)
                         self.sections[section.key] = section
+                        if sectionConfig.get("wait", True):
+                            pendings.append(section)
 
-    def loadSection(self, section):
+    def loadSection(self, section, defer = False):
         """Update the section
         Parameters:
             name                        The section name
@@ -169,6 +315,7 @@ class ConfigRepository(object):
             autoUpdate                  Whether auto update this section or not
             environ                     The environment of this section
             wait                        Whether to wait this section ready or not
+            defer                       Do not wait this section even if wait is set, the caller will wait it by waitSections
         """
         name, t, value, autoUpdate, environ, wait = \
             section.get("name"), \
@@ -185,4 +332,4 @@ class ConfigRepository(object):
         if environ:
             environ = EnvironConfig(**environ)
         # Create
-        return self.sectionTypes[t](name, value, self, autoUpdate, environ, wait)
+        return self.sectionTypes[t](name, value, self, autoUpdate, environ, wait and not defer)
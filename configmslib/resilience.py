@@ -0,0 +1,279 @@
+# encoding=utf8
+
+""" The resilience policies
+    Author: lipixun
+    Created Time : 日 10/18 20:31:05 2026
+
+    File Name: resilience.py
+    Description:
+
+        The resilience policies of ReferConfigSection.instance:
+
+            - CircuitBreaker        Fail fast when the error rate or slow call rate of recent calls is too high
+            - Bulkhead              Limit the concurrent holders of instance()
+
+        They're configured in the section config:
+
+            breaker:
+                window: 100         The number of recent calls to calculate the rates
+                minCalls: 20        The min number of calls in window to open the breaker
+                errorRate: 0.5      Open when the failed calls reach this rate
+                slowCall: 2.0       The seconds a call is considered slow, slow calls are not checked if not specified
+                slowRate: 0.5       Open when the slow calls reach this rate
+                openTime: 30.0      The seconds to fail fast before calls are allowed to probe the backend
+                probes: 1           The number of successful probe calls to close the breaker
+            bulkhead:
+                size: 32            The max concurrent holders
+                timeout: 0.0        The seconds to wait for a free slot
+
+        Or `breaker: true` to use the default breaker and `bulkhead: 32` to only set the size
+
+"""
+
+import time
+
+from collections import deque
+from threading import Lock, Condition
+
+class CircuitOpenError(RuntimeError):
+    """The circuit breaker is open
+    """
+    pass
+
+class BulkheadFullError(RuntimeError):
+    """No free slot in the bulkhead
+    """
+    pass
+
+class CircuitBreaker(object):
+    """The circuit breaker
+    """
+    Closed = "closed"
+    Open = "open"
+    HalfOpen = "half-open"
+
+    DefaultWindow = 100
+    DefaultMinCalls = 20
+    DefaultErrorRate = 0.5
+    DefaultSlowRate = 0.5
+    DefaultOpenTime = 30.0      # 30s
+    DefaultProbes = 1
+
+    def __init__(self, window = DefaultWindow, minCalls = DefaultMinCalls, errorRate = DefaultErrorRate, slowCall = None, slowRate = DefaultSlowRate, openTime = DefaultOpenTime, probes = DefaultProbes):
+        """Create a new CircuitBreaker
+        """
+        if window < 1 or minCalls < 1 or probes < 1:
+            raise ValueError("Invalid breaker window, minCalls or probes")
+        if not 0 < errorRate <= 1 or not 0 < slowRate <= 1:
+            raise ValueError("Invalid breaker errorRate or slowRate")
+        self.window = window
+        self.minCalls = minCalls
+        self.errorRate = errorRate
+        self.slowCall = slowCall
+        self.slowRate = slowRate
+        self.openTime = openTime
+        self.probes = probes
+        self._lock = Lock()
+        self._state = self.Closed
+        self._calls = deque()       # The outcomes of recent calls, (failed, slow)
+        self._failures = 0          # The failed calls in window
+        self._slows = 0             # The slow calls in window
+        self._openedTime = None
+        self._probing = 0           # The running probe calls
+        self._succeeded = 0         # The succeeded probe calls
+        self.rejections = 0
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Create a CircuitBreaker from the section config
+        Returns:
+            The CircuitBreaker object, None if not configured
+        """
+        if not config:
+            return None
+        if config is True:
+            return cls()
+        if not isinstance(config, dict):
+            raise ValueError("Invalid breaker config")
+        try:
+            return cls(
+                window = int(config.get("window", cls.DefaultWindow)),
+                minCalls = int(config.get("minCalls", cls.DefaultMinCalls)),
+                errorRate = float(config.get("errorRate", cls.DefaultErrorRate)),
+                slowCall = float(config["slowCall"]) if config.get("slowCall") else None,
+                slowRate = float(config.get("slowRate", cls.DefaultSlowRate)),
+                openTime = float(config.get("openTime", cls.DefaultOpenTime)),
+                probes = int(config.get("probes", cls.DefaultProbes)),
+                )
+        except (TypeError, ValueError) as error:
+            raise ValueError("Invalid breaker config: %s" % error)
+
+    @property
+    def state(self):
+        """Get the state
+        """
+        return self._state
+
+    def allow(self):
+        """Check if a call is allowed
+        Returns:
+            True if the call is a probe call, False if it's a normal call
+        NOTE:
+            Raise CircuitOpenError if not allowed
+        """
+        with self._lock:
+            if self._state == self.Open:
+                if time.time() - self._openedTime < self.openTime:
+                    self.rejections += 1
+                    raise CircuitOpenError("Circuit breaker is open")
+                # Let the probe calls in
+                self._state, self._probing, self._succeeded = self.HalfOpen, 0, 0
+            if self._state == self.HalfOpen:
+                if self._probing >= self.probes:
+                    self.rejections += 1
+                    raise CircuitOpenError("Circuit breaker is half open and probing")
+                self._probing += 1
+                return True
+            return False
+
+    def record(self, failed, duration, probe = False):
+        """Record the outcome of a call
+        Parameters:
+            failed                          Whether the call is failed by the backend or not
+            duration                        The seconds of the call
+            probe                           The value returned by allow
+        """
+        slow = not self.slowCall is None and duration >= self.slowCall
+        with self._lock:
+            if probe:
+                self._probing -= 1
+                if self._state != self.HalfOpen:
+                    return
+                if failed or slow:
+                    self.trip()
+                else:
+                    self._succeeded += 1
+                    if self._succeeded >= self.probes:
+                        self._state = self.Closed
+                return
+            if self._state != self.Closed:
+                return
+            # Add to window
+            self._calls.append((failed, slow))
+            self._failures += failed
+            self._slows += slow
+            if len(self._calls) > self.window:
+                oldFailed, oldSlow = self._calls.popleft()
+                self._failures -= oldFailed
+                self._slows -= oldSlow
+            # Check the rates
+            calls = len(self._calls)
+            if calls >= self.minCalls and (self._failures >= calls * self.errorRate or (not self.slowCall is None and self._slows >= calls * self.slowRate)):
+                self.trip()
+
+    def cancel(self, probe):
+        """Cancel an allowed call which is not run, e.g. rejected by the bulkhead
+        Parameters:
+            probe                           The value returned by allow
+        NOTE:
+            Only the probe slot is released, nothing is added to the window
+        """
+        if probe:
+            with self._lock:
+                self._probing -= 1
+
+    def trip(self):
+        """Open the breaker
+        NOTE:
+            The lock should be held
+        """
+        self._state = self.Open
+        self._openedTime = time.time()
+        self._calls.clear()
+        self._failures, self._slows = 0, 0
+
+    def stats(self):
+        """Get the stats
+        """
+        return {
+            "state": self._state,
+            "calls": len(self._calls),
+            "failures": self._failures,
+            "slows": self._slows,
+            "rejections": self.rejections,
+            }
+
+class Bulkhead(object):
+    """The bulkhead
+    """
+    DefaultTimeout = 0.0        # Reject immediately
+
+    def __init__(self, size, timeout = DefaultTimeout):
+        """Create a new Bulkhead
+        Parameters:
+            size                            The max concurrent holders
+            timeout                         The seconds to wait for a free slot
+        """
+        if size < 1:
+            raise ValueError("Invalid bulkhead size")
+        self.size = size
+        self.timeout = timeout
+        self._cond = Condition(Lock())
+        self.active = 0
+        self.waiting = 0
+        self.rejections = 0
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Create a Bulkhead from the section config
+        Returns:
+            The Bulkhead object, None if not configured
+        """
+        if not config:
+            return None
+        try:
+            if isinstance(config, dict):
+                return cls(int(config["size"]), float(config.get("timeout", cls.DefaultTimeout)))
+            return cls(int(config))
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError("Invalid bulkhead config: %s" % error)
+
+    def acquire(self):
+        """Acquire a slot
+        NOTE:
+            Raise BulkheadFullError if no slot is released in timeout
+        """
+        with self._cond:
+            if self.active >= self.size:
+                if self.timeout <= 0:
+                    self.rejections += 1
+                    raise BulkheadFullError("Bulkhead is full")
+                deadline = time.time() + self.timeout
+                self.waiting += 1
+                try:
+                    while self.active >= self.size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.rejections += 1
+                            raise BulkheadFullError("Bulkhead is full after waiting [%s]s" % self.timeout)
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+
+    def release(self):
+        """Release a slot
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        """Get the stats
+        """
+        return {
+            "size": self.size,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejections": self.rejections,
+            }
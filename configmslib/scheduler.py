@@ -0,0 +1,162 @@
+# encoding=utf8
+
+""" The task scheduler
+    Author: lipixun
+    Created Time : 日 10/18 14:36:02 2026
+
+    File Name: scheduler.py
+    Description:
+
+        The scheduler runs the background tasks (e.g. section reloading) of a repository on a bounded pool of worker threads
+
+"""
+
+import time
+import heapq
+import random
+import logging
+
+from itertools import count
+from threading import Thread, Condition
+
+class Scheduler(object):
+    """The task scheduler
+    NOTE:
+        - A task is identified by its key, submitting a key which is pending will not add a duplicated task
+        - The tasks of the same key never run concurrently, a key submitted when running will run again after it's done
+        - A task which raises will be retried with exponential backoff and jitter
+        - A task which returns a number will be scheduled again after that seconds
+        - A task submitted with debounce is postponed by each submit until it settles, but no longer than debounce seconds
+    """
+    logger = logging.getLogger("configmslib.scheduler")
+
+    DefaultWorkers = 4
+    DefaultLoadWorkers = 2          # The workers of the slow loading sections, see ConfigSection.SlowLoading
+    DefaultBackoff = 1.0            # 1s
+    DefaultMaxBackoff = 60.0        # 60s
+
+    def __init__(self, workers = DefaultWorkers, backoff = DefaultBackoff, maxBackoff = DefaultMaxBackoff):
+        """Create a new Scheduler
+        Parameters:
+            workers                         The number of worker threads
+            backoff                         The initial retry backoff in seconds
+            maxBackoff                      The max retry backoff in seconds
+        """
+        if workers < 1:
+            raise ValueError("Require at least one worker")
+        self._size = workers
+        self._backoff = backoff
+        self._maxBackoff = maxBackoff
+        self._cond = Condition()
+        self._heap = []                 # The due queue, (due time, sequence, key)
+        self._tasks = {}                # The pending tasks, key --> [ func, due time, deadline ]
+        self._running = set()           # The running keys
+        self._reruns = {}               # The keys submitted when running, key --> (func, due time)
+        self._failures = {}             # The continuous failures, key --> count
+        self._sequence = count()
+        self._workers = []
+
+    def submit(self, key, func, delay = 0.0, debounce = None):
+        """Submit a task
+        Parameters:
+            key                             The task key
+            func                            The task function, called without any parameter
+            delay                           Run the task after delay seconds
+            debounce                        Postpone the pending task to delay seconds later, but no longer than debounce seconds after it's first submitted
+        Returns:
+            Nothing
+        """
+        now = time.time()
+        due = now + delay
+        with self._cond:
+            if key in self._running:
+                # Run again after the running one is done
+                rerun = self._reruns.get(key)
+                if rerun is None or due < rerun[1] or not debounce is None:
+                    self._reruns[key] = (func, due, debounce)
+                return
+            task = self._tasks.get(key)
+            if task:
+                # Pending, use the new function
+                task[0] = func
+                if not debounce is None:
+                    # Postpone until settled
+                    due = min(due, task[2])
+                    if task[1] == due:
+                        return
+                elif task[1] <= due:
+                    # Use the earlier due time
+                    return
+                task[1] = due
+            else:
+                self._tasks[key] = [ func, due, now + debounce if not debounce is None else due ]
+            heapq.heappush(self._heap, (due, next(self._sequence), key))
+            # Start the workers
+            while len(self._workers) < self._size:
+                thread = Thread(target = self.__work__)
+                thread.setDaemon(True)
+                thread.start()
+                self._workers.append(thread)
+            self._cond.notify()
+
+    def getBackoff(self, failures):
+        """Get the retry backoff in seconds
+        Parameters:
+            failures                        The continuous failures
+        """
+        backoff = min(self._backoff * (2 ** min(failures - 1, 30)), self._maxBackoff)
+        # Equal jitter
+        return backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+    def getNextTask(self):
+        """Wait for the next due task
+        Returns:
+            (key, func)
+        """
+        with self._cond:
+            while True:
+                # Remove the replaced entries
+                while self._heap:
+                    due, _, key = self._heap[0]
+                    task = self._tasks.get(key)
+                    if task and task[1] == due:
+                        break
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, key = self._heap[0]
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                # Good
+                heapq.heappop(self._heap)
+                func, _, _ = self._tasks.pop(key)
+                self._running.add(key)
+                return key, func
+
+    def __work__(self):
+        """The worker thread
+        """
+        while True:
+            key, func = self.getNextTask()
+            delay = None
+            try:
+                delay = func()
+            except:
+                failures = self._failures.get(key, 0) + 1
+                self._failures[key] = failures
+                delay = self.getBackoff(failures)
+                self.logger.exception("Failed to run task [%s], will retry in [%.1f]s", key, delay)
+            else:
+                self._failures.pop(key, None)
+            with self._cond:
+                self._running.discard(key)
+                rerun = self._reruns.pop(key, None)
+            if rerun:
+                # Submitted when running, the new submit takes priority over the retry
+                func, due, debounce = rerun
+                self.submit(key, func, max(due - time.time(), 0.0), debounce)
+            elif not delay is None:
+                self.submit(key, func, delay)
@@ -13,25 +13,33 @@
 
 """
 
+import sys
 import time
+import socket
 import logging
 
 from etcd import EtcdKeyNotFound, EtcdWatchTimedOut, EtcdEventIndexCleared
 
-from util import json
+from util import json, diffPaths
+from resilience import CircuitBreaker, Bulkhead, CircuitOpenError, BulkheadFullError
 from config import EnvironConfig
-from threading import Thread, RLock, Event
-from contextlib import contextmanager
+from threading import Thread, Lock, Event, local
+from collections import deque
 
 NoDefault = object()
 
 class ConfigSection(dict):
     """The config section
+    Known configs (of all sections):
+        - settle                The settle window in seconds, a burst of updates within it is reloaded once
     """
     logger = logging.getLogger("configmslib.section")
 
     Type = None
     ReloadRequired = False
+    SettleTime = 0.0            # The default settle window in seconds
+    MaxSettleTime = 5.0         # The max seconds a reload could be postponed by the settle window
+    SlowLoading = False         # Whether the reloading may take minutes, run on the dedicated scheduler of the repository if True
 
     def __init__(self, key, value, repository, autoUpdate = False, environ = None, wait = False):
         """Create a new ConfigSection
@@ -46,24 +54,19 @@ class ConfigSection(dict):
         self._autoUpdate = autoUpdate
         self._environ = EnvironConfig(**environ) if environ else None
         self._updatedEvent = Event()
-        self._timestamp = 0.0
-        self._reloadLock = None
-        self._reloadEvent = None
+        self._updateLock = Lock()
+        self._etcdLock = Lock()         # Serialize the updates from etcd by the modified index
+        self._snapshot = ConfigSnapshot({})     # The current config, replaced as a whole when updated
+        self._index = None              # The etcd modified index of current config
+        self._etcdIndex = None          # The etcd index when current config is read, the changes are watched after it
         self._reloadedEvent = None
-        self._reloadThread = None
+        self._reloadedGeneration = 0    # The generation of the snapshot reloaded
         self._autoUpdateThread = None
         # Super
         super(ConfigSection, self).__init__()
         # Check if reload is required
         if self.ReloadRequired:
-            self._reloadLock = RLock()
-            self._reloadEvent = Event()
             self._reloadedEvent = Event()
-            # Start reload thread
-            thread = Thread(target = self.__reload__)
-            thread.setDaemon(True)
-            thread.start()
-            self._reloadThread = thread
         # Update the value
         try:
             value = self.getInitialUpdatedValue()
@@ -73,18 +76,17 @@ class ConfigSection(dict):
         self.update(value)
         # Check auto update (Key will empty value is not be auto updated)
         if key and autoUpdate:
-            thread = Thread(target = self.__autoupdate__)
-            thread.setDaemon(True)
-            thread.start()
-            self._autoUpdateThread = thread
+            if repository.sharedWatch:
+                # Watched by the shared watcher of the repository
+                repository.watch(self)
+            else:
+                thread = Thread(target = self.__autoupdate__)
+                thread.setDaemon(True)
+                thread.start()
+                self._autoUpdateThread = thread
         # Wait
         if wait:
-            if self.ReloadRequired and self._reloadedEvent:
-                # Wait for reloaded
-                self._reloadedEvent.wait()
-            elif self._updatedEvent:
-                # Wait for updated
-                self._updatedEvent.wait()
+            self.ready()
 
     @property
     def key(self):
@@ -98,6 +100,49 @@ class ConfigSection(dict):
         """
         return self._repository
 
+    @property
+    def scheduler(self):
+        """Get the scheduler to run the background tasks of this section
+        """
+        if self.SlowLoading:
+            return self._repository.loadScheduler
+        return self._repository.scheduler
+
+    @property
+    def etcdIndex(self):
+        """Get the etcd index when current config is read, None if not read from etcd
+        """
+        return self._etcdIndex
+
+    @property
+    def environ(self):
+        """Get the environ config of this section
+        """
+        return self._environ or self._repository.environ
+
+    def snapshot(self):
+        """Get the snapshot of current config
+        Returns:
+            The ConfigSnapshot object
+        NOTE:
+            The snapshot is never modified after created, read it instead of this section for a consistent view
+        """
+        return self._snapshot
+
+    def ready(self, timeout = None):
+        """Wait for this section ready
+        Parameters:
+            timeout                         The timeout in seconds, wait forever if not specified
+        Returns:
+            True if ready, False if timed out
+        """
+        if self.ReloadRequired and self._reloadedEvent:
+            # Wait for reloaded
+            return self._reloadedEvent.wait(timeout)
+        else:
+            # Wait for updated
+            return self._updatedEvent.wait(timeout)
+
     def first(self, key, default = NoDefault):
         """Get first value of key
         """
@@ -135,14 +180,13 @@ class ConfigSection(dict):
                     pass
             else:
                 yield obj
-        for value in iterfind(self, key.split(".")):
+        for value in iterfind(self._snapshot, key.split(".")):
             yield value
 
     def __autoupdate__(self):
         """Auto update
         """
-        # TODO: Support modified index
-        initialized = False
+        index = self._etcdIndex     # The last seen etcd index, None means the config should be read again
         self.logger.debug("[%s] Auto update thread started", self.Type)
         while True:
             # Get etcd client
@@ -156,24 +200,34 @@ class ConfigSection(dict):
                 break
             # Wait for the config
             # Get the read path
-            if self._environ:
-                path = self._environ.getEtcdPath(self._key)
-            else:
-                path = self._repository.environ.getEtcdPath(self._key)
+            path = self.environ.getEtcdPath(self._key)
             # Wait the config
             try:
-                if not initialized:
-                    # Not initialized
-                    self.logger.debug("[%s] Watching config at path [%s]", self.Type, path)
-                    if self.update(json.loads(client.read(path).value)):
-                        initialized = True
+                if index is None:
+                    # Not initialized or the watch index is cleared, read the current config
+                    self.logger.debug("[%s] Reading config at path [%s]", self.Type, path)
+                    result = client.read(path)
+                    index = result.etcd_index
+                    self.updateByEtcd(json.loads(result.value), result.modifiedIndex)
                 else:
-                    # Initialized, just wait
-                    self.logger.debug("[%s] Watching config at path [%s]", self.Type, path)
-                    self.update(json.loads(client.read(path, wait = True).value))
-            except (EtcdKeyNotFound, EtcdWatchTimedOut, EtcdEventIndexCleared):
-                # A normal error
-                time.sleep(10)
+                    # Initialized, wait for the changes after the last seen index
+                    self.logger.debug("[%s] Watching config at path [%s] from index [%s]", self.Type, path, index + 1)
+                    result = client.read(path, wait = True, waitIndex = index + 1)
+                    index = result.modifiedIndex
+                    if not result.value is None:
+                        self.updateByEtcd(json.loads(result.value), index)
+            except EtcdWatchTimedOut:
+                # Nothing changed, watch again
+                pass
+            except EtcdEventIndexCleared:
+                # The changes after the index are cleared, read the config again
+                self.logger.info("[%s] Watch index [%s] cleared at path [%s], will read again", self.Type, index, path)
+                index = None
+            except EtcdKeyNotFound as error:
+                # The config is not created, watch the creation from the current etcd index
+                index = (error.payload or {}).get("index")
+                if index is None:
+                    time.sleep(10)
             except:
                 # Error, wait 30s and continue watch
                 self.logger.exception("[%s] Failed to watch etcd, will retry in 30s", self.Type)
@@ -184,19 +238,49 @@ class ConfigSection(dict):
         """
         if self._repository.etcd is None:
             raise ValueError("No etcd available")
-        if self._environ:
-            path = self._environ.getEtcdPath(self._key)
-        else:
-            path = self._repository.environ.getEtcdPath(self._key)
-        # Get value
-        return json.loads(self._repository.etcd.read(path).value)
+        # Get value, from the prefetched configs if available
+        result, self._etcdIndex = self._repository.readConfig(self.environ, self._key)
+        self._index = result.modifiedIndex
+        return json.loads(result.value)
+
+    def updateByEtcd(self, value, index):
+        """Update the config by the value read from etcd
+        Parameters:
+            value                           The config value
+            index                           The etcd modified index of the value
+        Returns:
+            True if updated
+        NOTE:
+            The value which is not newer than current config is ignored
+        """
+        with self._etcdLock:
+            if not self._index is None and index <= self._index:
+                return False
+            self._index = index
+            return self.update(value)
+
+    def resync(self):
+        """Read the config from etcd again, used when the changes after it's read may be missed
+        Returns:
+            True if updated
+        """
+        client = self._repository.etcd
+        if client is None:
+            return False
+        try:
+            result = client.read(self.environ.getEtcdPath(self._key))
+        except EtcdKeyNotFound:
+            return False
+        updated = self.updateByEtcd(json.loads(result.value), result.modifiedIndex)
+        self._etcdIndex = max(self._etcdIndex, result.etcd_index)
+        return updated
 
     def update(self, value):
         """Update the config
         Parameters:
             value                           The config value
         Returns:
-            Nothing
+            True if updated
         """
         if not isinstance(value, dict):
             self.logger.error("[%s] Failed to update config, value must be a dict", self.Type)
@@ -207,22 +291,24 @@ class ConfigSection(dict):
         except:
             self.logger.exception("[%s] Failed to validate config value: [%s]", self.Type, json.dumps(value, ensure_ascii = False))
             return False
-        # Remove all values from self and update new values
-        def updateConfig():
-            """Update the config
-            """
-            self.clear()
-            super(ConfigSection, self).update(value)
-            self._timestamp = time.time()
-        # Update
-        if self._reloadLock:
-            with self._reloadLock:
-                updateConfig()
-        else:
-            updateConfig()
+        with self._updateLock:
+            # Compare with current config
+            changes = diffPaths(self._snapshot, value)
+            if self._snapshot.generation > 0 and not changes:
+                # Nothing changed, skip the update
+                self._updatedEvent.set()
+                self.logger.debug("[%s] Config not changed, skip update", self.Type)
+                return True
+            # Publish the new snapshot
+            snapshot = ConfigSnapshot(value, time.time(), self._snapshot.generation + 1, frozenset(changes))
+            self._snapshot = snapshot
+            # Update the values of self without clearing it first
+            super(ConfigSection, self).update(snapshot)
+            for key in [ x for x in self.iterkeys() if not x in snapshot ]:
+                super(ConfigSection, self).pop(key, None)
         # If reload is required
         if self.ReloadRequired:
-            self._reloadEvent.set()
+            self.requestReload()
         # Updated
         self._updatedEvent.set()
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -235,45 +321,137 @@ class ConfigSection(dict):
         """
         pass
 
+    def requestReload(self):
+        """Request to reload this config by the scheduler of the repository
+        NOTE:
+            The reload is postponed until the updates settle, except for the first one
+        """
+        key = ("reload", self._key, id(self))
+        settle = self._snapshot.get("settle", self.SettleTime)
+        if self._reloadedGeneration > 0 and settle > 0:
+            self.scheduler.submit(key, self.__reload__, settle, debounce = max(self.MaxSettleTime, settle))
+        else:
+            self.scheduler.submit(key, self.__reload__)
+
     def __reload__(self):
-        """Reload this config
+        """Reload this config by current snapshot
+        NOTE:
+            This method is run by the scheduler, which will retry it with backoff when raises
         """
-        self.logger.debug("[%s] Reload thread started", self.Type)
-        reloadedTimestamp = 0.0
-        while True:
-            if reloadedTimestamp >= self._timestamp:
-                # Wait for reload event
-                self._reloadEvent.wait()
-                self._reloadEvent.clear()
-            # Start reload until reload succeed
-            while True:
-                try:
-                    # Lock the reload lock, copy timestamp and config
-                    with self._reloadLock:
-                        reloadedTimestamp = self._timestamp
-                        config = dict(self)
-                    # Run reload
-                    self.reload(config)
-                except:
-                    self.logger.exception("[%s] Failed to reload config, will retry in 30s", self.Type)
-                    time.sleep(30)
-                else:
-                    self._reloadedEvent.set()
-                    break
+        snapshot = self._snapshot
+        if snapshot.generation <= self._reloadedGeneration:
+            # Already reloaded
+            return
+        delay = self.getReloadDelay(snapshot)
+        if not delay is None:
+            # Not ready to reload, run again later without counting a failure
+            self.logger.debug("[%s] Reload of section [%s] postponed for %.2fs", self.Type, self._key, delay)
+            return delay
+        metrics, start = self._repository.metrics, time.time()
+        try:
+            self.reload(snapshot)
+        except:
+            metrics.increase("reload_failures", self._key)
+            raise
+        now = time.time()
+        metrics.observe("reload_seconds", self._key, now - start)
+        metrics.observe("update_lag_seconds", self._key, now - snapshot.timestamp)
+        self._reloadedGeneration = snapshot.generation
+        self._reloadedEvent.set()
+
+    def getReloadDelay(self, config):
+        """Get the seconds to postpone the reload
+        Parameters:
+            config                          The config to reload
+        Returns:
+            The seconds to wait (e.g. the sections it depends on are still loading), None to reload now
+        """
+        return None
 
     def reload(self, config):
         """Reload this config
         """
         pass
 
+    def collectMetrics(self, metrics):
+        """Collect the metrics of this section
+        Parameters:
+            metrics                         The Metrics object
+        """
+        pass
+
     def close(self):
         """Close the config
         """
         pass
 
+class ConfigSnapshot(dict):
+    """The immutable snapshot of config section
+    """
+    def __init__(self, value, timestamp = 0.0, generation = 0, changes = frozenset()):
+        """Create a new ConfigSnapshot
+        Parameters:
+            value                           The config value
+            timestamp                       The updated timestamp
+            generation                      The generation of the config, increased by each update
+            changes                         The dotted paths changed from the previous snapshot
+        """
+        super(ConfigSnapshot, self).__init__(value)
+        self.timestamp = timestamp
+        self.generation = generation
+        self.changes = changes
+
+    def immutable(self, *args, **kwargs):
+        """The snapshot cannot be modified
+        """
+        raise TypeError("Config snapshot is immutable")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = immutable
+
+    def __reduce__(self):
+        """Support copy and pickle
+        """
+        return (ConfigSnapshot, (dict(self), self.timestamp, self.generation, self.changes))
+
 class ReferConfigSection(ConfigSection):
     """The config section which support reference counter
+    Known configs (of all refer sections):
+        - releaseTimeout        The seconds to wait for a superseded referenced value to be unreferenced, it's released by force after that
+        - lazy                  Do not create the referenced value until the first instance() call
+        - warmup                The number of connections (or true for one) to open and check before a new referenced value replaces the current one
+        - shared                Whether to share the referenced value with the sections of the same type and config or not, default is Shared
+        - breaker               The circuit breaker of instance(), see resilience module
+        - bulkhead              The bulkhead of instance(), see resilience module
+        - rebuildInterval       The min seconds between two rebuilds requested on errors, default is RebuildInterval
+        - holdMetrics           Record the instance_hold_seconds metric or not, default is false since it's recorded by the global metrics
     """
+    ReloadKeys = None           # The config keys which require creating a new referenced value when changed, None means all keys
+    BehaviorKeys = ( 'settle', 'releaseTimeout', 'lazy', 'warmup', 'shared', 'breaker', 'bulkhead', 'rebuildInterval', 'holdMetrics' )     # The config keys which don't affect the referenced value
+    Shared = True               # Share the referenced value by default
+    SettleTime = 0.5            # 500ms
+    ReapInterval = 1.0          # The interval in seconds to check the superseded referenced values
+    ReleaseTimeout = None       # Never release a referenced value by force by default
+    RebuildInterval = 30.0      # The min seconds between two rebuilds requested on errors
+
+    _value = None
+    _referencedConfig = None    # The config of current referenced value
+
+    def __init__(self, *args, **kwargs):
+        """Create a new ReferConfigSection
+        """
+        self._valueLock = Lock()
+        self._buildLock = Lock()
+        self._lazyConfig = None     # The config to create the referenced value of lazy section
+        self._superseded = []       # The superseded referenced values waiting for release
+        self._breaker = None        # The CircuitBreaker of instance()
+        self._bulkhead = None       # The Bulkhead of instance()
+        self._policyConfigs = (None, None)
+        self._holdMetrics = False   # Record the hold time of instance() or not
+        self._rebuildTime = 0.0     # The last time a rebuild is requested on errors
+        self._handle = InstanceHandle(self)
+        # Super
+        super(ReferConfigSection, self).__init__(*args, **kwargs)
+
     def reference(self, config):
         """Get the current referenced value
         """
@@ -289,61 +467,424 @@ class ReferConfigSection(ConfigSection):
         """
         pass
 
+    def isBackendError(self, error):
+        """Tell if the error raised in the with statements is caused by the backend, which is counted by the circuit breaker
+        NOTE:
+            Only the socket errors by default, the sections should override it with the connection errors of the client
+        """
+        return isinstance(error, socket.error)
+
+    def warmup(self, value, connections):
+        """Open and check the connections of the new referenced value before it's used
+        Parameters:
+            value                           The value returned by reference
+            connections                     The number of connections to open
+        NOTE:
+            Raise if the value is not healthy, the current referenced value will be kept
+        """
+        pass
+
+    @classmethod
+    def runConcurrently(cls, func, count):
+        """Run func in count threads concurrently, used to open multiple pooled connections
+        Returns:
+            Nothing, raise the first error if any
+        """
+        errors = []
+        def run():
+            """Run the func
+            """
+            try:
+                func()
+            except Exception as error:
+                errors.append(error)
+        threads = [ Thread(target = run) for _ in range(count) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def getInstanceValue(self, value):
         """Get the value returned by instance method
         """
         yield value
 
+    def isReferenceChanged(self, config):
+        """Tell if the referenced value should be created again for the config
+        """
+        if self._value is None or self._referencedConfig is None:
+            return True
+        changes = diffPaths(self._referencedConfig, config)
+        if self.ReloadKeys is None:
+            return any(not path.split(".")[0] in self.BehaviorKeys for path in changes)
+        return any(path.split(".")[0] in self.ReloadKeys for path in changes)
+
     def reload(self, config):
         """Reload this section
+        NOTE:
+            The lazy section only keeps the config until the referenced value is created by the first instance() call
+        """
+        self.configurePolicies(config)
+        with self._buildLock:
+            if config.get("lazy") and self._value is None:
+                self.logger.debug("[%s] Lazy section, defer creating the referenced value", self.Type)
+                self._lazyConfig = config
+                return
+            if not self.isReferenceChanged(config):
+                self.logger.debug("[%s] Referenced config not changed, skip reload", self.Type)
+                self._referencedConfig = config
+                return
+            self.rebuild(config)
+
+    def configurePolicies(self, config):
+        """Create the circuit breaker and bulkhead if their configs are changed
+        NOTE:
+            The holders of instance() keep using the policies when they're entered
+        """
+        self._holdMetrics = bool(config.get("holdMetrics"))
+        configs = (config.get("breaker"), config.get("bulkhead"))
+        if configs == self._policyConfigs:
+            return
+        breaker, bulkhead = CircuitBreaker.fromConfig(configs[0]), Bulkhead.fromConfig(configs[1])
+        self._breaker, self._bulkhead, self._policyConfigs = breaker, bulkhead, configs
+        self.logger.info("[%s] Resilience policies configured, breaker [%s] bulkhead [%s]", self.Type, configs[0], configs[1])
+
+    def rebuild(self, config, renew = False):
+        """Create a new referenced value for the config no matter it is changed or not
+        Parameters:
+            config                          The config
+            renew                           Replace the current value which is broken, the shared one is replaced for all sections using it
+        NOTE:
+            The build lock should be held
+        """
+        if renew:
+            current = self._value
+            value, created = self.renewShared(config, current.value if current else None)
+        else:
+            value, created = self.referenceShared(config)
+        connections = config.get("warmup")
+        if connections and created:
+            # Warm up before replacing the current one
+            try:
+                self.warmup(value, 1 if connections is True else int(connections))
+            except:
+                self.logger.exception("[%s] Failed to warm up the new referenced value, keep the current one", self.Type)
+                try:
+                    self.releaseShared(value)
+                except:
+                    self.logger.exception("[%s] Failed to release the new referenced value", self.Type)
+                raise
+        value = ReferencedValue(value)
+        with self._valueLock:
+            superseded = self._value
+            if not superseded is None:
+                superseded.supersededTime = time.time()
+                self._superseded.append(superseded)
+            self._value = value
+            self._referencedConfig = config
+        if not superseded is None:
+            # Release the superseded value by the reaper if no one is using it
+            self.scheduler.submit(("reap", self._key, id(self)), self.__reap__)
+
+    def requestRebuild(self):
+        """Request to rebuild the referenced value in background, used to recover from the backend errors
+        NOTE:
+            - The caller never waits for the rebuild
+            - Only one rebuild runs at the same time, and the requests within rebuildInterval seconds after the last one are ignored
+        """
+        interval = self._snapshot.get("rebuildInterval", self.RebuildInterval)
+        with self._valueLock:
+            now = time.time()
+            if self._value is None or now - self._rebuildTime < interval:
+                return
+            self._rebuildTime = now
+        self.logger.info("[%s] Rebuild the referenced value in background", self.Type)
+        self.scheduler.submit(("rebuild", self._key, id(self)), self.__rebuild__)
+
+    def __rebuild__(self):
+        """Rebuild the referenced value by the current config
+        NOTE:
+            This method is run by the scheduler
+        """
+        with self._buildLock:
+            config = self._referencedConfig
+            if self._value is None or config is None:
+                return
+            self.rebuild(config, renew = True)
+        self.logger.info("[%s] Referenced value rebuilt", self.Type)
+
+    def referenceShared(self, config):
+        """Get the referenced value from the shared clients of repository
+        Returns:
+            (value, created)
+        """
+        if not config.get("shared", self.Shared) or self._repository is None:
+            return self.reference(config), True
+        return self._repository.clients.reference(self, config)
+
+    def renewShared(self, config, value):
+        """Renew the broken referenced value by the shared clients of repository
+        Returns:
+            (value, created)
+        """
+        if not config.get("shared", self.Shared) or self._repository is None:
+            return self.reference(config), True
+        return self._repository.clients.renew(self, config, value)
+
+    def sharedRenewed(self, value):
+        """The shared referenced value is renewed by another section, rebuild to use the new one if it's the current value
         """
-        self._value = ReferencedValue(self.reference(config))
+        current = self._value
+        if not current is None and current.value is value:
+            with self._valueLock:
+                self._rebuildTime = time.time()
+            self.logger.info("[%s] Shared referenced value renewed by another section, rebuild in background", self.Type)
+            self.scheduler.submit(("rebuild", self._key, id(self)), self.__rebuild__)
+
+    def releaseShared(self, value):
+        """Release the referenced value, it's not released until no section is using it
+        """
+        if self._repository is None:
+            self.release(value)
+        else:
+            self._repository.clients.release(self, value)
+
+    def __reap__(self):
+        """Release the superseded referenced values which are not referenced
+        Returns:
+            The seconds to check again, None if no value is waiting for release
+        NOTE:
+            This method is run by the scheduler
+        """
+        timeout = self._snapshot.get("releaseTimeout", self.ReleaseTimeout)
+        now = time.time()
+        for value in list(self._superseded):
+            if not self.releaseSuperseded(value) and not timeout is None and now - value.supersededTime >= timeout:
+                self.logger.warn("[%s] Superseded referenced value is still referenced [%d] after [%s]s, release by force", self.Type, value.refcount, timeout)
+                self.releaseSuperseded(value, force = True)
+        if self._superseded:
+            return self.ReapInterval
+
+    def getLazyValue(self):
+        """Get the referenced value, create it by the deferred config if not created
+        Returns:
+            The ReferencedValue object
+        NOTE:
+            Only one of the concurrent callers creates the referenced value, the others wait for it
+        """
+        with self._buildLock:
+            if self._value is None:
+                if self._lazyConfig is None:
+                    raise ValueError("Section [%s] is not loaded" % self._key)
+                self.logger.info("[%s] Create the referenced value of lazy section", self.Type)
+                self.rebuild(self._lazyConfig)
+                self._lazyConfig = None
+            return self._value
+
+    def releaseSuperseded(self, value, force = False):
+        """Release the superseded referenced value if it's not referenced
+        Parameters:
+            value                           The ReferencedValue object
+            force                           Release it even if it's referenced
+        Returns:
+            True if released, False if it's referenced, not superseded or already released
+        """
+        with self._valueLock:
+            if not value in self._superseded:
+                return False
+            if not value.retire() and not force:
+                return False
+            self._superseded.remove(value)
+        # Release
+        self.logger.info("[%s] Referenced value changed and release is required", self.Type)
+        try:
+            self.releaseShared(value.value)
+        except:
+            self.logger.exception('[%s] Failed to release the old referenced value', self.Type)
+        return True
+
+    def collectMetrics(self, metrics):
+        """Collect the metrics of this section
+        """
+        value, superseded = self._value, list(self._superseded)
+        metrics.gauge("referenced_value_refcount", self._key, value.refcount if value else 0)
+        metrics.gauge("instance_holders", self._key, sum(x.refcount for x in superseded) + (value.refcount if value else 0))
+        metrics.gauge("superseded_values", self._key, len(superseded))
+        if value and not self._repository is None:
+            metrics.gauge("referenced_value_shares", self._key, self._repository.clients.getShares(value.value))
+        breaker, bulkhead = self._breaker, self._bulkhead
+        if breaker:
+            metrics.gauge("breaker_state", self._key, (CircuitBreaker.Closed, CircuitBreaker.HalfOpen, CircuitBreaker.Open).index(breaker.state))
+        if bulkhead:
+            metrics.gauge("bulkhead_active", self._key, bulkhead.active)
+            metrics.gauge("bulkhead_waiting", self._key, bulkhead.waiting)
 
-    @contextmanager
     def instance(self):
         """Get the instance
+        Returns:
+            A context manager which returns the instance value when entered
+        NOTE:
+            - The same context manager object is returned every time, the state of each enter is kept in thread local
+            - The nested calls in the same thread get the same instance value as the outermost one
         """
-        value = None
+        return self._handle
+
+class InstanceHandle(object):
+    """The context manager returned by ReferConfigSection.instance
+    """
+    def __init__(self, section):
+        """Create a new InstanceHandle
+        """
+        self._section = section
+        self._local = local()
+        # Skip the getInstanceValue generator if it's not overridden
+        self._plain = getattr(type(section).getInstanceValue, "__func__", None) is ReferConfigSection.getInstanceValue.__func__
+
+    def __enter__(self):
+        """Reference the current value and return the instance value
+        NOTE:
+            The nested enters in the same thread reuse the instance value of the outermost one
+        """
+        local = self._local
+        entry = getattr(local, "entry", None)
+        if not entry is None:
+            # Reentered, no reference is required
+            local.depth += 1
+            return entry[3]
+        section = self._section
+        breaker, bulkhead, probe = section._breaker, section._bulkhead, False
+        # Check the resilience policies
+        try:
+            if breaker:
+                probe = breaker.allow()
+            if bulkhead:
+                try:
+                    bulkhead.acquire()
+                except BulkheadFullError:
+                    if breaker:
+                        breaker.cancel(probe)
+                    raise
+        except CircuitOpenError:
+            section._repository.metrics.increase("breaker_rejections", section._key)
+            raise
+        except BulkheadFullError:
+            section._repository.metrics.increase("bulkhead_rejections", section._key)
+            raise
+        # Only the circuit breaker and hold metrics require the time
+        value, start = None, time.time() if breaker or section._holdMetrics else None
         try:
-            value = self._value
-            # Increase
-            value.increase()
-            # Yield return the referenced value
-            yield self.getInstanceValue(value.value).next()
+            value = section._value
+            if value is None:
+                value = section.getLazyValue()
+            # Increase, get the current value again if it has been released
+            while not value.increase():
+                value = section._value
+            if self._plain:
+                instance, generator = value.value, None
+            else:
+                generator = section.getInstanceValue(value.value)
+                instance = generator.next()
         except Exception as error:
             # Run within error
-            self.withinError(error)
+            section.withinError(error)
+            if not value is None:
+                self.unreference(value, start)
+            self.leave(breaker, bulkhead, probe, error, start)
             # Re-raise
             raise
+        local.entry, local.depth, local.error = (value, generator, start, instance, breaker, bulkhead, probe), 1, None
+        return instance
+
+    def __exit__(self, excType, excValue, traceback):
+        """Unreference the value when the outermost enter exits
+        """
+        section, local = self._section, self._local
+        local.depth -= 1
+        if not excType is None and issubclass(excType, Exception) and not excValue is local.error:
+            # Run within error once for each error
+            local.error = excValue
+            section.withinError(excValue)
+        if local.depth > 0:
+            return False
+        value, generator, start, _, breaker, bulkhead, probe = local.entry
+        local.entry, local.error = None, None
+        try:
+            if not generator is None:
+                self.closeGenerator(generator, excType, excValue, traceback)
         finally:
-            if not value is None:
-                # Decrease
-                value.decrease()
-            # Check if the referenced value is changed
-            if self._value != value and value.notReferenced:
-                # Updated and should be released
-                self.logger.info("[%s] Referenced value changed and release is required", self.Type)
-                # Release
-                try:
-                    self.release(value.value)
-                except:
-                    self.logger.exception('[%s] Failed to release the old referenced value', self.Type)
+            self.unreference(value, start)
+            self.leave(breaker, bulkhead, probe, excValue if not excType is None and issubclass(excType, Exception) else None, start)
+        # Do not suppress the exception
+        return False
+
+    def leave(self, breaker, bulkhead, probe, error, start):
+        """Record the outcome to the circuit breaker and release the bulkhead slot
+        """
+        if bulkhead:
+            bulkhead.release()
+        if breaker:
+            breaker.record(not error is None and self._section.isBackendError(error), time.time() - start, probe)
+
+    def unreference(self, value, start):
+        """Decrease the reference of value and release it if it's superseded and not referenced
+        """
+        section = self._section
+        value.decrease()
+        # Check if the referenced value is changed
+        if not value is section._value and value.notReferenced:
+            # Updated and should be released
+            section.releaseSuperseded(value)
+        if section._holdMetrics and not start is None:
+            section._repository.metrics.observe("instance_hold_seconds", section._key, time.time() - start)
+
+    @classmethod
+    def closeGenerator(cls, generator, excType, excValue, traceback):
+        """Close the getInstanceValue generator, the exception is thrown into it
+        """
+        if excType is None:
+            try:
+                generator.next()
+            except StopIteration:
+                return
+            raise RuntimeError("getInstanceValue generator didn't stop")
+        else:
+            try:
+                generator.throw(excType, excValue, traceback)
+            except StopIteration:
+                return
+            except:
+                if sys.exc_info()[1] is excValue:
+                    # The same exception, will be raised by with statement
+                    return
+                raise
+            raise RuntimeError("getInstanceValue generator didn't stop after throw()")
 
 class ReferencedValue(object):
     """The referenced value
+    NOTE:
+        The reference counter is a deque of which append and pop are atomic, no lock is required
     """
     def __init__(self, value):
         """Create a new ReferencedValue object
         """
-        self._lock = RLock()
-        self._refcount = 0
+        self._refs = deque()
+        self._retired = False
         self._value = value
+        self.supersededTime = None      # The time this value is superseded
 
     @property
     def notReferenced(self):
         """Tell if current value is not referenced
         """
-        return self._refcount == 0
+        return not self._refs
+
+    @property
+    def refcount(self):
+        """Get the reference count
+        """
+        return len(self._refs)
 
     @property
     def value(self):
@@ -353,12 +894,33 @@ class ReferencedValue(object):
 
     def increase(self):
         """Increase the reference counter
+        Returns:
+            True if increased, False if this value is retired
         """
-        with self._lock:
-            self._refcount += 1
+        self._refs.append(None)
+        if self._retired:
+            # Retired, revert
+            self._refs.pop()
+            return False
+        return True
+
+    def retire(self):
+        """Retire this value if it's not referenced, a retired value could not be referenced any more
+        Returns:
+            True if retired
+        NOTE:
+            Should not be called concurrently
+        """
+        if self._retired:
+            return True
+        self._retired = True
+        if self._refs:
+            # Referenced, revert
+            self._retired = False
+            return False
+        return True
 
     def decrease(self):
         """Decrease the reference counter
         """
-        with self._lock:
-            self._refcount -= 1
+        self._refs.pop()
@@ -14,17 +14,30 @@ reload(sys)
 sys.setdefaultencoding('utf-8')
 
 from configmslib.section import ReferConfigSection
-from threading import Lock
+from threading import Lock, Thread, Event
 import gridfs
 import simplejson as json
+import hashlib
 import logging
 import os
-import hashlib
+import time
+import datetime
+import bson
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure
+from dictstore import FileLock, HashTable, HashTableWriter, writecache, writeatomic, readcacheheader, itercacheblocks
 
 
 LOG = logging.getLogger("configms.sections.dict")
 DEFAULT_CACHE_DIR = '/tmp/.bdmd/.dict'
+DEFAULT_MMAP_TTL = 600
+DEFAULT_TAIL_INTERVAL = 5
+DEFAULT_TAIL_CHECKPOINT = 60
+DEFAULT_CACHE_INTERVAL = 600
 NoDefault = object()
+# The config keys the cached items are built by
+CACHE_CONFIG_KEYS = ('dbtype', 'datatype', 'key_field', 'value_field', 'database', 'collection', 'filename',
+                     'index', 'doctype', 'updated_field', 'deleted_field')
 
 
 class DictConfigSection(ReferConfigSection):
@@ -40,21 +53,61 @@ class DictConfigSection(ReferConfigSection):
                     - collection: collection name, default to 'fs' for gridfs
                 - For gridfs:
                     - filename
+                - For mongodb:
+                    - updated_field: the field of last update time (or any increasing value) of documents, it
+                        should be indexed. When set, the dict is refreshed by the documents updated after the last
+                        loaded one instead of reloading the entire collection (mmap storage is reloaded only if the
+                        collection has changed). The key fields of a document should never change
+                    - deleted_field: the tombstone flag field, the documents with true flag are removed from dict.
+                        The deleted documents are never seen by refresh, so mark them instead of deleting
+                    - tail: apply the inserts, updates and deletes of the change stream of the collection to the
+                        loaded dict (memory storage only), default to false. The resume token is saved next to the
+                        cache file every tail_checkpoint (default to 60) seconds, together with the cache if the cache
+                        is rewritten, so the tailing is resumed from the cache after restart. If change stream is not
+                        supported (not a replica set) the dict is refreshed by updated_field every tail_interval
+                        (default to 5) seconds instead.
+                        The deletes are applied by _id, so a map of _id to key is kept in memory and saved with
+                        the cache as well. The dict is reloaded from the collection once the tailing loses changes
+                        (e.g. the collection is dropped or the resume token is out of oplog)
             - backend: the backend database where data is stored, should be in the same repository
             - datatype: json | kv,  when dbtype is mongodb or elasticsearch, type is allways json, when dbtype is gridfs, both json and kv can be set
                 - For json:
                     - key_field: list of key field
                     - value_field: the value field, default to entire obj
                 - For kv: first column is key, second column is value, all the other columns is ignored
-            - enable_cache: whether the dict will be cached to disk to avoid downloading everytime
+            - enable_cache: whether the dict will be cached to disk to avoid downloading everytime, the cache file
+                is in a binary format (see dictstore), and the gridfs cache is reused until the file md5 changes
+                - cache_interval: the min seconds to rewrite the entire cache file after the refreshed or tailed
+                    changes, default to 600. The older cache is caught up by the watermark or resume token when loaded
             - cache_path: cache directory, use different dir for modules
+            - storage: memory | mmap, default to memory
+                - For mmap: the dict is built once into a hash table file in cache_path, and mapped read-only
+                    by every process, values are decoded on lookup
+                - mmap_ttl: the seconds a hash table file is reused when the source has no version (mongodb and
+                    elasticsearch), default to 600. The gridfs file is reused until the md5 changes
+            - refresh_interval: the seconds to check if the source has changed, disabled by default
+                - For gridfs: the dict is reloaded when the md5 of the last version changes
+                - For mongodb with updated_field: the updated documents are applied to the dict in place
+                - For mongodb and elasticsearch: the dict is reloaded every interval since the source has no version,
+                    and the cache file older than the interval is not used
+        The dict is also reloaded when the section config is changed in etcd (e.g. bump a `revision` key), the
+        source without version (mongodb without updated_field and elasticsearch) is loaded again instead of the cache.
+        The new dict is loaded in background while the current one keeps serving, and the old dict is released
+        once all its instance() holders exit, so both dicts are in memory during the reload. The loads and refreshes
+        run on the dedicated load scheduler of the repository, so they never hold up the reloads of other sections
     """
     Type = 'dict'
     ReloadRequired = True
+    SlowLoading = True
+    BackendWaitTime = 0.2   # The seconds to check the backend again when it's not ready
+    Shared = False          # The dict is loaded by the section name
+    BehaviorKeys = ReferConfigSection.BehaviorKeys + ('refresh_interval', )
 
     def validate(self, value):
         if not value.get('dbtype'):
             raise ValueError('dbtype is required')
+        if value.get('storage', 'memory') not in ('memory', 'mmap'):
+            raise ValueError('unknown storage')
         if value.get('dbtype') == 'elasticsearch':
             if not value.get('index') or not value.get('doctype'):
                 raise ValueError('index and doctype is required')
@@ -67,29 +120,125 @@ class DictConfigSection(ReferConfigSection):
         else:
             raise ValueError('unknown dbtype')
 
+    def getReloadDelay(self, config):
+        """
+            @Brief getReloadDelay wait for the backend ready quietly, it may be still loading since sections are waited together
+            @Param config:
+            @Return the seconds to check again, None if the backend is ready (or not found, raised by reference)
+        """
+        backend = self.repository[config['backend']]
+        if backend is not None and not backend.ready(0):
+            LOG.debug('dict[%s] backend [%s] not ready, wait' % (self.key, config['backend']))
+            return self.BackendWaitTime
+        return None
+
     def reference(self, config):
         """
             @Brief reference
             @Param config:
         """
-        return DictObj.getDict(self.key, config, self.repository)
+        backend = self.repository[config['backend']]
+        if backend is None:
+            raise ValueError('backend [%s] not found' % config['backend'])
+        # Checked by getReloadDelay before reload, do not block the reload worker if the backend is reloading again
+        if not backend.ready(0):
+            raise ValueError('backend [%s] not ready' % config['backend'])
+        # Replacing the current dict, the source without version should be loaded again instead of the cache
+        return DictObj.getDict(self.key, config, self.repository, reload=self._value is not None,
+                               on_lost=self.requestRefresh)
 
     def reload(self, config):
         """
-            @Brief reload Disable reload, dict can only load once
+            @Brief reload reload the dict if the config is changed, and schedule the refresh check
             @Param config:
         """
-        if hasattr(self, '_value') and self._value:
-            return
-        else:
-            super(DictConfigSection, self).reload(config)
+        super(DictConfigSection, self).reload(config)
+        interval = config.get('refresh_interval')
+        if interval:
+            self.scheduler.submit(('refresh', self.key, id(self)), self.__refresh__, float(interval))
+        value = self._value
+        if value is not None and value.value.lost:
+            # Lost before it's referenced by this section
+            self.requestRefresh()
+
+    def requestRefresh(self):
+        """
+            @Brief requestRefresh reload the dict in background now if it's stale, e.g. the tailing has lost changes
+        """
+        self.scheduler.submit(('refresh', self.key, id(self)), self.__refresh__)
+
+    def __refresh__(self):
+        """
+            @Brief __refresh__ reload the dict in background if the source has changed, run by the scheduler
+            @Return the seconds to check again, None if refresh is disabled
+        """
+        interval = self.snapshot().get('refresh_interval')
+        value = self._value
+        if value is not None and not value.value.refresh() and value.value.isStale():
+            with self._buildLock:
+                # Skip if reloaded by config when checking
+                if self._value is value:
+                    LOG.info('dict[%s] source changed, reload in background' % self.key)
+                    self.rebuild(self._referencedConfig, renew=True)
+        if interval:
+            return float(interval)
 
     def release(self, value):
         """
             @Brief release
             @Param value:
         """
-        self._value.value.clear()
+        value.close()
+
+
+def encodewatermark(value):
+    """
+        @Brief encodewatermark encode the updated field value into the version string
+        @Param value: datetime, number, ObjectId or Timestamp
+    """
+    if isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        return 'd:' + value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    elif isinstance(value, bool):
+        raise ValueError('unsupported updated_field value %r' % value)
+    elif isinstance(value, (int, long)):
+        return 'i:%d' % value
+    elif isinstance(value, float):
+        return 'f:%r' % value
+    elif isinstance(value, bson.ObjectId):
+        return 'o:%s' % value
+    elif isinstance(value, Timestamp):
+        return 't:%d,%d' % (value.time, value.inc)
+    raise ValueError('unsupported updated_field value %r' % value)
+
+
+def decodewatermark(version):
+    """
+        @Brief decodewatermark
+        @Param version: the string returned by encodewatermark
+    """
+    kind, value = version.split(':', 1)
+    if kind == 'd':
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    elif kind == 'i':
+        return int(value)
+    elif kind == 'f':
+        return float(value)
+    elif kind == 'o':
+        return bson.ObjectId(value)
+    elif kind == 't':
+        return Timestamp(*map(int, value.split(',')))
+    raise ValueError('bad watermark %s' % version)
+
+
+def hashconfig(config):
+    """
+        @Brief hashconfig get the hash of the config keys the cached items are built by
+        @Param config:
+    """
+    keys = dict((key, config.get(key)) for key in CACHE_CONFIG_KEYS)
+    return hashlib.md5(json.dumps(keys, sort_keys=True)).hexdigest()
 
 
 def ensuredirs(path, mode=None):
@@ -123,6 +272,11 @@ class DictObj(dict):
         else:
             self.datatype = config.get('datatype', 'json')
         self.enable_cache = config.get('enable_cache', False)
+        self.cached_time = None     # The time the cache file is written or loaded
+        self.reload_time = None     # The time the reload begins, None if it's not replacing a loaded dict
+        self.lost = False           # Whether the dict has lost changes of the source or not, it should be reloaded
+        self.on_lost = None         # Called when the dict is lost, to reload it
+        self.config_hash = hashconfig(config)
         cache_path = config.get('cache_path', DEFAULT_CACHE_DIR)
         if cache_path == DEFAULT_CACHE_DIR:
             ensuredirs(cache_path, 0o777)
@@ -133,15 +287,17 @@ class DictObj(dict):
         self._lock = Lock()
 
     @classmethod
-    def getDict(self, name, config, repository):
-        if config['dbtype'] == 'elasticsearch':
-            handler = ElasticDict(name, config, repository)
-        elif config['dbtype'] == 'mongodb':
-            handler = MongoDict(name, config, repository)
-        elif config['dbtype'] == 'gridfs':
-            handler = GridfsDict(name, config, repository)
+    def getDict(self, name, config, repository, reload=False, on_lost=None):
+        if config.get('storage', 'memory') == 'mmap':
+            classes = MMAP_DICT_CLASSES
         else:
+            classes = DICT_CLASSES
+        if config['dbtype'] not in classes:
             raise ValueError('unknown dbtype %s' % config['dbtype'])
+        handler = classes[config['dbtype']](name, config, repository)
+        if reload:
+            handler.reload_time = time.time()
+        handler.on_lost = on_lost
         handler.load()
         return handler
 
@@ -163,6 +319,50 @@ class DictObj(dict):
         """fetch data from backend server"""
         raise NotImplementedError()
 
+    def sourceVersion(self):
+        """
+            @Brief sourceVersion get the version of the source data
+            @Return the version or None if the source has no version
+        """
+        return None
+
+    def isCacheFresh(self, version):
+        """
+            @Brief isCacheFresh tell if the cache of the source version could be used
+                The cache of refreshed dict is not used after the refresh interval, and the reloaded dict only uses
+                the cache written after the reload begins (e.g. by another process)
+            @Param version: the source version in cache file
+        """
+        if self.reload_time is not None and os.path.getmtime(self.cache_path) < self.reload_time:
+            LOG.info('cachefile[%s] is older than the reload, ignored' % self.cache_path)
+            return False
+        interval = self.config.get('refresh_interval')
+        if interval and time.time() - os.path.getmtime(self.cache_path) >= interval:
+            LOG.info('cachefile[%s] is older than refresh interval, ignored' % self.cache_path)
+            return False
+        return True
+
+    def isStale(self):
+        """
+            @Brief isStale tell if the source has changed since loaded
+                The source without version is always stale
+        """
+        version = self.sourceVersion()
+        return version is None or version != self.md5
+
+    def refresh(self):
+        """
+            @Brief refresh apply the changes of source to the loaded dict in place
+            @Return True if refreshed, False if not supported and the dict should be reloaded when stale
+        """
+        return False
+
+    def close(self):
+        """
+            @Brief close the dict is released
+        """
+        self.clear()
+
     def find(self, obj, key):
         """
             @Brief find key in obj
@@ -252,28 +452,46 @@ class DictObj(dict):
     def loadCache(self):
         """loadCache"""
         if self.cache_path and os.path.exists(self.cache_path):
-            with open(self.cache_path) as df:
-                for line in df:
-                    obj = json.loads(line)
-                    key = obj['key']
-                    if isinstance(key, list):
-                        key = tuple(key)
-                    self[key] = obj['value']
+            with open(self.cache_path, 'rb') as df:
+                header = readcacheheader(df)
+                if header is None:
+                    LOG.info('cachefile[%s] is not in current format, ignored' % self.cache_path)
+                    return False
+                version, count, config = header
+                if config != self.config_hash:
+                    LOG.info('cachefile[%s] is built by another config, ignored' % self.cache_path)
+                    return False
+                if not self.isCacheFresh(version):
+                    return False
+                try:
+                    for block in itercacheblocks(df, count):
+                        self.update(block)
+                except Exception as e:
+                    LOG.warn('Failed to load cachefile[%s]: %s' % (self.cache_path, e))
+                    self.clear()
+                    return False
                 LOG.info(
                     'dict[%s] loaded from cachefile[%s]' %
                     (self.name, self.cache_path))
+            self.cached_time = os.path.getmtime(self.cache_path)
             return True
         return False
 
     def cache(self):
         if self.cache_path:
-            with open(self.cache_path, 'w') as df:
-                for k, v in self.iteritems():
-                    print >>df, json.dumps(
-                        {'key': k, 'value': v}, ensure_ascii=False)
+            writecache(self.cache_path, self.iteritems(), self.md5, self.config_hash)
+            self.cached_time = time.time()
             if os.path.dirname(self.cache_path) == DEFAULT_CACHE_DIR:
                 os.chmod(self.cache_path, 0o777)
 
+    def isCacheDue(self):
+        """
+            @Brief isCacheDue tell if the changed dict should rewrite the entire cache file now
+        """
+        if self.cached_time is None or not os.path.exists(self.cache_path):
+            return True
+        return time.time() - self.cached_time >= self.config.get('cache_interval', DEFAULT_CACHE_INTERVAL)
+
 
 class ElasticDict(DictObj):
 
@@ -324,23 +542,376 @@ class MongoDict(DictObj):
     """MongoDict
         Dict stored in mongodb collection
     """
+    # The error codes of change stream
+    STREAM_UNSUPPORTED = (40573, 40324)     # Not a replica set, or the server is older than 3.6
+    STREAM_HISTORY_LOST = (136, 280, 286)   # The resume token is not in oplog
+    STREAM_INVALIDATED = ('drop', 'rename', 'dropDatabase', 'invalidate')
+    STREAM_AWAIT_MS = 1000
 
     def __init__(self, name, config, repository):
         super(MongoDict, self).__init__(name, config, repository)
         self.database = config['database']
         self.collection = config['collection']
+        self.updated_field = config.get('updated_field')
+        self.deleted_field = config.get('deleted_field')
+        # The mmap hash table could not be changed in place
+        memory = config.get('storage', 'memory') == 'memory'
+        self.incremental = bool(self.updated_field) and memory
+        self.watermark = None
+        self.tailing = bool(config.get('tail')) and memory
+        self.tailer = None
+        self.stopped = Event()
+        self.token = None           # The resume token of change stream
+        self.synced = False         # Whether the dict has all the changes before the current token or not
+        self.dirty = False          # Whether the dict has changed since the cache file is written or not
+        self.ids = {} if self.tailing else None     # _id --> key, to apply deletes
+        self.token_path = self.cache_path + '.resume' if self.cache_path else None
+        self.ids_path = self.cache_path + '.ids' if self.cache_path else None
+
+    def load(self):
+        """
+            @Brief load the dict, and start tailing the change stream
+        """
+        super(MongoDict, self).load()
+        if self.tailing and self.tailer is None:
+            self.tailer = Thread(target=self.__tail__, name='dict-tail-%s' % self.name)
+            self.tailer.setDaemon(True)
+            self.tailer.start()
 
     def fetch(self):
         LOG.info('Loading dict[%s] from [%s]' % (self.name, self.backend))
         with self.repository[self.backend].instance() as client:
             collection = client[self.database][self.collection]
+            if self.tailing:
+                # The changes when fetching are applied again by tailing
+                try:
+                    self.token = self.currentToken(collection)
+                    self.synced = True
+                except OperationFailure as e:
+                    LOG.warn('Change stream of dict[%s] is not available: %s' % (self.name, e))
             count = 0
             for doc in collection.find():
                 count += 1
-                key, value = self.make(doc)
-                self[key] = value
+                self.apply(doc)
+            if self.watermark is not None:
+                self.md5 = encodewatermark(self.watermark)
             LOG.info('Loaded %d records for dict[%s]' % (count, self.name))
 
+    def apply(self, doc):
+        """
+            @Brief apply set or remove (by tombstone) the document, and advance the watermark
+            @Param doc:
+            @Return True if the document is updated after the watermark
+        """
+        key, value = self.make(doc)
+        deleted = self.deleted_field and self.getValue(doc, self.deleted_field, False)
+        if self.ids is not None and '_id' in doc:
+            # Remove the old key if the key fields are changed
+            old = self.ids.get(doc['_id'])
+            if old is not None and old != key:
+                self.pop(old, None)
+            if deleted:
+                self.ids.pop(doc['_id'], None)
+            else:
+                self.ids[doc['_id']] = key
+        if deleted:
+            self.pop(key, None)
+        else:
+            self[key] = value
+        if self.updated_field:
+            updated = self.getValue(doc, self.updated_field, None)
+            if updated is not None and (self.watermark is None or updated > self.watermark):
+                self.watermark = updated
+                return True
+        return False
+
+    def remove(self, _id):
+        """
+            @Brief remove the deleted document by _id
+            @Param _id:
+        """
+        key = self.ids.pop(_id, None)
+        if key is None and self.config.get('key_field') == ['_id']:
+            key = _id
+        if key is None:
+            LOG.warn('Ignore the deleted document [%s] of dict[%s], the key is unknown' % (_id, self.name))
+            return
+        self.pop(key, None)
+
+    def sourceVersion(self):
+        """
+            @Brief sourceVersion the last updated value of the collection if updated_field is set
+        """
+        if not self.updated_field:
+            return None
+        with self.repository[self.backend].instance() as client:
+            collection = client[self.database][self.collection]
+            for doc in collection.find({self.updated_field: {'$exists': True}}, [self.updated_field]) \
+                    .sort(self.updated_field, -1).limit(1):
+                return encodewatermark(self.getValue(doc, self.updated_field))
+        return None
+
+    def isStale(self):
+        """
+            @Brief isStale the tailed dict is stale if changes are lost
+        """
+        if self.tailer is not None:
+            return self.lost
+        return super(MongoDict, self).isStale()
+
+    def isCacheFresh(self, version):
+        """
+            @Brief isCacheFresh the incremental cache is always used and then refreshed from its watermark,
+                the other cache with updated_field is used if the collection has not changed
+            @Param version: the watermark of the cache
+        """
+        if self.tailing and self.token is not None:
+            # Resumed by tailing
+            if version:
+                self.md5, self.watermark = version, decodewatermark(version)
+            return True
+        if not self.updated_field or not version:
+            return super(MongoDict, self).isCacheFresh(version)
+        if not self.incremental and version != self.sourceVersion():
+            LOG.info('collection[%s] has changed since cachefile[%s]' % (self.collection, self.cache_path))
+            return False
+        self.md5 = version
+        self.watermark = decodewatermark(version)
+        return True
+
+    def loadCache(self):
+        """
+            @Brief loadCache load the cache, and refresh it to current if incremental
+                The cache and resume token of tailed dict are loaded together
+        """
+        if self.tailing and self.cache_path:
+            with FileLock(self.cache_path + '.lock'):
+                self.token = self.loadToken()
+                if self.token is None and not self.incremental:
+                    LOG.info('No resume token of cachefile[%s], ignored' % self.cache_path)
+                    return False
+                if not self.loadIds() or not super(MongoDict, self).loadCache():
+                    self.token = None
+                    self.ids.clear()
+                    return False
+            return True
+        if not super(MongoDict, self).loadCache():
+            return False
+        if self.incremental and self.watermark is not None:
+            self.poll()
+        return True
+
+    def loadToken(self):
+        """
+            @Brief loadToken load the saved resume token
+        """
+        if self.token_path and os.path.exists(self.token_path):
+            try:
+                with open(self.token_path, 'rb') as fh:
+                    return bson.BSON(fh.read()).decode()
+            except Exception as e:
+                LOG.warn('Ignore bad resume token [%s]: %s' % (self.token_path, e))
+        return None
+
+    def loadIds(self):
+        """
+            @Brief loadIds load the saved map of _id to key
+            @Return True if loaded
+        """
+        if not os.path.exists(self.ids_path):
+            return False
+        try:
+            with open(self.ids_path, 'rb') as fh:
+                header = readcacheheader(fh)
+                if header is None:
+                    return False
+                for block in itercacheblocks(fh, header[1]):
+                    self.ids.update(block)
+        except Exception as e:
+            LOG.warn('Ignore bad ids file [%s]: %s' % (self.ids_path, e))
+            return False
+        return True
+
+    def cache(self):
+        """
+            @Brief cache the tailed dict is cached together with the ids and resume token
+        """
+        if self.tailing:
+            self.checkpoint(True, True)
+        else:
+            super(MongoDict, self).cache()
+
+    def checkpoint(self, changed, force=False):
+        """
+            @Brief checkpoint save the resume token, and the cache if changed and due
+                The token is only saved with the cache it matches, a saved token ahead of the cache loses the changes
+                between them, so the token is not saved until the cache is rewritten when the dict has changed
+            @Param changed: whether the dict has changed since last checkpoint
+            @Param force: rewrite the cache even if not due
+        """
+        if not self.enable_cache or not self.cache_path or self.stopped.is_set():
+            return
+        self.dirty = self.dirty or changed
+        with FileLock(self.cache_path + '.lock'):
+            if not os.path.exists(self.cache_path) or (self.dirty and (force or self.isCacheDue())):
+                super(MongoDict, self).cache()
+                writecache(self.ids_path, self.ids.iteritems())
+                self.dirty = False
+            if self.token is not None and not self.dirty:
+                writeatomic(self.token_path, bson.BSON.encode(self.token))
+            if os.path.dirname(self.cache_path) == DEFAULT_CACHE_DIR:
+                for path in (self.ids_path, self.token_path):
+                    if os.path.exists(path):
+                        os.chmod(path, 0o777)
+
+    def refresh(self):
+        """
+            @Brief refresh the tailed dict is kept current by the tailer, or poll by the watermark
+        """
+        if self.tailer is not None:
+            return not self.lost
+        return self.poll()
+
+    def poll(self):
+        """
+            @Brief poll apply the documents updated since the watermark
+                The documents at the watermark are applied again since more documents may be updated at the same time
+        """
+        if not self.incremental or self.watermark is None:
+            return False
+        count, updated = 0, 0
+        with self.repository[self.backend].instance() as client:
+            collection = client[self.database][self.collection]
+            with self._lock:
+                for doc in collection.find({self.updated_field: {'$gte': self.watermark}}).sort(self.updated_field, 1):
+                    count += 1
+                    updated += self.apply(doc)
+                self.md5 = encodewatermark(self.watermark)
+        if updated:
+            LOG.info('Refreshed %d records for dict[%s], watermark [%s]' % (count, self.name, self.md5))
+            if self.tailing:
+                self.checkpoint(True)
+            elif self.enable_cache and self.isCacheDue():
+                self.cache()
+        return True
+
+    def currentToken(self, collection):
+        """
+            @Brief currentToken get the resume token of now
+            @Param collection:
+        """
+        with collection.watch(max_await_time_ms=1) as stream:
+            stream.try_next()
+            return stream.resume_token
+
+    def __tail__(self):
+        """
+            @Brief __tail__ the tailer thread, apply the change stream, or poll by the watermark if not supported
+        """
+        interval = self.config.get('tail_interval', DEFAULT_TAIL_INTERVAL)
+        checkpoint = self.config.get('tail_checkpoint', DEFAULT_TAIL_CHECKPOINT)
+        streamable = True
+        while not self.stopped.is_set() and not self.lost:
+            try:
+                if streamable:
+                    streamable = self.tail(checkpoint)
+                    if not streamable and not self.incremental:
+                        LOG.error('dict[%s] could not be tailed without change stream or updated_field' % self.name)
+                        self.markLost()
+                else:
+                    self.poll()
+                    self.stopped.wait(interval)
+            except Exception:
+                LOG.exception('Failed to tail dict[%s]' % self.name)
+                self.stopped.wait(interval)
+        LOG.info('Stop tailing dict[%s]' % self.name)
+
+    def tail(self, checkpoint):
+        """
+            @Brief tail apply the change stream until the next checkpoint
+            @Param checkpoint: the seconds to checkpoint
+            @Return False if change stream is not supported
+        """
+        changed = False
+        with self.repository[self.backend].instance() as client:
+            collection = client[self.database][self.collection]
+            try:
+                if self.token is None:
+                    # Tail from now, catch up the changes before by the watermark
+                    self.token = self.currentToken(collection)
+                    if self.incremental:
+                        self.poll()
+                    elif not self.synced:
+                        LOG.warn('dict[%s] may have lost changes without resume token' % self.name)
+                        self.markLost()
+                        return True
+                self.synced = True
+                deadline = time.time() + checkpoint
+                with collection.watch(full_document='updateLookup', resume_after=self.token,
+                                      max_await_time_ms=self.STREAM_AWAIT_MS) as stream:
+                    while not self.stopped.is_set() and time.time() < deadline:
+                        change = stream.try_next()
+                        if change is not None:
+                            with self._lock:
+                                self.applyChange(change)
+                            changed = True
+                            if self.lost:
+                                return True
+                        self.token = stream.resume_token or self.token
+            except OperationFailure as e:
+                if e.code in self.STREAM_UNSUPPORTED:
+                    LOG.warn('Change stream of dict[%s] is not supported, poll by watermark: %s' % (self.name, e))
+                    return False
+                if e.code in self.STREAM_HISTORY_LOST:
+                    LOG.warn('Resume token of dict[%s] is lost: %s' % (self.name, e))
+                    self.token, self.synced = None, False
+                    return True
+                raise
+        self.checkpoint(changed)
+        return True
+
+    def applyChange(self, change):
+        """
+            @Brief applyChange apply a change event of change stream
+            @Param change:
+        """
+        op = change['operationType']
+        if op in ('insert', 'update', 'replace'):
+            doc = change.get('fullDocument')
+            # None if deleted after the update, the delete will be applied later
+            if doc is not None:
+                self.apply(doc)
+        elif op == 'delete':
+            self.remove(change['documentKey']['_id'])
+        elif op in self.STREAM_INVALIDATED:
+            LOG.warn('Change stream of dict[%s] is invalidated by [%s], reload required' % (self.name, op))
+            self.markLost()
+
+    def markLost(self):
+        """
+            @Brief markLost the tailing has lost changes, remove the cache and resume token so that the dict is
+                reloaded from the collection instead of the same cache, and request the reload
+        """
+        if self.enable_cache and self.cache_path:
+            with FileLock(self.cache_path + '.lock'):
+                for path in (self.token_path, self.ids_path, self.cache_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        self.lost = True
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def close(self):
+        """
+            @Brief close stop tailing
+        """
+        self.stopped.set()
+        if self.tailer is not None and self.tailer.is_alive():
+            self.tailer.join()
+        super(MongoDict, self).close()
+
 
 class GridfsDict(DictObj):
 
@@ -354,6 +925,14 @@ class GridfsDict(DictObj):
         self.collection = config.get('collection', 'fs')
         self.filename = config['filename']
 
+    def sourceVersion(self):
+        """
+            @Brief sourceVersion the md5 of the last version of the gridfs file
+        """
+        with self.repository[self.backend].instance() as client:
+            fs = gridfs.GridFS(client[self.database], self.collection)
+            return fs.get_last_version(self.filename).md5
+
     def parseLine(self, line):
         """
             @Brief parseLine 解析文件的一行
@@ -377,76 +956,203 @@ class GridfsDict(DictObj):
                 (self.filename, df.upload_date, df.md5))
             self.md5 = df.md5
             count = 0
-            cache_file = None
-            if self.cache_path and self.enable_cache:
-                cache_file = open(self.cache_path, 'w')
             while True:
                 line = df.readline()
                 if not line:
                     break
                 count += 1
                 self.parseLine(line)
-                if cache_file is not None:
-                    cache_file.write(line)
-            if cache_file is not None:
-                cache_file.close()
-                if os.path.dirname(self.cache_path) == DEFAULT_CACHE_DIR:
-                    os.chmod(self.cache_path, 0o777)
             df.close()
 
             LOG.info('Loaded %d records for dict[%s]' % (count, self.name))
 
-    def loadCache(self):
-        """loadCache"""
-        if self.cache_path and os.path.exists(self.cache_path):
-            local_md5 = self.md5sum(self.cache_path)
-            with self.repository[self.backend].instance() as client:
-                fs = gridfs.GridFS(client[self.database], self.collection)
-                df = fs.get_last_version(self.filename)
-                if df.md5 == local_md5:
-                    LOG.info(
-                        'file[%s] has not changed, will use local cache dict' %
-                        self.filename)
-                    self.md5 = local_md5
-                else:
-                    LOG.info(
-                        'file[%s] has changed, local_md5:%s != remote_md5:%s' %
-                        (self.filename, local_md5, df.md5))
-                    return False
+    def isCacheFresh(self, version):
+        """
+            @Brief isCacheFresh the cache is fresh if the gridfs file has not changed
+            @Param version: the md5 of the cached file
+        """
+        remote_md5 = self.sourceVersion()
+        if version != remote_md5:
+            LOG.info(
+                'file[%s] has changed, local_md5:%s != remote_md5:%s' %
+                (self.filename, version, remote_md5))
+            return False
+        LOG.info(
+            'file[%s] has not changed, will use local cache dict' %
+            self.filename)
+        self.md5 = version
+        return True
 
-            with open(self.cache_path) as df:
-                for line in df:
-                    self.parseLine(line)
-                LOG.info(
-                    'dict[%s] loaded from cachefile[%s]' %
-                    (self.name, self.cache_path))
-            return True
-        return False
 
-    def cache(self):
-        pass
+class MmapDictMixin(object):
+
+    """MmapDictMixin
+        The dict stored in a memory mapped hash table file, see dictstore
+        NOTE: Mixed before the DictObj class, so that the memory storage is not slowed down by the overrides
+    """
+
+    def __init__(self, name, config, repository):
+        self._table = None      # The mapped hash table
+        self._writer = None     # The hash table writer when building
+        super(MmapDictMixin, self).__init__(name, config, repository)
+        self.mmap_ttl = config.get('mmap_ttl', DEFAULT_MMAP_TTL)
 
-    def md5sum(self, fname):
+    def load(self):
         """
-            @Brief md5sum 计算文件md5
-            @Param fname: 文件路径或文件流
+            @Brief load map the hash table file, build it if it doesn't exist or is stale
+                Only one process builds the file, the others wait for it and map the built one
         """
-        def read_chunks(fh):
-            fh.seek(0)
-            chunk = fh.read(8096)
-            while chunk:
-                yield chunk
-                chunk = fh.read(8096)
-            else:
-                fh.seek(0)
-        m = hashlib.md5()
-        if isinstance(fname, basestring) and os.path.exists(fname):
-            with open(fname, "rb") as fh:
-                for chunk in read_chunks(fh):
-                    m.update(chunk)
-        elif fname.__class__.__name__ in ["StringIO", "StringO"] or isinstance(fname, file):
-            for chunk in read_chunks(fname):
-                m.update(chunk)
+        self.clear()
+        path = self.cache_path + '.table'
+        version = self.sourceVersion()
+        if self.openTable(path, version):
+            return
+        with FileLock(path + '.lock'):
+            # May be built by another process when waiting for the lock
+            if self.openTable(path, version):
+                return
+            LOG.info('Building hash table for dict[%s] at [%s]' % (self.name, path))
+            writer = HashTableWriter(path, version, self.config_hash)
+            self._writer = writer
+            try:
+                if not (self.enable_cache and self.loadCache()):
+                    if len(writer.offsets):
+                        # Partially loaded from a bad cache file
+                        writer.abort()
+                        writer = self._writer = HashTableWriter(path, version, self.config_hash)
+                    with self._lock:
+                        self.fetch()
+                writer.version = self.md5 or version
+            except:
+                writer.abort()
+                raise
+            finally:
+                self._writer = None
+            writer.commit()
+            if os.path.dirname(self.cache_path) == DEFAULT_CACHE_DIR:
+                os.chmod(path, 0o777)
+        if not self.openTable(path, self.md5 or version):
+            raise ValueError('Failed to open hash table [%s]' % path)
+
+    def openTable(self, path, version):
+        """
+            @Brief openTable map the hash table file if it's fresh
+            @Return True if mapped
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            table = HashTable(path)
+        except Exception as e:
+            LOG.warn('Ignore bad hash table [%s]: %s' % (path, e))
+            return False
+        if table.config != self.config_hash:
+            fresh = False
+        elif version is not None:
+            fresh = table.version == version
         else:
-            return ""
-        return m.hexdigest()
+            fresh = time.time() - table.built_time < self.mmap_ttl and \
+                (self.reload_time is None or table.built_time >= self.reload_time)
+        if not fresh:
+            table.close()
+            return False
+        LOG.info('dict[%s] mapped from [%s], %d entries' % (self.name, path, len(table)))
+        self._table = table
+        if version is not None:
+            self.md5 = version
+        return True
+
+    def __setitem__(self, key, value):
+        if self._writer is not None:
+            self._writer.add(key, value)
+        else:
+            dict.__setitem__(self, key, value)
+
+    def update(self, items):
+        if self._writer is not None:
+            for key, value in (items.iteritems() if isinstance(items, dict) else items):
+                self._writer.add(key, value)
+        else:
+            dict.update(self, items)
+
+    def __getitem__(self, key):
+        if self._table is not None:
+            found = self._table.find(key)
+            if found is None:
+                raise KeyError(key)
+            return self._table.decode(*found)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if self._table is not None:
+            return self._table.get(key, default)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if self._table is not None:
+            return key in self._table
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def __len__(self):
+        if self._table is not None:
+            return len(self._table)
+        return dict.__len__(self)
+
+    def iteritems(self):
+        if self._table is not None:
+            return self._table.iteritems()
+        return dict.iteritems(self)
+
+    def iterkeys(self):
+        if self._table is not None:
+            return (k for k, _ in self._table.iteritems())
+        return dict.iterkeys(self)
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        if self._table is not None:
+            return (v for _, v in self._table.iteritems())
+        return dict.itervalues(self)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def clear(self):
+        if self._table is not None:
+            self._table.close()
+            self._table = None
+        dict.clear(self)
+
+
+class MmapElasticDict(MmapDictMixin, ElasticDict):
+    pass
+
+
+class MmapMongoDict(MmapDictMixin, MongoDict):
+    pass
+
+
+class MmapGridfsDict(MmapDictMixin, GridfsDict):
+    pass
+
+
+DICT_CLASSES = {
+    'elasticsearch': ElasticDict,
+    'mongodb': MongoDict,
+    'gridfs': GridfsDict,
+}
+
+MMAP_DICT_CLASSES = {
+    'elasticsearch': MmapElasticDict,
+    'mongodb': MmapMongoDict,
+    'gridfs': MmapGridfsDict,
+}
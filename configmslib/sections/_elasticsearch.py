@@ -25,6 +25,7 @@ class ElasticsearchConfigSection(ReferConfigSection):
     """
     Type = "elasticsearch"
     ReloadRequired = True
+    ReloadKeys = ( 'hosts', 'timeout' )
     DefaultTimeout = 30.0   # 30s
 
     def validate(self, value):
@@ -46,6 +47,18 @@ class ElasticsearchConfigSection(ReferConfigSection):
         # Create the client
         return Elasticsearch(hosts, timeout = float(timeout))
 
+    def warmup(self, value, connections):
+        """Get the cluster info concurrently to open the connections
+        """
+        self.runConcurrently(value.info, connections)
+
+    def isBackendError(self, error):
+        """Tell if the error is caused by elasticsearch, the client errors (4xx) are not
+        """
+        if not isinstance(error, TransportError):
+            return False
+        return not (isinstance(error.status_code, int) and error.status_code < 500)
+
     def withinError(self, error):
         """When error occurred in the with statements
         """
@@ -10,14 +10,16 @@
 """
 
 import happybase
-import time
+import socket
+
+from thriftpy2.transport import TTransportException
 
 from configmslib.section import ReferConfigSection
 
 class HBaseConfigSection(ReferConfigSection):
     """The hbase config section
     Known configs:
-        - host                  (Required)The hbase host
+        - host                  (Required)The hbase host, a list or hosts separated by , are balanced when using kerberos
         - port                  The hbase port, 9090 by default
         - timeout               The timeout in ms
         - tablePrefix           The table prefix
@@ -26,9 +28,16 @@ class HBaseConfigSection(ReferConfigSection):
         - transport             The transport mode
         - protocol              The protocol mode
         - useKerberos          Whether to use kerberos
+        - balancer              The host balancer when using kerberos, least_outstanding (default) or ewma
+        - idleTimeout           The seconds to close an idle connection when using kerberos
+        - maxLifetime           The seconds to reopen a connection when using kerberos, should be less than the ticket lifetime
+        - keepaliveInterval     The seconds to ping the idle connections when using kerberos
+        - minIdle               The number of idle connections of each host to keep open when using kerberos
     """
     Type = "hbase"
     ReloadRequired = True
+    ReloadKeys = ( 'host', 'port', 'timeout', 'tablePrefix', 'tablePrefixSeparator', 'compat', 'transport', 'protocol', 'poolSize', 'useKerberos', 'balancer',
+            'idleTimeout', 'maxLifetime', 'keepaliveInterval', 'minIdle' )
     DefaultTimeout = 10.0       # 10s
     DefaultPoolSize = 30
 
@@ -73,13 +82,22 @@ class HBaseConfigSection(ReferConfigSection):
         # Create the connection pool
         if use_kerberos:
             from happybase_krb_patch import KerberosConnectionPool, KerberosConnection
-            return KerberosConnectionPool(size=poolSize, use_kerberos=True, **params)
+            hosts = params.pop("host")
+            return KerberosConnectionPool(size=poolSize, hosts=hosts, balancer=config.get("balancer", KerberosConnectionPool.LEAST_OUTSTANDING),
+                    idle_timeout=config.get("idleTimeout"), max_lifetime=config.get("maxLifetime"),
+                    keepalive_interval=config.get("keepaliveInterval"), min_idle=config.get("minIdle", 0),
+                    use_kerberos=True, **params)
         else:
             return happybase.ConnectionPool(size = poolSize, **params)
 
     def release(self, value):
         """Release the reference
         """
+        if hasattr(value, "close"):
+            # The kerberos connection pool closes the connections of all hosts
+            succ, failed = value.close()
+            self.logger.info('[%s] Release pool: [%d] hbase connection closed successfully and [%d] failed' % (self.Type, succ, failed))
+            return
         # Close all the connections in the pool
         succ, failed = 0, 0
         while not value._queue.empty():
@@ -94,26 +112,46 @@ class HBaseConfigSection(ReferConfigSection):
         # Done
         self.logger.info('[%s] Release pool: [%d] hbase connection closed successfully and [%d] failed' % (self.Type, succ, failed))
 
+    def warmup(self, value, connections):
+        """Open the pooled connections and list tables by them
+        """
+        if hasattr(value, "warmup"):
+            # The kerberos connection pool
+            value.warmup(connections, self.get("timeout", self.DefaultTimeout))
+            return
+        opened = []
+        try:
+            for _ in range(min(connections, value._queue.maxsize)):
+                connection = value._acquire_connection(self.get("timeout", self.DefaultTimeout))
+                opened.append(connection)
+                connection.open()
+                connection.tables()
+        finally:
+            for connection in opened:
+                value._return_connection(connection)
+
     def getInstanceValue(self, value):
         """Get the value returned by instance method
         """
         with value.connection(timeout = self.get("timeout", self.DefaultTimeout)) as connection:
             yield connection
 
+    def isBackendError(self, error):
+        """Tell if the error is caused by the hbase connections
+        NOTE:
+            The thrift application exceptions (e.g. IOError or IllegalArgument of hbase) and the pool exhaustion (NoConnectionsAvailable)
+            are not, neither the breaker nor a rebuild helps them
+        """
+        if self.get("useKerberos"):
+            from happybase_krb_patch import TRANSPORT_ERRORS, NoHostsAvailable
+            return isinstance(error, TRANSPORT_ERRORS + (NoHostsAvailable, ))
+        return isinstance(error, (TTransportException, socket.error))
+
     def withinError(self, error):
         """When error occurred in the with statements
+        NOTE:
+            The tainted connection has been replaced by the pool, the pool is rebuilt in background at most once in rebuildInterval
         """
-        self._reloadedEvent.wait()
-        self._reloadedEvent.clear()
-        config = dict(self)
-        while True:
-            try:
-                self.reload(config)
-            except Exception,e:
-                self.logger.exception(e)
-                self.logger.warn('reconnect hbase failed, wait 3s...')
-                time.sleep(3)
-            else:
-                self._reloadedEvent.set()
-                self.logger.info('reload hbase succ')
-                break
+        if self.isBackendError(error):
+            self.logger.warn("[%s] HBase error [%s], request to rebuild the pool", self.Type, error)
+            self.requestRebuild()
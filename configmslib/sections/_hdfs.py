@@ -10,6 +10,7 @@ sys.setdefaultencoding('utf-8')
 
 from configmslib.section import ReferConfigSection
 import os
+import socket
 
 class HDFSConfigSection(ReferConfigSection):
     '''
@@ -23,6 +24,7 @@ class HDFSConfigSection(ReferConfigSection):
     '''
     Type = 'hdfs'
     ReloadRequired = True
+    ReloadKeys = ( 'hosts', 'user' )
     DefaultPort = 8020
     DefaultUser = 'hdfs'
 
@@ -61,6 +63,21 @@ class HDFSConfigSection(ReferConfigSection):
         fs = hdfs3.HDFileSystem(host=host, port=port, pars=pars, user=config.get('user', self.DefaultUser))
         return fs
 
+    def warmup(self, value, connections):
+        '''
+            Check the namenode
+        '''
+        value.exists('/')
+
+    def isBackendError(self, error):
+        '''
+            Tell if the error is caused by the namenode, the errors of the files (e.g. not found) are not
+        '''
+        from hdfs3.compatibility import ConnectionError, FileNotFoundError, PermissionError
+        if isinstance(error, (FileNotFoundError, PermissionError)):
+            return False
+        return isinstance(error, (ConnectionError, socket.error))
+
     def release(self, value):
         '''
             release connection
@@ -12,6 +12,7 @@
 """
 
 from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure, AutoReconnect
 
 from configmslib.section import ReferConfigSection
 
@@ -25,6 +26,7 @@ class MongodbConfigSection(ReferConfigSection):
     """
     Type = 'mongodb'
     ReloadRequired = True
+    ReloadKeys = ( 'uri', 'timeout', 'connectTimeout', 'keepAlive', 'replicaSet' )
     DefaultTimeout = 10                 # 10s
     DefaultConnectionTimeout = 10       # 10s
     DefaultKeepAlive = False            # Do not keep alive by default
@@ -59,3 +61,13 @@ class MongodbConfigSection(ReferConfigSection):
         """Release the referenced mongodb client
         """
         value.close()
+
+    def warmup(self, value, connections):
+        """Run ismaster concurrently to open the connections
+        """
+        self.runConcurrently(lambda: value.admin.command("ismaster"), connections)
+
+    def isBackendError(self, error):
+        """Tell if the error is caused by mongodb, the operation errors (e.g. duplicate key) are not
+        """
+        return isinstance(error, (ConnectionFailure, AutoReconnect))
@@ -14,6 +14,7 @@
 from threading import Lock
 
 from redis import StrictRedis
+from redis.exceptions import ConnectionError, TimeoutError
 
 from configmslib.section import ReferConfigSection
 
@@ -27,6 +28,7 @@ class RedisConfigSection(ReferConfigSection):
     """
     Type = 'redis'
     ReloadRequired = True
+    ReloadKeys = ( 'host', 'port', 'password', 'timeout' )
 
     def validate(self, value):
         """Validate the config value
@@ -45,6 +47,16 @@ class RedisConfigSection(ReferConfigSection):
         """
         value.close()
 
+    def warmup(self, value, connections):
+        """Open the connections of database 0 and ping them
+        """
+        value.warmup(0, connections)
+
+    def isBackendError(self, error):
+        """Tell if the error is caused by redis, the command errors (e.g. wrong type) are not
+        """
+        return isinstance(error, (ConnectionError, TimeoutError))
+
 class RedisDatabase(object):
     """The redis database
     """
@@ -72,6 +84,19 @@ class RedisDatabase(object):
         # Done
         return redis
 
+    def warmup(self, db, connections):
+        """Open the connections to a database and ping them
+        """
+        pool = self[db].connection_pool
+        opened = [ pool.get_connection("PING") for _ in range(connections) ]
+        try:
+            for connection in opened:
+                connection.send_command("PING")
+                connection.read_response()
+        finally:
+            for connection in opened:
+                pool.release(connection)
+
     def close(self):
         """Close this database
         """
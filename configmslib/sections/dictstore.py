@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# coding=utf8
+"""
+# Author: f
+# Created Time : 日 10/18 22:15:08 2026
+
+# File Name: dictstore.py
+# Description:
+    The on-disk storage of dict sections
+
+    Hash table file layout (all integers are little endian except the slots, which are native):
+        - header        magic, format version, marshal version, entry count, slots offset, slot count, build time, source version,
+                        config hash
+        - records       flags(1 byte), key length(4 bytes), value length(4 bytes), marshaled key, marshaled (or bson encoded) value
+        - slots         8 bytes each, 0 means empty, otherwise the high 24 bits are the key tag and the low 40 bits are the record offset
+
+    The file is built once into a temp file and renamed, then mapped read-only by every process,
+    the pages are shared through the page cache and the values are decoded on lookup
+
+    The values could not be marshaled (e.g. ObjectId or datetime) are encoded by bson, never pickled, since the
+    files in the shared cache dir could be written by the other users
+
+    Cache file layout (little endian):
+        - header        magic, format version, marshal version, entry count, write time, source version, config hash
+        - blocks        flags(1 byte), length(4 bytes), a marshaled (or bson encoded) list of at most CACHE_BLOCK_SIZE (key, value) pairs
+
+    The blocks are decoded at once and loaded by dict.update, the file is written into a temp file and renamed
+
+"""
+
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+import marshal
+import logging
+
+from array import array
+from itertools import izip
+
+import bson
+
+LOG = logging.getLogger("configms.sections.dictstore")
+
+TABLE_MAGIC = 'CMSDTBL\0'
+TABLE_FORMAT_VERSION = 3
+TABLE_HEADER = struct.Struct('<8sIIQQQd32s32s')
+TABLE_HEADER_SIZE = 128
+
+RECORD_HEADER = struct.Struct('<BII')
+RECORD_DELETED = 1
+RECORD_BSON = 2
+
+CACHE_MAGIC = 'CMSDCHE\0'
+CACHE_FORMAT_VERSION = 3
+CACHE_HEADER = struct.Struct('<8sIIQd32s32s')
+CACHE_BLOCK_HEADER = struct.Struct('<BI')
+CACHE_BLOCK_SIZE = 4096
+BLOCK_BSON = 1
+
+SLOT = struct.Struct('=Q')
+SLOT_TYPE = 'L' if array('L').itemsize == 8 else 'Q'
+TAG_SHIFT = 40
+OFFSET_MASK = (1 << TAG_SHIFT) - 1
+
+
+def normkey(key):
+    """
+        @Brief normkey normalize the key so that the equal keys (e.g. str and unicode) are encoded the same
+        @Param key:
+    """
+    if isinstance(key, str):
+        return key.decode('utf8')
+    elif isinstance(key, tuple):
+        return tuple(normkey(k) for k in key)
+    elif isinstance(key, long) and -0x8000000000000000 <= key <= 0x7fffffffffffffff:
+        return int(key)
+    elif isinstance(key, float) and key.is_integer():
+        return int(key)
+    return key
+
+
+def encodekey(key):
+    """
+        @Brief encodekey
+        @Param key:
+    """
+    return marshal.dumps(normkey(key))
+
+
+def hashkey(data):
+    """
+        @Brief hashkey get the slot hash and the tag of the encoded key
+        @Param data:
+    """
+    return zlib.crc32(data) & 0xffffffff, zlib.adler32(data) & 0xffffff
+
+
+def encodebson(value):
+    """
+        @Brief encodebson encode the value not marshalable by bson, the tuple is kept as tuple
+        @Param value:
+    """
+    return bson.BSON.encode({'v': value, 't': isinstance(value, tuple)})
+
+
+def decodebson(data):
+    """
+        @Brief decodebson
+        @Param data:
+    """
+    doc = bson.BSON(data).decode()
+    return tuple(doc['v']) if doc['t'] else doc['v']
+
+
+class FileLock(object):
+    """FileLock
+        The exclusive lock among processes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        return False
+
+
+class HashTableWriter(object):
+    """HashTableWriter
+        Write the records into a temp file and build the slots on commit
+    """
+
+    def __init__(self, path, version=None, config=None):
+        self.path = path
+        self.version = version
+        self.config = config
+        self.tmppath = '%s.%d.tmp' % (path, os.getpid())
+        self.fh = open(self.tmppath, 'w+b')
+        self.fh.write('\0' * TABLE_HEADER_SIZE)
+        self.offset = TABLE_HEADER_SIZE
+        self.offsets = array(SLOT_TYPE)
+        self.hashes = array('I')
+        self.tags = array('I')
+
+    def add(self, key, value):
+        """
+            @Brief add a record, the later one wins if the key is added again
+            @Param key:
+            @Param value:
+        """
+        data = encodekey(key)
+        flags = 0
+        try:
+            encoded = marshal.dumps(value)
+        except ValueError:
+            # Not marshalable, e.g. ObjectId or datetime
+            encoded = encodebson(value)
+            flags |= RECORD_BSON
+        h, tag = hashkey(data)
+        self.fh.write(RECORD_HEADER.pack(flags, len(data), len(encoded)))
+        self.fh.write(data)
+        self.fh.write(encoded)
+        self.offsets.append(self.offset)
+        self.hashes.append(h)
+        self.tags.append(tag)
+        self.offset += RECORD_HEADER.size + len(data) + len(encoded)
+
+    def commit(self):
+        """
+            @Brief commit build the slots and rename the temp file to path
+        """
+        try:
+            self.fh.flush()
+            count = len(self.offsets)
+            nslots = 8
+            while nslots < count * 3 / 2:
+                nslots *= 2
+            slots = array(SLOT_TYPE, [0]) * nslots
+            mask = nslots - 1
+            entries = 0
+            mm = mmap.mmap(self.fh.fileno(), self.offset) if count else None
+            try:
+                for offset, h, tag in izip(self.offsets, self.hashes, self.tags):
+                    idx = h & mask
+                    while True:
+                        slot = slots[idx]
+                        if not slot:
+                            slots[idx] = (tag << TAG_SHIFT) | offset
+                            entries += 1
+                            break
+                        if slot >> TAG_SHIFT == tag and self.samekey(mm, slot & OFFSET_MASK, offset):
+                            # Duplicated key, the later one wins
+                            old = slot & OFFSET_MASK
+                            flags, klen, vlen = RECORD_HEADER.unpack_from(mm, old)
+                            RECORD_HEADER.pack_into(mm, old, flags | RECORD_DELETED, klen, vlen)
+                            slots[idx] = (tag << TAG_SHIFT) | offset
+                            break
+                        idx = (idx + 1) & mask
+                if mm is not None:
+                    mm.flush()
+            finally:
+                if mm is not None:
+                    mm.close()
+            self.fh.seek(self.offset)
+            slots.tofile(self.fh)
+            self.fh.seek(0)
+            self.fh.write(TABLE_HEADER.pack(
+                TABLE_MAGIC, TABLE_FORMAT_VERSION, marshal.version, entries,
+                self.offset, nslots, time.time(), self.version or '', self.config or ''))
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+            os.rename(self.tmppath, self.path)
+            LOG.info('hash table[%s] built, %d entries' % (self.path, entries))
+        except:
+            self.abort()
+            raise
+
+    @staticmethod
+    def samekey(mm, offset1, offset2):
+        """
+            @Brief samekey tell if the keys of two records are the same
+        """
+        _, klen1, _ = RECORD_HEADER.unpack_from(mm, offset1)
+        _, klen2, _ = RECORD_HEADER.unpack_from(mm, offset2)
+        if klen1 != klen2:
+            return False
+        start1, start2 = offset1 + RECORD_HEADER.size, offset2 + RECORD_HEADER.size
+        return mm[start1:start1 + klen1] == mm[start2:start2 + klen2]
+
+    def abort(self):
+        """
+            @Brief abort remove the temp file
+        """
+        if not self.fh.closed:
+            self.fh.close()
+        if os.path.exists(self.tmppath):
+            os.remove(self.tmppath)
+
+
+class HashTable(object):
+    """HashTable
+        The read-only memory mapped hash table
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, format_version, marshal_version, self.count, self.slots_offset, self.nslots, self.built_time, version, config = \
+                TABLE_HEADER.unpack_from(self.mm, 0)
+            if magic != TABLE_MAGIC or format_version != TABLE_FORMAT_VERSION or marshal_version != marshal.version:
+                raise ValueError('bad hash table file [%s]' % path)
+            if self.slots_offset + self.nslots * SLOT.size != len(self.mm):
+                raise ValueError('truncated hash table file [%s]' % path)
+        except:
+            self.mm.close()
+            raise
+        self.version = version.rstrip('\0') or None
+        self.config = config.rstrip('\0') or None
+        self.mask = self.nslots - 1
+
+    def close(self):
+        self.mm.close()
+
+    def find(self, key):
+        """
+            @Brief find the value position of key
+            @Param key:
+            @Return (flags, value offset, value length) or None
+        """
+        data = encodekey(key)
+        h, tag = hashkey(data)
+        mm, mask, slots_offset = self.mm, self.mask, self.slots_offset
+        idx = h & mask
+        while True:
+            slot, = SLOT.unpack_from(mm, slots_offset + idx * SLOT.size)
+            if not slot:
+                return None
+            if slot >> TAG_SHIFT == tag:
+                offset = slot & OFFSET_MASK
+                flags, klen, vlen = RECORD_HEADER.unpack_from(mm, offset)
+                start = offset + RECORD_HEADER.size
+                if mm[start:start + klen] == data:
+                    return flags, start + klen, vlen
+            idx = (idx + 1) & mask
+
+    def decode(self, flags, offset, length):
+        data = self.mm[offset:offset + length]
+        if flags & RECORD_BSON:
+            return decodebson(data)
+        return marshal.loads(data)
+
+    def get(self, key, default=None):
+        found = self.find(key)
+        if found is None:
+            return default
+        return self.decode(*found)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def iteritems(self):
+        """
+            @Brief iteritems iterate the records in order, the overwritten ones are skipped
+        """
+        mm, offset = self.mm, TABLE_HEADER_SIZE
+        while offset < self.slots_offset:
+            flags, klen, vlen = RECORD_HEADER.unpack_from(mm, offset)
+            start = offset + RECORD_HEADER.size
+            offset = start + klen + vlen
+            if flags & RECORD_DELETED:
+                continue
+            yield marshal.loads(mm[start:start + klen]), self.decode(flags, start + klen, vlen)
+
+
+def writecache(path, items, version=None, config=None):
+    """
+        @Brief writecache write the (key, value) pairs into the cache file atomically
+        @Param path:
+        @Param items: iterable of (key, value)
+        @Param version: the source version
+        @Param config: the hash of the config the items are built by
+        @Return the number of entries written
+    """
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    count = 0
+    try:
+        with open(tmppath, 'wb') as fh:
+            fh.write('\0' * CACHE_HEADER.size)
+            block = []
+            for item in items:
+                block.append(item)
+                if len(block) >= CACHE_BLOCK_SIZE:
+                    writeblock(fh, block)
+                    count += len(block)
+                    block = []
+            if block:
+                writeblock(fh, block)
+                count += len(block)
+            fh.seek(0)
+            fh.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, marshal.version, count, time.time(), version or '', config or ''))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    return count
+
+
+def writeatomic(path, data):
+    """
+        @Brief writeatomic write the data into a temp file and rename it to path
+        @Param path:
+        @Param data: str
+    """
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def writeblock(fh, block):
+    """
+        @Brief writeblock
+        @Param fh:
+        @Param block: list of (key, value)
+    """
+    flags = 0
+    try:
+        data = marshal.dumps(block)
+    except ValueError:
+        # Not marshalable, e.g. ObjectId or datetime
+        data = bson.BSON.encode({'b': [(key, isinstance(key, tuple), value, isinstance(value, tuple)) for key, value in block]})
+        flags |= BLOCK_BSON
+    fh.write(CACHE_BLOCK_HEADER.pack(flags, len(data)))
+    fh.write(data)
+
+
+def readcacheheader(fh):
+    """
+        @Brief readcacheheader
+        @Param fh:
+        @Return (version, count, config) or None if it's not a cache file of current format
+    """
+    data = fh.read(CACHE_HEADER.size)
+    if len(data) != CACHE_HEADER.size:
+        return None
+    magic, format_version, marshal_version, count, _, version, config = CACHE_HEADER.unpack(data)
+    if magic != CACHE_MAGIC or format_version != CACHE_FORMAT_VERSION or marshal_version != marshal.version:
+        return None
+    return version.rstrip('\0') or None, count, config.rstrip('\0') or None
+
+
+def itercacheblocks(fh, count):
+    """
+        @Brief itercacheblocks iterate the decoded blocks after the header
+        @Param fh:
+        @Param count: the entry count in header
+    """
+    loaded = 0
+    while loaded < count:
+        header = fh.read(CACHE_BLOCK_HEADER.size)
+        if len(header) != CACHE_BLOCK_HEADER.size:
+            raise ValueError('truncated cache file')
+        flags, length = CACHE_BLOCK_HEADER.unpack(header)
+        data = fh.read(length)
+        if len(data) != length:
+            raise ValueError('truncated cache file')
+        if flags & BLOCK_BSON:
+            block = [(tuple(key) if keytuple else key, tuple(value) if valuetuple else value)
+                     for key, keytuple, value, valuetuple in bson.BSON(data).decode()['b']]
+        else:
+            block = marshal.loads(data)
+        loaded += len(block)
+        yield block
+
@@ -1,16 +1,17 @@
 # coding=utf8
 import six
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 import base64
-from io import BytesIO
 import contextlib
 import logging
+import random
 import socket
 import threading
+import time
 from six.moves import queue, range
 
 from thriftpy2.thrift import TClient, TException
-from thriftpy2.transport import TBufferedTransport, TFramedTransport, TSocket, TTransportBase, TTransportException, readall
+from thriftpy2.transport import TBufferedTransport, TFramedTransport, TSocket, TTransportBase, TTransportException
 from thriftpy2.protocol import TBinaryProtocol, TCompactProtocol
 
 import puresasl
@@ -25,6 +26,42 @@ from kerberos import KrbError
 
 logger = logging.getLogger(__name__)
 
+FRAME_HEADER = Struct("!i")
+
+# The errors of the connection itself, which count toward host ejection. The
+# other ``TException`` (e.g. IOError or IllegalArgument of hbase) are raised by
+# the application and the host is healthy
+TRANSPORT_ERRORS = (TTransportException, socket.error, KrbError)
+
+# The max part of max_lifetime cut from each connection, so that the
+# connections opened together are reopened in different maintenances
+LIFETIME_JITTER = 0.5
+
+
+def read_exactly(read, size):
+    '''
+    Read exactly ``size`` bytes by ``read``. The chunk is returned as is if it's
+    read at once, otherwise the chunks are assembled in a preallocated buffer
+    '''
+    chunk = read(size)
+    if len(chunk) == size:
+        return chunk
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while True:
+        if not chunk:
+            raise TTransportException(
+                TTransportException.END_OF_FILE,
+                "End of file reading from transport")
+        view[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+        if pos == size:
+            break
+        chunk = read(size - pos)
+    del view
+    return bytes(buf)
+
 
 class CustomGSSAPIMechanism(puresasl.mechanisms.GSSAPIMechanism):
     '''
@@ -46,6 +83,11 @@ class CustomGSSAPIMechanism(puresasl.mechanisms.GSSAPIMechanism):
 class TSaslClientTransport(TTransportBase):
     """
     SASL transport
+
+    The written data is kept as chunks after a slot reserved for the frame
+    header and joined once on flush, and the frames read are served by slicing
+    without copying them into another buffer. When the negotiated qop is
+    ``auth`` the data is neither wrapped nor unwrapped
     """
 
     START = 1
@@ -71,8 +113,9 @@ class TSaslClientTransport(TTransportBase):
             self._patch_pure_sasl()
         self.sasl = SASLClient(host, service, mechanism, **sasl_kwargs)
 
-        self.__wbuf = BytesIO()
-        self.__rbuf = BytesIO()
+        self._wparts = [b'']       # the first one is the header slot
+        self._rframe = b''
+        self._rpos = 0
 
     def _patch_pure_sasl(self):
         ''' we need to patch pure_sasl to support python 3 '''
@@ -115,44 +158,53 @@ class TSaslClientTransport(TTransportBase):
         self.transport.flush()
 
     def recv_sasl_msg(self):
-        header = readall(self.transport.read, 5)
+        header = read_exactly(self.transport.read, 5)
         status, length = unpack(">BI", header)
         if length > 0:
-            payload = readall(self.transport.read, length)
+            payload = read_exactly(self.transport.read, length)
         else:
             payload = ""
         return status, payload
 
+    def _is_auth_only(self):
+        """Whether the negotiated qop only authenticates, the data is not wrapped then."""
+        return getattr(self.sasl, 'qop', None) == puresasl.QOP.AUTH
+
     def write(self, data):
-        self.__wbuf.write(data)
+        self._wparts.append(data)
 
     def flush(self):
-        data = self.__wbuf.getvalue()
-        encoded = self.sasl.wrap(data)
-        if six.PY2:
-            self.transport.write(''.join([
-                    pack("!i", len(encoded)),
-                    encoded
-                ])
-            )
-        else:
-            self.transport.write(b''.join((pack("!i", len(encoded)), encoded)))
+        parts = self._wparts
+        try:
+            if self._is_auth_only():
+                # Fill the header slot and join the frame at once
+                parts[0] = FRAME_HEADER.pack(sum(map(len, parts)) - len(parts[0]))
+                self.transport.write(b''.join(parts))
+            else:
+                parts[0] = b''
+                encoded = self.sasl.wrap(b''.join(parts))
+                self.transport.write(FRAME_HEADER.pack(len(encoded)))
+                self.transport.write(encoded)
+        finally:
+            del parts[1:]
         self.transport.flush()
-        self.__wbuf = BytesIO()
 
     def read(self, sz):
-        ret = self.__rbuf.read(sz)
-        if len(ret) != 0 or sz == 0:
-            return ret
-
-        self._read_frame()
-        return self.__rbuf.read(sz)
+        pos = self._rpos
+        if pos >= len(self._rframe):
+            if sz == 0:
+                return b''
+            self._read_frame()
+            pos = 0
+        self._rpos = pos + sz
+        # Slicing the whole frame returns the frame itself
+        return self._rframe[pos:pos + sz]
 
     def _read_frame(self):
-        header = readall(self.transport.read, 4)
-        length, = unpack('!i', header)
-        encoded = readall(self.transport.read, length)
-        self.__rbuf = BytesIO(self.sasl.unwrap(encoded))
+        length, = FRAME_HEADER.unpack(read_exactly(self.transport.read, FRAME_HEADER.size))
+        encoded = read_exactly(self.transport.read, length)
+        self._rframe = encoded if self._is_auth_only() else self.sasl.unwrap(encoded)
+        self._rpos = 0
 
     def close(self):
         self.sasl.dispose()
@@ -179,6 +231,14 @@ DEFAULT_PROTOCOL = 'binary'
 
 
 class KerberosConnection(Connection):
+    # the time the transport is opened, None if not opened
+    opened_time = None
+    # the time the connection is returned to the pool
+    last_used = None
+    # the part of the pool max_lifetime used by the connection, jittered to
+    # not reopen the connections opened together at the same time
+    lifetime_ratio = 1.0
+
     def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=None,
                  autoconnect=True, table_prefix=None,
                  table_prefix_separator=b'_', compat=DEFAULT_COMPAT,
@@ -237,6 +297,22 @@ class KerberosConnection(Connection):
             self.transport = TSaslClientTransport(self.transport, self.host, self.sasl_service_name)
         protocol = self._protocol_class(self.transport, decode_response=False)
         self.client = TClient(Hbase, protocol)
+        self.opened_time = None
+
+    def open(self):
+        if self.transport.is_open():
+            return
+        super(KerberosConnection, self).open()
+        self.opened_time = time.time()
+        self.lifetime_ratio = 1 - random.random() * LIFETIME_JITTER
+
+    def retire(self):
+        """Close the connection and refresh the thrift client to open again."""
+        try:
+            self.close()
+        except Exception as e:
+            logger.warning("{} error when close connection to {}".format(str(e), self.host))
+        self._refresh_thrift_client()
 
 
 class NoHostsAvailable(RuntimeError):
@@ -245,6 +321,30 @@ class NoHostsAvailable(RuntimeError):
     """
     pass
 
+class HostState(object):
+    """
+    The load balancing and health state of a host in KerberosConnectionPool
+    """
+    def __init__(self, host):
+        self.host = host
+        self.queue = None           # created on the first use of the host
+        self.outstanding = 0        # the connections in use
+        self.latency = 0.0          # the EWMA of the seconds a connection is held
+        self.failures = 0           # the continuous failures
+        self.ejections = 0          # the continuous ejections
+        self.ejected_until = None   # the time to re-probe the ejected host
+        self.probing = False        # whether a probe request is running
+
+    def stats(self):
+        return {
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'failures': self.failures,
+            'ejected': self.ejected_until is not None,
+            'created': self.queue is not None,
+        }
+
+
 class KerberosConnectionPool(ConnectionPool):
     """
     similar to `happybase.ConnectionPool` with the following extra features
@@ -252,12 +352,48 @@ class KerberosConnectionPool(ConnectionPool):
         a support to high avaliable
     2. pool will auto connect to the next host if current is unavailable even in
         the outermost with statement
+    3. requests are balanced across the hosts by the least outstanding
+        connections or the EWMA latency, and the pool of a host is created on
+        its first use
+    4. a host is ejected after continuous failures and re-probed by a single
+        request after the ejection time, which doubles on each ejection
+    5. the connections are maintained by a background thread: the ones idle
+        for idle_timeout are closed, the ones opened for max_lifetime are
+        reopened before they're used, the idle ones are pinged every
+        keepalive_interval and min_idle connections of each host are kept open,
+        so the SASL handshake is not paid on the request path
     """
-    def __init__(self, size, hosts=None, **kwargs):
+    LEAST_OUTSTANDING = 'least_outstanding'
+    EWMA = 'ewma'
+    BALANCERS = (LEAST_OUTSTANDING, EWMA)
+
+    EWMA_DECAY = 0.3
+    MAINTAIN_INTERVAL = 30.0
+
+    def __init__(self, size, hosts=None, balancer=LEAST_OUTSTANDING,
+                 eject_failures=3, eject_time=10.0, max_eject_time=300.0,
+                 idle_timeout=None, max_lifetime=None, keepalive_interval=None,
+                 min_idle=0, **kwargs):
         '''
             hosts:
                 A list of hosts or a string of hosts seperated by ","
                 This parameter works only if host is not specified
+            balancer:
+                `least_outstanding` or `ewma`
+            eject_failures:
+                The continuous failures to eject a host
+            eject_time:
+                The seconds to re-probe an ejected host, doubled on each
+                continuous ejection until max_eject_time
+            idle_timeout:
+                The seconds to close an idle connection, the min_idle ones are kept
+            max_lifetime:
+                The seconds to reopen a connection, should be less than the
+                kerberos ticket lifetime
+            keepalive_interval:
+                The seconds to ping the idle connections
+            min_idle:
+                The number of idle connections of each host to keep open
         '''
         if not isinstance(size, int):
             raise TypeError("Pool 'size' arg must be an integer")
@@ -265,34 +401,43 @@ class KerberosConnectionPool(ConnectionPool):
         if not size > 0:
             raise ValueError("Pool 'size' arg must be greater than zero")
 
+        if balancer not in self.BALANCERS:
+            raise ValueError("'balancer' must be one of %s"
+                             % ", ".join(self.BALANCERS))
+
         logger.debug(
             "Initializing connection pool with %d connections", size)
 
+        self._size = size
+        self._balancer = balancer
+        self._eject_failures = eject_failures
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._keepalive_interval = keepalive_interval
+        self._min_idle = min(min_idle, size)
+        self._closed = False
+        self._closing = threading.Event()
+        self._maintainer = None
+        self._eject_time = eject_time
+        self._max_eject_time = max_eject_time
         self._lock = threading.Lock()
         self._host_queue_map = {}
         self._thread_connections = threading.local()
 
         connection_kwargs = kwargs
         connection_kwargs['autoconnect'] = False
+        self._connection_kwargs = connection_kwargs
 
         if kwargs.get('host'):
             self._hosts = [kwargs.get('host')]
         else:
-            if isinstance(hosts, list):
-                self._hosts = hosts
-            elif isinstance(hosts, six.text_type):
-                self._hosts = hosts.split(',')
+            if isinstance(hosts, (list, tuple)):
+                self._hosts = list(hosts)
+            elif isinstance(hosts, six.string_types):
+                self._hosts = [host.strip() for host in hosts.split(',') if host.strip()]
             else:
                 raise Exception('error hosts type')
-
-        for host in self._hosts:
-            self._host_queue_map[host] = queue.LifoQueue(maxsize=size)
-            connection_kwargs['host'] = host
-
-            for i in range(size):
-                connection = KerberosConnection(**connection_kwargs)
-                self._host_queue_map[host].put(connection)
-                # self._queue.put(connection)
+        self._host_states = [HostState(host) for host in self._hosts]
 
         # The first connection is made immediately so that trivial
         # mistakes like unresolvable host names are raised immediately.
@@ -300,48 +445,292 @@ class KerberosConnectionPool(ConnectionPool):
         with self.connection():
             pass
 
-    def _acquire_connection(self, host, timeout=None):
+        if idle_timeout or max_lifetime or keepalive_interval or min_idle:
+            self._maintainer = threading.Thread(target=self._maintain_forever)
+            self._maintainer.setDaemon(True)
+            self._maintainer.start()
+
+    @property
+    def maintain_interval(self):
+        intervals = [x for x in (self._keepalive_interval, (self._idle_timeout or 0) / 2.0, (self._max_lifetime or 0) / 4.0) if x]
+        return min(intervals) if intervals else self.MAINTAIN_INTERVAL
+
+    def _maintain_forever(self):
+        """The maintainer thread."""
+        interval = self.maintain_interval
+        logger.debug("Maintainer started, interval %.1fs", interval)
+        while True:
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception("Failed to maintain the pool connections")
+            if self._closing.wait(interval):
+                break
+
+    def maintain(self):
+        """
+        Maintain the idle connections of each healthy host:
+        1. reopen the ones will reach max_lifetime before next maintenance
+        2. close the ones idle for idle_timeout, except the min_idle ones
+        3. ping the ones idle for keepalive_interval
+        4. open the closed ones until there are min_idle open ones
+        Each connection is taken out of the queue only while it's worked on.
+        """
+        interval = self.maintain_interval
+        for state in self._host_states:
+            if self._closed:
+                return
+            if state.ejected_until is not None or (state.queue is None and not self._min_idle):
+                continue
+            q = self._get_queue(state)
+            with q.mutex:
+                # The most recently used connections come first
+                idle = list(reversed(q.queue))
+            now = time.time()
+            works, opened = [], 0
+            for connection in idle:
+                if connection.opened_time is None:
+                    if opened < self._min_idle:
+                        works.append((connection, 'open'))
+                        opened += 1
+                elif self._expired(connection, now + interval):
+                    works.append((connection, 'reopen'))
+                    opened += 1
+                elif self._idle_timeout and connection.last_used and now - connection.last_used >= self._idle_timeout and opened >= self._min_idle:
+                    works.append((connection, 'close'))
+                elif self._keepalive_interval and connection.last_used and now - connection.last_used >= self._keepalive_interval:
+                    works.append((connection, 'ping'))
+                    opened += 1
+                else:
+                    opened += 1
+            for connection, action in works:
+                if self._closed:
+                    return
+                if not self._take_idle(q, connection):
+                    # Acquired by a request in the meantime
+                    continue
+                try:
+                    if action == 'close':
+                        logger.debug("Close idle connection to %s", state.host)
+                        connection.retire()
+                    elif action == 'reopen':
+                        logger.debug("Reopen connection to %s", state.host)
+                        connection.retire()
+                        connection.open()
+                    elif action == 'open':
+                        connection.open()
+                    elif action == 'ping':
+                        connection.tables()
+                except (TException, socket.error, KrbError) as e:
+                    logger.error("{} error when maintain connection to {}".format(str(e), state.host))
+                    connection.retire()
+                    if isinstance(e, TRANSPORT_ERRORS):
+                        self._record(state, True, 0.0, False)
+                finally:
+                    self._put_idle(q, connection)
+
+    def _expired(self, connection, at):
+        """Check if the connection reaches its lifetime at the time."""
+        return bool(self._max_lifetime) and connection.opened_time is not None and \
+            at - connection.opened_time >= self._max_lifetime * connection.lifetime_ratio
+
+    def _take_idle(self, q, connection):
+        """Take the idle connection out of the queue, return False if it's not in the queue."""
+        with q.mutex:
+            try:
+                q.queue.remove(connection)
+            except ValueError:
+                return False
+            q.not_full.notify()
+            return True
+
+    def _put_idle(self, q, connection):
+        """Put the connection taken by _take_idle back, the closed ones are used last."""
+        with q.mutex:
+            if not self._closed:
+                if connection.opened_time is None:
+                    q.queue.insert(0, connection)
+                else:
+                    q.queue.append(connection)
+                q.unfinished_tasks += 1
+                q.not_empty.notify()
+                return
+        # The pool is closed while the connection is out of the queue
+        connection.close()
+
+    def close(self):
+        """Stop the maintainer and close all the connections, the in-use ones are closed when they're returned."""
+        self._closed = True
+        self._closing.set()
+        closed, failed = 0, 0
+        for state in self._host_states:
+            if state.queue is None:
+                continue
+            while True:
+                try:
+                    connection = state.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    connection.close()
+                    closed += 1
+                except Exception:
+                    logger.exception("Failed to close hbase connection to %s", state.host)
+                    failed += 1
+        return closed, failed
+
+    def _get_queue(self, state):
+        """Get the connection queue of the host, create it on the first use."""
+        if state.queue is None:
+            with self._lock:
+                if state.queue is None:
+                    logger.debug("Creating %d connections to %s", self._size, state.host)
+                    connection_kwargs = dict(self._connection_kwargs, host=state.host)
+                    q = queue.LifoQueue(maxsize=self._size)
+                    for i in range(self._size):
+                        q.put(KerberosConnection(**connection_kwargs))
+                    self._host_queue_map[state.host] = q
+                    state.queue = q
+        return state.queue
+
+    def _select_hosts(self):
+        """
+        Get the hosts to try in order:
+        1. an ejected host whose ejection time is over, as the probe
+        2. the healthy hosts ordered by the balancer
+        3. the other ejected hosts, as the last resort
+        Returns a list of (state, is_probe)
+        """
+        now = time.time()
+        with self._lock:
+            probes, healthy, ejected = [], [], []
+            for state in self._host_states:
+                if state.ejected_until is None:
+                    healthy.append(state)
+                elif not probes and not state.probing and state.ejected_until <= now:
+                    state.probing = True
+                    probes.append(state)
+                else:
+                    ejected.append(state)
+            if self._balancer == self.EWMA:
+                healthy.sort(key=lambda x: (x.outstanding + 1) * x.latency)
+            else:
+                healthy.sort(key=lambda x: (x.outstanding, x.latency))
+            ejected.sort(key=lambda x: x.ejected_until)
+        return [(state, True) for state in probes] + \
+            [(state, False) for state in healthy + ejected]
+
+    def _record(self, state, failed, duration, is_probe):
+        """Record the outcome of using a connection of the host."""
+        with self._lock:
+            if is_probe:
+                state.probing = False
+            if failed:
+                state.failures += 1
+                if state.failures >= self._eject_failures or state.ejected_until is not None:
+                    eject_time = min(self._eject_time * (2 ** min(state.ejections, 30)), self._max_eject_time)
+                    state.ejections += 1
+                    state.ejected_until = time.time() + eject_time
+                    logger.warning("Eject host %s for %.1fs after %d failures", state.host, eject_time, state.failures)
+            else:
+                if state.ejected_until is not None:
+                    logger.info("Host %s recovered", state.host)
+                state.failures, state.ejections, state.ejected_until = 0, 0, None
+                state.latency = duration if not state.latency else \
+                    self.EWMA_DECAY * duration + (1 - self.EWMA_DECAY) * state.latency
+
+    def host_stats(self):
+        """Get the load balancing and health state of the hosts."""
+        return dict((state.host, state.stats()) for state in self._host_states)
+
+    def _acquire_connection(self, state, timeout=None):
         """Acquire a connection from the pool."""
         try:
-            return self._host_queue_map[host].get(True, timeout)
+            connection = self._get_queue(state).get(True, timeout)
         except queue.Empty:
             raise NoConnectionsAvailable(
                 "No connection available from pool within specified "
                 "timeout")
+        if self._expired(connection, time.time()):
+            # Not reopened by the maintainer in time
+            connection.retire()
+        return connection
 
-    def _return_connection(self, host, connection):
+    def _return_connection(self, state, connection):
         """Return a connection to the pool."""
-        self._host_queue_map[host].put(connection)
+        connection.last_used = time.time()
+        if self._closed:
+            connection.close()
+            return
+        self._get_queue(state).put(connection)
+
+    def warmup(self, connections, timeout=None):
+        '''
+            Open ``connections`` connections of the first available host and
+            check them by listing tables
+        '''
+        for state, is_probe in self._select_hosts():
+            opened = []
+            failed = False
+            try:
+                for i in range(min(connections, self._size)):
+                    connection = self._acquire_connection(state, timeout)
+                    opened.append(connection)
+                    connection.open()
+                    connection.tables()
+                return
+            except TRANSPORT_ERRORS as e:
+                logger.error("{} error when warm up {}".format(str(e), state.host))
+                failed = True
+                for connection in opened:
+                    connection._refresh_thrift_client()
+            finally:
+                for connection in opened:
+                    self._return_connection(state, connection)
+                self._record(state, failed, 0.0, is_probe)
+        raise NoHostsAvailable("No available host to warm up")
 
     @contextlib.contextmanager
     def connection(self, timeout=None):
-        for host in self._hosts:
-            connection = getattr(self._thread_connections, 'current', None)
-            # whether in the outermost `with` context
-            is_outermost_with = False
+        connection = getattr(self._thread_connections, 'current', None)
+        if connection is not None:
+            # Nested connection requests from the same thread return the
+            # same connection instance of the outermost one.
+            try:
+                connection.open()
+                yield connection
+            except (TException, socket.error, KrbError):
+                logger.info("Replacing tainted pool connection")
+                connection._refresh_thrift_client()
+                raise
+            return
+
+        for state, is_probe in self._select_hosts():
             # whether the exception raised in ``with`` block, not include ``with`` statement
             is_in_with = False
-            # whether to retry next host
-            is_continue = False
-            if connection is None:
-                # This is the outermost connection requests for this thread.
-                # Obtain a new connection from the pool and keep a reference
-                # in a thread local so that nested connection requests from
-                # the same thread can return the same connection instance.
-                # Note: this code acquires a lock before assigning to the
-                #
-                # thread local; see
-                # http://emptysquare.net/blog/another-thing-about-pythons-
-                # threadlocals/
-                is_outermost_with = True
-                connection = self._acquire_connection(host, timeout)
-                with self._lock:
-                    self._thread_connections.current = connection
-
+            # whether the host is failed
+            failed = False
+            # Obtain a new connection from the pool and keep a reference
+            # in a thread local so that nested connection requests from
+            # the same thread can return the same connection instance.
+            # Note: this code acquires a lock before assigning to the
+            # thread local; see
+            # http://emptysquare.net/blog/another-thing-about-pythons-
+            # threadlocals/
+            try:
+                connection = self._acquire_connection(state, timeout)
+            except:
+                if is_probe:
+                    with self._lock:
+                        state.probing = False
+                raise
+            with self._lock:
+                self._thread_connections.current = connection
+                state.outstanding += 1
+            start = time.time()
             try:
                 # Open connection, because connections are opened lazily.
                 # This is a no-op for connections that are already open.
-                # import ipdb; ipdb.set_trace()
                 connection.open()
                 is_in_with = True
                 # Return value from the context manager's __enter__()
@@ -352,26 +741,30 @@ class KerberosConnectionPool(ConnectionPool):
                 # occurred in the Thrift layer, since we don't know whether
                 # the connection is still usable.
                 logger.info("Replacing tainted pool connection")
-                logger.error("{} error when connect to {}".format(str(e), host))
+                # Only the transport errors mark the host failed, the
+                # application exceptions are raised to the caller as is.
+                if isinstance(e, TRANSPORT_ERRORS):
+                    logger.error("{} error when connect to {}".format(str(e), state.host))
+                    failed = True
                 # don't try to open the new connection here because even if
                 # the new connection's `connection.open` failed, the
                 # `connection.transport.is_open` still returns `True` which
                 # results in success of the next invoking of `connection.open`
                 # in `with pool.connection()` even if the host is still unaccessible.
                 connection._refresh_thrift_client()
-                if is_outermost_with and not is_in_with:
-                    # only retry to connect to next host during the outermost `with` statement
-                    is_continue = True
-                else:
+                if is_in_with or not failed:
                     raise
             finally:
                 # Remove thread local reference after the outermost 'with'
                 # block ends. Afterwards the thread no longer owns the
                 # connection.
-                if is_outermost_with:
-                    del self._thread_connections.current
-                    self._return_connection(host, connection)
-            if not is_continue:
+                del self._thread_connections.current
+                with self._lock:
+                    state.outstanding -= 1
+                self._return_connection(state, connection)
+                self._record(state, failed, time.time() - start, is_probe)
+            # only retry to connect to next host during the outermost `with` statement
+            if not failed:
                 break
         else:
             raise NoHostsAvailable(
@@ -14,3 +14,24 @@ try:
 except ImportError:
     import json
 
+def diffPaths(old, new, prefix = ""):
+    """Get the changed paths between two values
+    Parameters:
+        old                         The old value
+        new                         The new value
+        prefix                      The path prefix
+    Returns:
+        A set of the dotted paths of changed values, e.g. set([ "a.b", "c" ])
+    """
+    paths = set()
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in set(old.iterkeys()) | set(new.iterkeys()):
+            path = "%s.%s" % (prefix, key) if prefix else key
+            if not key in old or not key in new:
+                paths.add(path)
+            else:
+                paths.update(diffPaths(old[key], new[key], path))
+    elif old != new:
+        paths.add(prefix)
+    # Done
+    return paths
@@ -0,0 +1,149 @@
+# encoding=utf8
+
+""" The etcd watcher
+    Author: lipixun
+    Created Time : 日 10/18 10:12:31 2026
+
+    File Name: watcher.py
+    Description:
+
+        A single watcher runs one recursive watch on the environ directory:
+
+            <environ.repository>/<environ.name>/
+
+        and dispatches every changed key to the config sections registered on it
+
+"""
+
+import time
+import logging
+
+from threading import Thread, Lock
+
+from etcd import EtcdKeyNotFound, EtcdWatchTimedOut, EtcdEventIndexCleared
+
+from util import json
+
+class EtcdWatcher(object):
+    """The etcd watcher which multiplexes the updates of one environ directory to config sections
+    """
+    logger = logging.getLogger("configmslib.watcher")
+
+    def __init__(self, repository, environ, index = None):
+        """Create a new EtcdWatcher
+        Parameters:
+            repository                      The config repository
+            environ                         The environ config
+            index                           The etcd index the watch starts after, the whole directory will be read first if not specified
+        """
+        self._repository = repository
+        self._path = environ.getEtcdPath("")
+        self._prefix = "/%s/" % self._path.strip("/")
+        self._lock = Lock()
+        self._sections = {}             # The registered sections, key --> list of sections
+        self._index = index             # The last seen etcd index
+        self._thread = None
+
+    @property
+    def path(self):
+        """Get the watched etcd path
+        """
+        return self._path
+
+    def register(self, section):
+        """Register a config section, start the watch thread if not started
+        NOTE:
+            The changes dispatched before the section is registered are dropped, so the section reads its config
+            again if the watcher has passed the etcd index when the section read it
+        """
+        with self._lock:
+            self._sections.setdefault(section.key, []).append(section)
+            if not self._thread:
+                thread = Thread(target = self.__watch__)
+                thread.setDaemon(True)
+                thread.start()
+                self._thread = thread
+            index = self._index
+        if index is None or section.etcdIndex is None or index > section.etcdIndex:
+            self.logger.debug("[%s] Watcher index [%s] passed section [%s] at index [%s], read it again", section.Type, index, section.key, section.etcdIndex)
+            try:
+                section.resync()
+            except:
+                self.logger.exception("[%s] Failed to read section [%s] again", section.Type, section.key)
+
+    def getSectionKey(self, etcdKey):
+        """Get the section key of the etcd key
+        Returns:
+            The section key, None if the etcd key is not in the watched directory
+        """
+        if not etcdKey.startswith("/"):
+            etcdKey = "/" + etcdKey
+        if etcdKey.startswith(self._prefix):
+            return etcdKey[len(self._prefix): ]
+
+    def dispatch(self, etcdKey, value, index):
+        """Dispatch the value of the etcd key to the registered sections
+        Parameters:
+            etcdKey                         The etcd key
+            value                           The raw value
+            index                           The etcd modified index of the value
+        """
+        key = self.getSectionKey(etcdKey)
+        if not key:
+            return
+        sections = self._sections.get(key)
+        if not sections or value is None:
+            return
+        try:
+            value = json.loads(value)
+        except:
+            self.logger.exception("Failed to decode config value of key [%s]", etcdKey)
+            return
+        for section in list(sections):
+            try:
+                section.updateByEtcd(value, index)
+            except:
+                self.logger.exception("[%s] Failed to update section [%s]", section.Type, key)
+
+    def __watch__(self):
+        """Watch the environ directory
+        """
+        self.logger.debug("Watch thread started at path [%s]", self._path)
+        while True:
+            # Get etcd client
+            client = self._repository.etcd
+            if client is None:
+                self.logger.error("Failed to watch config, no etcd client found, will retry in 30s")
+                time.sleep(30)
+                continue
+            try:
+                if self._index is None:
+                    # Read the whole directory
+                    result = client.read(self._path, recursive = True)
+                    # Set the index before dispatching, the sections registered meanwhile will read again
+                    self._index = result.etcd_index
+                    for node in result.leaves:
+                        if not node.dir:
+                            self.dispatch(node.key, node.value, node.modifiedIndex)
+                else:
+                    # Wait for the next change
+                    result = client.read(self._path, recursive = True, wait = True, waitIndex = self._index + 1)
+                    self._index = result.modifiedIndex
+                    if not result.dir:
+                        self.dispatch(result.key, result.value, result.modifiedIndex)
+            except EtcdWatchTimedOut:
+                # Nothing changed, watch again
+                pass
+            except EtcdEventIndexCleared:
+                # The history has been cleared, read the whole directory again
+                self.logger.info("Watch index [%s] cleared at path [%s], will read again", self._index, self._path)
+                self._index = None
+            except EtcdKeyNotFound as error:
+                # The directory is not created, watch the creation from the current etcd index
+                self._index = (error.payload or {}).get("index")
+                if self._index is None:
+                    time.sleep(10)
+            except:
+                # Error, wait 30s and continue watch
+                self.logger.exception("Failed to watch etcd at path [%s], will retry in 30s", self._path)
+                time.sleep(30)
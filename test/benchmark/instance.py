@@ -0,0 +1,142 @@
+# encoding=utf8
+
+""" The micro benchmark of ReferConfigSection.instance
+    Author: lipixun
+    Created Time : 日 10/18 18:20:13 2026
+
+    File Name: instance.py
+    Description:
+
+        Compare the throughput of entering instance() against the number of threads, between:
+
+            - legacy        The previous implementation: a @contextmanager generator and a RLock protected counter
+            - handle        The reusable InstanceHandle with the lock-free counter
+
+        Usage: python test/benchmark/instance.py [--operations 200000] [--threads 1,2,4,8,16,32,64]
+
+"""
+
+import sys
+import time
+
+from os.path import dirname, abspath, join
+from threading import Thread, RLock, Event
+from contextlib import contextmanager
+from argparse import ArgumentParser
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", ".."))
+
+from configmslib.repository import ConfigRepository
+from configmslib.section import ReferConfigSection
+
+class BenchmarkConfigSection(ReferConfigSection):
+    """The section references a plain object
+    """
+    Type = "benchmark"
+    ReloadRequired = True
+
+    def reference(self, config):
+        """Get the referenced value
+        """
+        return object()
+
+    @contextmanager
+    def legacyInstance(self):
+        """The legacy instance implementation
+        """
+        value = None
+        try:
+            value = self._legacyValue
+            value.increase()
+            yield self.getInstanceValue(value.value).next()
+        except Exception as error:
+            self.withinError(error)
+            raise
+        finally:
+            if not value is None:
+                value.decrease()
+            if self._legacyValue != value and value.notReferenced:
+                self.release(value.value)
+
+class LegacyReferencedValue(object):
+    """The legacy referenced value
+    """
+    def __init__(self, value):
+        """Create a new LegacyReferencedValue
+        """
+        self._lock = RLock()
+        self._refcount = 0
+        self._value = value
+
+    @property
+    def notReferenced(self):
+        """Tell if current value is not referenced
+        """
+        return self._refcount == 0
+
+    @property
+    def value(self):
+        """The referenced value
+        """
+        return self._value
+
+    def increase(self):
+        """Increase the reference counter
+        """
+        with self._lock:
+            self._refcount += 1
+
+    def decrease(self):
+        """Decrease the reference counter
+        """
+        with self._lock:
+            self._refcount -= 1
+
+def run(enter, threads, operations):
+    """Run enter by threads
+    Parameters:
+        enter                       The function returns the context manager to enter
+        threads                     The number of threads
+        operations                  The number of operations of each thread
+    Returns:
+        The operations per second
+    NOTE:
+        Each thread runs a fixed number of operations, since a timer thread could hardly get the GIL under contention
+    """
+    startEvent = Event()
+    def work():
+        """The benchmark thread
+        """
+        startEvent.wait()
+        for _ in xrange(operations):
+            with enter():
+                pass
+    workers = [ Thread(target = work) for _ in range(threads) ]
+    for worker in workers:
+        worker.start()
+    start = time.time()
+    startEvent.set()
+    for worker in workers:
+        worker.join()
+    return threads * operations / (time.time() - start)
+
+def main():
+    """The main entry
+    """
+    parser = ArgumentParser(description = "ReferConfigSection.instance benchmark")
+    parser.add_argument("--operations", dest = "operations", type = int, default = 200000, help = "The total operations of each case")
+    parser.add_argument("--threads", dest = "threads", default = "1,2,4,8,16,32,64", help = "The thread counts, separated by ,")
+    args = parser.parse_args()
+    # Create the section
+    repository = ConfigRepository(enableEtcd = False)
+    section = BenchmarkConfigSection("benchmark", {}, repository, wait = True)
+    section._legacyValue = LegacyReferencedValue(object())
+    print "%8s %16s %16s %8s" % ("threads", "legacy ops/s", "handle ops/s", "speedup")
+    for threads in map(int, args.threads.split(",")):
+        legacy = run(section.legacyInstance, threads, args.operations / threads)
+        handle = run(section.instance, threads, args.operations / threads)
+        print "%8d %16.0f %16.0f %7.2fx" % (threads, legacy, handle, handle / legacy)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
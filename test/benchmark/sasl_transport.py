@@ -0,0 +1,225 @@
+# encoding=utf8
+
+""" The benchmark of TSaslClientTransport framing
+    Author: lipixun
+    Created Time : 日 10/18 21:47:36 2026
+
+    File Name: sasl_transport.py
+    Description:
+
+        Compare the throughput (MB/s) of reading and writing SASL frames through a local fake thrift peer, between:
+
+            - legacy        The previous implementation: BytesIO buffers, ''.join header and readall
+            - current       The chunks joined once with the header on flush and the frames served by slicing
+
+        The SASL client is faked by an identity wrap / unwrap, so only the framing is measured
+
+        Usage: python test/benchmark/sasl_transport.py [--megabytes 256] [--frame-size 65536] [--read-size 4096] [--write-size 1024] [--qop auth]
+
+"""
+
+import sys
+import time
+import socket
+
+from io import BytesIO
+from struct import pack, unpack
+from os.path import dirname, abspath, join
+from threading import Thread
+from argparse import ArgumentParser
+
+sys.path.insert(0, join(dirname(abspath(__file__)), "..", ".."))
+
+from thriftpy2.transport import TBufferedTransport, TSocket
+
+from configmslib.sections import happybase_krb_patch
+from configmslib.sections.happybase_krb_patch import TSaslClientTransport
+
+class FakeSaslClient(object):
+    """The SASL client with identity wrap and unwrap
+    """
+    QOP = "auth"
+
+    def __init__(self, host, service, mechanism, **kwargs):
+        """Create a new FakeSaslClient
+        """
+        self.mechanism = mechanism
+        self.qop = self.QOP
+        self.complete = True
+
+    def wrap(self, data):
+        """Wrap the outgoing data
+        """
+        return data
+
+    def unwrap(self, data):
+        """Unwrap the incoming data
+        """
+        return data
+
+    def dispose(self):
+        """Dispose the client
+        """
+        pass
+
+def legacyReadall(read, size):
+    """The legacy readall
+    """
+    buf, have = b'', 0
+    while have < size:
+        chunk = read(size - have)
+        if not chunk:
+            raise EOFError
+        have += len(chunk)
+        buf += chunk
+    return buf
+
+class LegacySaslClientTransport(TSaslClientTransport):
+    """The legacy SASL transport
+    """
+    def __init__(self, *args, **kwargs):
+        """Create a new LegacySaslClientTransport
+        """
+        super(LegacySaslClientTransport, self).__init__(*args, **kwargs)
+        self.__wbuf = BytesIO()
+        self.__rbuf = BytesIO()
+
+    def write(self, data):
+        """Write data
+        """
+        self.__wbuf.write(data)
+
+    def flush(self):
+        """Flush the written data as a frame
+        """
+        data = self.__wbuf.getvalue()
+        encoded = self.sasl.wrap(data)
+        self.transport.write(''.join([ pack("!i", len(encoded)), encoded ]))
+        self.transport.flush()
+        self.__wbuf = BytesIO()
+
+    def read(self, sz):
+        """Read at most sz bytes
+        """
+        ret = self.__rbuf.read(sz)
+        if len(ret) != 0 or sz == 0:
+            return ret
+        self._read_frame()
+        return self.__rbuf.read(sz)
+
+    def _read_frame(self):
+        """Read a frame
+        """
+        header = legacyReadall(self.transport.read, 4)
+        length, = unpack('!i', header)
+        encoded = legacyReadall(self.transport.read, length)
+        self.__rbuf = BytesIO(self.sasl.unwrap(encoded))
+
+class FakePeer(object):
+    """The local fake thrift peer, it sends frames or discards the received data
+    """
+    def __init__(self, mode, total, frameSize):
+        """Create a new FakePeer
+        Parameters:
+            mode                            send or discard
+            total                           The bytes to send
+            frameSize                       The payload size of each sent frame
+        """
+        self._mode = mode
+        self._total = total
+        self._frameSize = frameSize
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        thread = Thread(target = self.__serve__)
+        thread.setDaemon(True)
+        thread.start()
+
+    def __serve__(self):
+        """Serve one client
+        """
+        conn, _ = self._server.accept()
+        try:
+            if self._mode == "send":
+                frame = pack("!i", self._frameSize) + b'x' * self._frameSize
+                for _ in xrange(self._total / self._frameSize):
+                    conn.sendall(frame)
+            else:
+                while conn.recv(1 << 20):
+                    pass
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+            self._server.close()
+
+def connect(cls, port):
+    """Connect to the fake peer by the transport class
+    """
+    sock = TSocket("127.0.0.1", port)
+    sock.open()
+    return cls(TBufferedTransport(sock), "127.0.0.1", "hbase")
+
+def benchmarkRead(cls, total, frameSize, readSize):
+    """Read the frames like the binary protocol: a 4 bytes length and then the value
+    Returns:
+        MB/s
+    """
+    peer = FakePeer("send", total, frameSize)
+    transport = connect(cls, peer.port)
+    received, start = 0, time.time()
+    frames = total / frameSize
+    while received < frames * frameSize:
+        received += len(transport.read(4))
+        received += len(transport.read(readSize - 4))
+    elapsed = time.time() - start
+    transport.close()
+    return received / elapsed / (1 << 20)
+
+def benchmarkWrite(cls, total, frameSize, writeSize):
+    """Write the frames by small writes like the binary protocol
+    Returns:
+        MB/s
+    """
+    peer = FakePeer("discard", total, frameSize)
+    transport = connect(cls, peer.port)
+    chunk = b'x' * writeSize
+    sent, start = 0, time.time()
+    while sent < total:
+        written = 0
+        while written < frameSize:
+            transport.write(chunk)
+            written += writeSize
+        transport.flush()
+        sent += written
+    elapsed = time.time() - start
+    transport.close()
+    return sent / elapsed / (1 << 20)
+
+def main():
+    """The main entry
+    """
+    parser = ArgumentParser(description = "TSaslClientTransport benchmark")
+    parser.add_argument("--megabytes", dest = "megabytes", type = int, default = 256, help = "The megabytes to transfer of each case")
+    parser.add_argument("--frame-size", dest = "frameSize", type = int, default = 65536, help = "The payload size of a frame")
+    parser.add_argument("--read-size", dest = "readSize", type = int, default = 4096, help = "The bytes of a value read")
+    parser.add_argument("--write-size", dest = "writeSize", type = int, default = 1024, help = "The bytes of a write")
+    parser.add_argument("--qop", dest = "qop", default = "auth", help = "The negotiated qop, data is passed to wrap and unwrap if not auth")
+    args = parser.parse_args()
+    # Fake the SASL client
+    FakeSaslClient.QOP = args.qop
+    happybase_krb_patch.SASLClient = FakeSaslClient
+    total = args.megabytes << 20
+    print "%8s %16s %16s %8s" % ("case", "legacy MB/s", "current MB/s", "speedup")
+    legacy = benchmarkRead(LegacySaslClientTransport, total, args.frameSize, args.readSize)
+    current = benchmarkRead(TSaslClientTransport, total, args.frameSize, args.readSize)
+    print "%8s %16.1f %16.1f %7.2fx" % ("read", legacy, current, current / legacy)
+    legacy = benchmarkWrite(LegacySaslClientTransport, total, args.frameSize, args.writeSize)
+    current = benchmarkWrite(TSaslClientTransport, total, args.frameSize, args.writeSize)
+    print "%8s %16.1f %16.1f %7.2fx" % ("write", legacy, current, current / legacy)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
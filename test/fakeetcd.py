@@ -0,0 +1,125 @@
+# encoding=utf8
+
+""" The in-memory etcd client used by tests
+    Author: lipixun
+    Created Time : 日 10/18 23:12:40 2026
+
+    File Name: fakeetcd.py
+    Description:
+
+        FakeEtcdClient implements the subset of etcd.Client.read used by configmslib, with the etcd v2 semantics of:
+
+            - The etcd index increases by each write, a watch returns the first event after waitIndex
+            - Only the last HistorySize events are kept, watching an older index raises EtcdEventIndexCleared
+
+"""
+
+import time
+
+from threading import Condition
+
+from etcd import EtcdKeyNotFound, EtcdWatchTimedOut, EtcdEventIndexCleared
+
+from configmslib.spec import ConfigEtcd
+
+class FakeResult(object):
+    """The etcd result
+    """
+    def __init__(self, key, value, modifiedIndex, etcdIndex, leaves = None):
+        """Create a new FakeResult
+        """
+        self.key = key
+        self.value = value
+        self.modifiedIndex = modifiedIndex
+        self.etcd_index = etcdIndex
+        self.dir = not leaves is None
+        self.leaves = leaves or []
+
+class FakeEtcdConfig(object):
+    """The etcd global config of the fake client
+    """
+    def __init__(self, client):
+        """Create a new FakeEtcdConfig
+        """
+        self.client = client
+
+class FakeEtcdClient(object):
+    """The in-memory etcd client
+    """
+    HistorySize = 1000
+    WatchTimeout = 0.05
+
+    def __init__(self, index = 0):
+        """Create a new FakeEtcdClient
+        Parameters:
+            index                           The initial etcd index
+        """
+        self.index = index
+        self.nodes = {}             # key --> FakeResult
+        self.events = []            # The events, list of FakeResult
+        self.reads = 0
+        self.watches = 0
+        self._cond = Condition()
+
+    @classmethod
+    def normalize(cls, key):
+        """Normalize the key
+        """
+        return "/" + key.strip("/")
+
+    def install(self, repository):
+        """Use this client in the repository
+        """
+        repository.globals[ConfigEtcd] = FakeEtcdConfig(self)
+        return self
+
+    def write(self, key, value, modifiedIndex = None):
+        """Write a key
+        Parameters:
+            modifiedIndex                   Set the modified index of the key without an event, used to build an old key
+        """
+        key = self.normalize(key)
+        with self._cond:
+            if modifiedIndex is None:
+                self.index += 1
+                modifiedIndex = self.index
+                self.events.append(FakeResult(key, value, modifiedIndex, modifiedIndex))
+            self.nodes[key] = FakeResult(key, value, modifiedIndex, self.index)
+            self._cond.notifyAll()
+
+    def advance(self, count):
+        """Make count writes to the other keys
+        """
+        for i in range(count):
+            self.write("/other/%d" % (i % 10), "{}")
+
+    def read(self, key, recursive = False, wait = False, waitIndex = None, timeout = None):
+        """Read or watch a key
+        """
+        key = self.normalize(key)
+        match = (lambda x: x == key or x.startswith(key + "/")) if recursive else (lambda x: x == key)
+        with self._cond:
+            if not wait:
+                self.reads += 1
+                if recursive:
+                    leaves = [ node for k, node in self.nodes.iteritems() if match(k) ]
+                    if not leaves and not key in self.nodes:
+                        raise EtcdKeyNotFound("Key not found", { "index": self.index })
+                    return FakeResult(key, None, self.index, self.index, leaves)
+                node = self.nodes.get(key)
+                if node is None:
+                    raise EtcdKeyNotFound("Key not found", { "index": self.index })
+                return FakeResult(node.key, node.value, node.modifiedIndex, self.index)
+            # Watch
+            self.watches += 1
+            if waitIndex <= self.index - self.HistorySize:
+                raise EtcdEventIndexCleared("The event in requested index is outdated and cleared")
+            deadline = time.time() + self.WatchTimeout
+            while True:
+                for event in self.events:
+                    if event.modifiedIndex >= waitIndex and match(event.key):
+                        return event
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise EtcdWatchTimedOut("Watch timed out")
+                self._cond.wait(remaining)
@@ -0,0 +1,127 @@
+# encoding=utf8
+
+""" The tests of the shared client registry
+    Author: lipixun
+    Created Time : 日 10/18 23:59:52 2026
+
+    File Name: test_clients.py
+    Description:
+
+"""
+
+import sys
+
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_, assert_raises
+
+from configmslib.clients import ClientRegistry
+from configmslib.repository import ConfigRepository
+from configmslib.section import ReferConfigSection
+
+from test_etcd import waitFor
+from test_section import ObjectConfigSection
+
+class ClientSection(object):
+    """The section creates the clients
+    """
+    Type = "client"
+    ReloadKeys = None
+    BehaviorKeys = ReferConfigSection.BehaviorKeys
+
+    def __init__(self, error = None):
+        """Create a new ClientSection
+        Parameters:
+            error                           The error raised by reference
+        """
+        self.error = error
+        self.created = []
+        self.released = []
+
+    def reference(self, config):
+        """Create a client
+        """
+        if self.error:
+            raise self.error
+        client = { "host": config.get("host") }
+        self.created.append(client)
+        return client
+
+    def release(self, value):
+        """Release a client
+        """
+        self.released.append(value)
+
+def testShareAndRelease():
+    """The client is shared by the same config, and released by the last user
+    """
+    registry, section = ClientRegistry(), ClientSection()
+    value, created = registry.reference(section, { "host": "a" })
+    ok_(created)
+    other, created = registry.reference(section, { "host": "a" })
+    ok_(other is value and not created)
+    eq_(registry.getShares(value), 2)
+    ok_(not registry.release(section, value))
+    eq_(section.released, [])
+    eq_(registry.getShares(value), 1)
+    ok_(registry.release(section, value))
+    ok_(section.released[0] is value)
+    # Created again
+    another, created = registry.reference(section, { "host": "a" })
+    ok_(created and not another is value)
+    eq_(len(section.created), 2)
+
+def testBehaviorKeys():
+    """The configs only differ in behavior keys share the client, the others don't
+    """
+    registry, section = ClientRegistry(), ClientSection()
+    value, _ = registry.reference(section, { "host": "a", "settle": 1 })
+    ok_(registry.reference(section, { "host": "a", "settle": 2 })[0] is value)
+    ok_(not registry.reference(section, { "host": "b", "settle": 1 })[0] is value)
+    eq_(registry.getShares(value), 2)
+
+def testReferenceFailed():
+    """The failed reference is not counted
+    """
+    registry, section = ClientRegistry(), ClientSection(ValueError("Failed"))
+    assert_raises(ValueError, registry.reference, section, { "host": "a" })
+    eq_(registry._clients, {})
+    section.error = None
+    value, created = registry.reference(section, { "host": "a" })
+    ok_(created)
+    eq_(registry.getShares(value), 1)
+
+def testNotShareable():
+    """The config could not be encoded is not shared
+    """
+    registry, section = ClientRegistry(), ClientSection()
+    config = { "host": "a", "factory": object() }
+    value, created = registry.reference(section, config)
+    other, created = registry.reference(section, config)
+    ok_(created and not other is value)
+    eq_(registry.getShares(value), 1)
+    ok_(registry.release(section, value))
+
+def testRenew():
+    """The broken client is renewed once, and the other sections using it switch to the new one
+    """
+    repository = ConfigRepository(enableEtcd = False)
+    config = { "id": 1, "settle": 0, "rebuildInterval": 0 }
+    first = ObjectConfigSection("first", config, repository, wait = True)
+    second = ObjectConfigSection("second", config, repository, wait = True)
+    broken = first._value.value
+    ok_(second._value.value is broken)
+    first.requestRebuild()
+    ok_(waitFor(lambda: not first._value.value is broken and not second._value.value is broken))
+    ok_(first._value.value is second._value.value)
+    eq_(first.created + second.created, 2)
+    eq_(repository.clients.getShares(first._value.value), 2)
+    # The broken one is released by both sections
+    ok_(waitFor(lambda: len(first.released + second.released) == 1))
+    # Renewed by the other section, not created again
+    value, created = repository.clients.renew(second, config, broken)
+    ok_(value is first._value.value and not created)
+    repository.clients.release(second, value)
+    eq_(first.created + second.created, 2)
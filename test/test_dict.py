@@ -0,0 +1,482 @@
+# encoding=utf8
+
+""" The tests of the mongodb dicts
+    Author: lipixun
+    Created Time : 日 10/18 23:58:12 2026
+
+    File Name: test_dict.py
+    Description:
+
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+
+from os.path import dirname, abspath, join, exists
+from contextlib import contextmanager
+from threading import Event, Lock
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_
+from pymongo.errors import OperationFailure
+
+from configmslib.repository import ConfigRepository
+from configmslib.sections._dict import DictConfigSection, MongoDict, MmapMongoDict
+
+from test_etcd import waitFor
+
+class FakeStream(object):
+    """The change stream of FakeCollection
+    """
+    def __init__(self, collection, position):
+        """Create a new FakeStream
+        """
+        self.collection = collection
+        self.position = position
+        self.resume_token = { "_data": position }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        """Get the next change, None if no change in a while
+        """
+        with self.collection.lock:
+            if self.position < len(self.collection.events):
+                change = self.collection.events[self.position]
+                self.position += 1
+                self.resume_token = { "_data": self.position }
+                return change
+        time.sleep(0.01)
+
+class FakeCollection(object):
+    """The collection with a change stream
+    """
+    def __init__(self):
+        """Create a new FakeCollection
+        """
+        self.lock = Lock()
+        self.docs = {}
+        self.events = []
+        self.finds = 0
+        self.historyStart = 0       # The events before are removed from oplog
+
+    def find(self, query = None, projection = None):
+        """Find all the documents
+        """
+        self.finds += 1
+        with self.lock:
+            return list(self.docs.values())
+
+    def watch(self, full_document = None, resume_after = None, max_await_time_ms = None):
+        """Watch the change stream
+        """
+        if resume_after is None:
+            return FakeStream(self, len(self.events))
+        if resume_after["_data"] < self.historyStart:
+            raise OperationFailure("resume of change stream was not possible", 286)
+        return FakeStream(self, resume_after["_data"])
+
+    def put(self, _id, value):
+        """Insert or update a document
+        """
+        with self.lock:
+            doc = { "_id": _id, "key": "k%d" % _id, "value": value }
+            self.events.append({ "operationType": "update" if _id in self.docs else "insert", "fullDocument": doc, "documentKey": { "_id": _id } })
+            self.docs[_id] = doc
+
+    def delete(self, _id):
+        """Delete a document
+        """
+        with self.lock:
+            del self.docs[_id]
+            self.events.append({ "operationType": "delete", "documentKey": { "_id": _id } })
+
+    def drop(self):
+        """Drop the collection
+        """
+        with self.lock:
+            self.docs.clear()
+            self.events.append({ "operationType": "drop" })
+            self.events.append({ "operationType": "invalidate" })
+
+class FakeCursor(list):
+    """The cursor supports sort and limit
+    """
+    def sort(self, field, direction = 1):
+        """Sort the documents by field
+        """
+        return FakeCursor(sorted(self, key = lambda doc: doc.get(field), reverse = direction < 0))
+
+    def limit(self, count):
+        """Limit the number of documents
+        """
+        return FakeCursor(self[: count])
+
+class UpdatedCollection(FakeCollection):
+    """The collection with the updated field, finds by the $gte and $exists queries
+    """
+    def __init__(self):
+        """Create a new UpdatedCollection
+        """
+        super(UpdatedCollection, self).__init__()
+        self.clock = 0
+        self.found = []             # The documents returned by the last find
+
+    def find(self, query = None, projection = None):
+        """Find the documents matched by query
+        """
+        self.finds += 1
+        docs = []
+        with self.lock:
+            for doc in self.docs.values():
+                matched = True
+                for field, condition in (query or {}).items():
+                    if "$gte" in condition:
+                        matched = matched and field in doc and doc[field] >= condition["$gte"]
+                    if "$exists" in condition:
+                        matched = matched and (field in doc) == condition["$exists"]
+                if matched:
+                    docs.append(doc)
+        self.found = docs
+        return FakeCursor(docs)
+
+    def put(self, _id, value, deleted = False):
+        """Insert or update a document, and advance the updated field
+        """
+        with self.lock:
+            self.clock += 1
+            self.docs[_id] = { "_id": _id, "key": "k%d" % _id, "value": value, "updated": self.clock, "deleted": deleted }
+
+class FakeBackend(object):
+    """The mongodb section
+    """
+    def __init__(self, collection):
+        """Create a new FakeBackend
+        """
+        self.collection = collection
+
+    def ready(self, timeout = None):
+        return True
+
+    @contextmanager
+    def instance(self):
+        yield { "db": { "coll": self.collection } }
+
+class TestTail(object):
+    """Test tailing the change stream
+    """
+    def setup(self):
+        """Create the collection and the cache dir
+        """
+        self.collection = FakeCollection()
+        for i in range(3):
+            self.collection.put(i, i)
+        self.repository = { "mongo": FakeBackend(self.collection) }
+        self.path = tempfile.mkdtemp()
+        self.dicts = []
+
+    def teardown(self):
+        """Stop the dicts and remove the cache dir
+        """
+        for d in self.dicts:
+            d.close()
+        shutil.rmtree(self.path, True)
+
+    def load(self):
+        """Load a new dict
+        """
+        d = MongoDict("tail", {
+            "dbtype": "mongodb",
+            "backend": "mongo",
+            "database": "db",
+            "collection": "coll",
+            "key_field": [ "key" ],
+            "value_field": "value",
+            "tail": True,
+            "tail_checkpoint": 0.1,
+            "enable_cache": True,
+            "cache_path": self.path,
+            }, self.repository)
+        d.load()
+        self.dicts.append(d)
+        return d
+
+    def testResume(self):
+        """The dict is loaded from the cache and resumes the changes after
+        """
+        d = self.load()
+        eq_(self.collection.finds, 1)
+        self.collection.put(1, 10)
+        self.collection.delete(2)
+        ok_(waitFor(lambda: d.get("k1") == 10 and not "k2" in d))
+        d.close()
+        self.collection.put(3, 3)
+        self.collection.delete(0)
+        d = self.load()
+        eq_(self.collection.finds, 1)
+        ok_(waitFor(lambda: sorted(d.items()) == [ ("k1", 10), ("k3", 3) ]))
+        ok_(d.refresh())
+        ok_(not d.isStale())
+
+    def testHistoryLost(self):
+        """The dict is reloaded from the collection when the resume token is lost
+        """
+        self.load().close()
+        self.collection.put(1, 10)
+        self.collection.historyStart = len(self.collection.events)
+        d = self.load()
+        ok_(waitFor(lambda: d.lost))
+        ok_(not d.refresh())
+        ok_(d.isStale())
+        ok_(not exists(d.token_path) and not exists(d.cache_path))
+        d = self.load()
+        eq_(self.collection.finds, 2)
+        eq_(d["k1"], 10)
+        ok_(not d.lost)
+
+    def testInvalidate(self):
+        """The dict is reloaded from the collection when the change stream is invalidated
+        """
+        d = self.load()
+        self.collection.drop()
+        self.collection.put(5, 5)
+        ok_(waitFor(lambda: d.lost))
+        ok_(d.isStale())
+        ok_(not exists(d.token_path) and not exists(d.ids_path) and not exists(d.cache_path))
+        d = self.load()
+        eq_(self.collection.finds, 2)
+        eq_(d.items(), [ ("k5", 5) ])
+
+    def testLostReload(self):
+        """The section reloads the lost dict without refresh_interval
+        """
+        repository = ConfigRepository(enableEtcd = False)
+        repository.sections["mongo"] = self.repository["mongo"]
+        section = DictConfigSection("tail", {
+            "dbtype": "mongodb",
+            "backend": "mongo",
+            "database": "db",
+            "collection": "coll",
+            "key_field": [ "key" ],
+            "value_field": "value",
+            "tail": True,
+            "tail_checkpoint": 0.1,
+            "enable_cache": True,
+            "cache_path": self.path,
+            "settle": 0,
+            }, repository, wait = True)
+        lost = section._value.value
+        self.dicts.append(lost)
+        self.collection.drop()
+        self.collection.put(5, 5)
+        ok_(waitFor(lambda: not section._value.value is lost))
+        d = section._value.value
+        self.dicts.append(d)
+        ok_(waitFor(lambda: d.items() == [ ("k5", 5) ]))
+        ok_(not d.lost)
+
+def testCacheConfigChanged():
+    """The cache built by another key_field or value_field is not used
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = { "mongo": FakeBackend(collection) }
+    path = tempfile.mkdtemp()
+    try:
+        config = {
+            "dbtype": "mongodb",
+            "backend": "mongo",
+            "database": "db",
+            "collection": "coll",
+            "key_field": [ "key" ],
+            "value_field": "value",
+            "enable_cache": True,
+            "cache_path": path,
+            }
+        MongoDict("dict", config, repository).load()
+        d = MongoDict("dict", config, repository)
+        d.load()
+        eq_(collection.finds, 1)
+        eq_(d.items(), [ ("k1", 1) ])
+        d = MongoDict("dict", dict(config, key_field = [ "value" ], value_field = "key"), repository)
+        d.load()
+        eq_(collection.finds, 2)
+        eq_(d.items(), [ (1, "k1") ])
+    finally:
+        shutil.rmtree(path, True)
+
+def testTableConfigChanged():
+    """The hash table built by another key_field or value_field is not mapped
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = { "mongo": FakeBackend(collection) }
+    path = tempfile.mkdtemp()
+    try:
+        config = {
+            "dbtype": "mongodb",
+            "backend": "mongo",
+            "database": "db",
+            "collection": "coll",
+            "key_field": [ "key" ],
+            "value_field": "value",
+            "storage": "mmap",
+            "cache_path": path,
+            }
+        MmapMongoDict("dict", config, repository).load()
+        d = MmapMongoDict("dict", config, repository)
+        d.load()
+        eq_(collection.finds, 1)
+        eq_(d.items(), [ ("k1", 1) ])
+        d = MmapMongoDict("dict", dict(config, key_field = [ "value" ], value_field = "key"), repository)
+        d.load()
+        eq_(collection.finds, 2)
+        eq_(d.items(), [ (1, "k1") ])
+    finally:
+        shutil.rmtree(path, True)
+
+def testReloadSkipCache():
+    """The reloaded dict of the source without version is not loaded from the cache
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = { "mongo": FakeBackend(collection) }
+    path = tempfile.mkdtemp()
+    try:
+        for storage in ("memory", "mmap"):
+            config = {
+                "dbtype": "mongodb",
+                "backend": "mongo",
+                "database": "db",
+                "collection": "coll",
+                "key_field": [ "key" ],
+                "value_field": "value",
+                "enable_cache": True,
+                "cache_path": join(path, storage),
+                "storage": storage,
+                }
+            collection.put(1, 1)
+            eq_(MongoDict.getDict("dict", config, repository).items(), [ ("k1", 1) ])
+            collection.put(1, 2)
+            # Restarted
+            eq_(MongoDict.getDict("dict", config, repository).items(), [ ("k1", 1) ])
+            # Reloaded
+            eq_(MongoDict.getDict("dict", config, repository, reload = True).items(), [ ("k1", 2) ])
+    finally:
+        shutil.rmtree(path, True)
+
+def testLoadLane():
+    """The dict is loaded on the load scheduler when the workers of the other sections are busy
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = ConfigRepository(enableEtcd = False, reloadWorkers = 1)
+    repository.sections["mongo"] = FakeBackend(collection)
+    busy = Event()
+    repository.scheduler.submit("busy", busy.wait)
+    try:
+        section = DictConfigSection("dict", {
+            "dbtype": "mongodb",
+            "backend": "mongo",
+            "database": "db",
+            "collection": "coll",
+            "key_field": [ "key" ],
+            "value_field": "value",
+            }, repository)
+        ok_(section.ready(2.0))
+        with section.instance() as d:
+            eq_(d.items(), [ ("k1", 1) ])
+    finally:
+        busy.set()
+
+def testBackendNotReady():
+    """The dict waits for the backend ready without failing the reload
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = ConfigRepository(enableEtcd = False)
+    backend = FakeBackend(collection)
+    loaded = Event()
+    backend.ready = lambda timeout = None: loaded.wait(timeout)
+    repository.sections["mongo"] = backend
+    section = DictConfigSection("dict", {
+        "dbtype": "mongodb",
+        "backend": "mongo",
+        "database": "db",
+        "collection": "coll",
+        "key_field": [ "key" ],
+        "value_field": "value",
+        }, repository)
+    ok_(not section.ready(0.5))
+    eq_(repository.loadScheduler._failures, {})
+    loaded.set()
+    ok_(section.ready(2.0))
+    with section.instance() as d:
+        eq_(d.items(), [ ("k1", 1) ])
+
+def testRefresh():
+    """The dict of the source without version is reloaded every refresh_interval, the old one keeps serving until released
+    """
+    collection = FakeCollection()
+    collection.put(1, 1)
+    repository = ConfigRepository(enableEtcd = False)
+    repository.sections["mongo"] = FakeBackend(collection)
+    section = DictConfigSection("dict", {
+        "dbtype": "mongodb",
+        "backend": "mongo",
+        "database": "db",
+        "collection": "coll",
+        "key_field": [ "key" ],
+        "value_field": "value",
+        "refresh_interval": 0.1,
+        }, repository, wait = True)
+    section.ReapInterval = 0.05
+    with section.instance() as old:
+        collection.put(1, 2)
+        ok_(waitFor(lambda: section._value.value.get("k1") == 2))
+        eq_(old["k1"], 1)
+    ok_(waitFor(lambda: len(old) == 0))
+    with section.instance() as d:
+        eq_(d.items(), [ ("k1", 2) ])
+
+def testPoll():
+    """The dict with updated_field is refreshed in place by the documents updated since the watermark
+    """
+    collection = UpdatedCollection()
+    for i in range(3):
+        collection.put(i, i)
+    repository = ConfigRepository(enableEtcd = False)
+    repository.sections["mongo"] = FakeBackend(collection)
+    section = DictConfigSection("dict", {
+        "dbtype": "mongodb",
+        "backend": "mongo",
+        "database": "db",
+        "collection": "coll",
+        "key_field": [ "key" ],
+        "value_field": "value",
+        "updated_field": "updated",
+        "deleted_field": "deleted",
+        }, repository, wait = True)
+    d = section._value.value
+    eq_(d.md5, "i:3")
+    collection.put(1, 10)
+    collection.put(2, 2, deleted = True)
+    collection.put(4, 4)
+    ok_(d.refresh())
+    # The documents at the watermark and after
+    eq_(sorted(doc["_id"] for doc in collection.found), [ 1, 2, 4 ])
+    eq_(sorted(d.items()), [ ("k0", 0), ("k1", 10), ("k4", 4) ])
+    eq_(d.md5, "i:6")
+    ok_(not d.isStale())
+    # Refreshed in place by the section
+    collection.put(0, 5)
+    section.requestRefresh()
+    ok_(waitFor(lambda: d.get("k0") == 5))
+    ok_(section._value.value is d)
@@ -0,0 +1,152 @@
+# encoding=utf8
+
+""" The tests of the on-disk storage of dict sections
+    Author: lipixun
+    Created Time : 日 10/18 23:59:56 2026
+
+    File Name: test_dictstore.py
+    Description:
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+from bson import ObjectId
+from datetime import datetime
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_, assert_raises
+
+from configmslib.sections.dictstore import HashTable, HashTableWriter, CACHE_BLOCK_SIZE, \
+        writecache, readcacheheader, itercacheblocks
+
+class TestDictStore(object):
+    """Test the hash table and cache files
+    """
+    def setup(self):
+        """Create the temp dir
+        """
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        """Remove the temp dir
+        """
+        shutil.rmtree(self.path, True)
+
+    def readCache(self, path):
+        """Read the cache file
+        Returns:
+            (version, items)
+        """
+        with open(path, "rb") as fh:
+            version, count, _ = readcacheheader(fh)
+            items = []
+            for block in itercacheblocks(fh, count):
+                items.extend(block)
+            eq_(len(items), count)
+            return version, items
+
+    def testCacheRoundTrip(self):
+        """The items are read back from the cache file in blocks
+        """
+        path = join(self.path, "cache")
+        items = [ ("k%d" % i, { "value": i, "tags": [ u"标签", i ] }) for i in range(CACHE_BLOCK_SIZE + 10) ]
+        eq_(writecache(path, iter(items), "v1", "c1"), len(items))
+        eq_(self.readCache(path), ("v1", items))
+        with open(path, "rb") as fh:
+            eq_(readcacheheader(fh), ("v1", len(items), "c1"))
+
+    def testCacheBson(self):
+        """The values could not be marshaled are encoded by bson, not pickled
+        """
+        path = join(self.path, "cache")
+        items = [ ("time", datetime(2026, 10, 18)), ((u"a", 1), None), (ObjectId("5f0000000000000000000001"), (u"b", 2)) ]
+        writecache(path, items)
+        eq_(self.readCache(path), (None, items))
+        with open(path, "rb") as fh:
+            ok_(not "cdatetime" in fh.read())
+
+    def testCacheBadFile(self):
+        """The file not in cache format is ignored, the truncated file raises
+        """
+        path = join(self.path, "cache")
+        with open(path, "wb") as fh:
+            fh.write("k1\tv1\n")
+        with open(path, "rb") as fh:
+            eq_(readcacheheader(fh), None)
+        writecache(path, [ ("k%d" % i, i) for i in range(10) ])
+        with open(path, "r+b") as fh:
+            fh.truncate(os.path.getsize(path) - 1)
+        with open(path, "rb") as fh:
+            _, count, _ = readcacheheader(fh)
+            assert_raises(ValueError, list, itercacheblocks(fh, count))
+        eq_([ x for x in os.listdir(self.path) if x.endswith(".tmp") ], [])
+
+    def testHashTableRoundTrip(self):
+        """The records are found by the equal keys, and the later one wins
+        """
+        path = join(self.path, "table")
+        writer = HashTableWriter(path, "v1", "c1")
+        for i in range(1000):
+            writer.add("k%d" % i, i)
+        writer.add(u"中文", { "a": [ 1, 2 ] })
+        writer.add(("t", 1), datetime(2026, 10, 18))
+        writer.add("id", (ObjectId("5f0000000000000000000001"), 1))
+        writer.add("k1", "new")
+        writer.commit()
+        table = HashTable(path)
+        try:
+            eq_(table.version, "v1")
+            eq_(table.config, "c1")
+            eq_(len(table), 1003)
+            eq_(table.get("k0"), 0)
+            eq_(table.get(u"k999"), 999)
+            eq_(table.get("k1"), "new")
+            eq_(table.get(u"中文".encode("utf8")), { "a": [ 1, 2 ] })
+            eq_(table.get((u"t", 1L)), datetime(2026, 10, 18))
+            eq_(table.get("id"), (ObjectId("5f0000000000000000000001"), 1))
+            ok_(not "k1000" in table)
+            eq_(table.get("k1000", "default"), "default")
+            items = dict(table.iteritems())
+            eq_(len(items), 1003)
+            eq_(items["k1"], "new")
+        finally:
+            table.close()
+
+    def testHashTableNotPickled(self):
+        """The values not marshalable are never pickled
+        """
+        path = join(self.path, "table")
+        writer = HashTableWriter(path)
+        writer.add("k", datetime(2026, 10, 18))
+        writer.commit()
+        with open(path, "rb") as fh:
+            ok_(not "cdatetime" in fh.read())
+
+    def testHashTableEmpty(self):
+        """The empty table is built
+        """
+        path = join(self.path, "table")
+        HashTableWriter(path).commit()
+        table = HashTable(path)
+        try:
+            eq_(len(table), 0)
+            eq_(table.version, None)
+            eq_(table.get("k"), None)
+            eq_(list(table.iteritems()), [])
+        finally:
+            table.close()
+
+    def testHashTableAbort(self):
+        """The aborted table is not built
+        """
+        path = join(self.path, "table")
+        writer = HashTableWriter(path)
+        writer.add("k", "v")
+        writer.abort()
+        eq_(os.listdir(self.path), [])
@@ -0,0 +1,93 @@
+# encoding=utf8
+
+""" The tests of watching configs in etcd
+    Author: lipixun
+    Created Time : 日 10/18 23:20:05 2026
+
+    File Name: test_etcd.py
+    Description:
+
+"""
+
+import sys
+import time
+
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_
+
+from configmslib.repository import ConfigRepository
+from configmslib.section import ConfigSection
+
+from fakeetcd import FakeEtcdClient
+
+Path = "/system/config/default/"
+
+def waitFor(func, timeout = 2.0):
+    """Wait for func returns true
+    """
+    deadline = time.time() + timeout
+    while not func() and time.time() < deadline:
+        time.sleep(0.01)
+    return func()
+
+def testWatchOldKey():
+    """The key not changed in the etcd history is watched after the etcd index, instead of read again and again
+    """
+    repository = ConfigRepository(sharedWatch = False)
+    client = FakeEtcdClient(5000).install(repository)
+    client.write(Path + "app", '{"a": 1}', modifiedIndex = 5)
+    section = ConfigSection("app", {}, repository, autoUpdate = True)
+    eq_(section["a"], 1)
+    time.sleep(0.3)
+    ok_(client.reads <= 2, "Read [%d] times" % client.reads)
+    # The changes are still received
+    client.write(Path + "app", '{"a": 2}')
+    ok_(waitFor(lambda: section.get("a") == 2))
+
+def testWatchClearedIndex():
+    """The cleared watch index is recovered by reading the config again
+    """
+    repository = ConfigRepository(sharedWatch = False)
+    client = FakeEtcdClient().install(repository)
+    client.write(Path + "app", '{"a": 1}')
+    section = ConfigSection("app", {}, repository, autoUpdate = True)
+    client.advance(FakeEtcdClient.HistorySize + 10)
+    client.write(Path + "app", '{"a": 2}')
+    ok_(waitFor(lambda: section.get("a") == 2))
+    time.sleep(0.2)
+    ok_(client.reads <= 3, "Read [%d] times" % client.reads)
+
+def testSharedWatch():
+    """The changes are dispatched to the sections by the shared watcher
+    """
+    repository = ConfigRepository()
+    client = FakeEtcdClient(100).install(repository)
+    client.write(Path + "app", '{"a": 1}', modifiedIndex = 10)
+    client.write(Path + "db", '{"b": 1}', modifiedIndex = 20)
+    app = ConfigSection("app", {}, repository, autoUpdate = True)
+    db = ConfigSection("db", {}, repository, autoUpdate = True)
+    client.write(Path + "db", '{"b": 2}')
+    client.write(Path + "app", '{"a": 2}')
+    ok_(waitFor(lambda: app.get("a") == 2 and db.get("b") == 2))
+    eq_(len(repository.watchers), 1)
+
+def testRegisterAfterChange():
+    """The change dispatched before a section is registered is read again when registering
+    """
+    repository = ConfigRepository()
+    client = FakeEtcdClient(100).install(repository)
+    client.write(Path + "app", '{"a": 1}', modifiedIndex = 10)
+    client.write(Path + "db", '{"b": 1}', modifiedIndex = 20)
+    ConfigSection("app", {}, repository, autoUpdate = True)
+    db = ConfigSection("db", {}, repository)
+    client.write(Path + "db", '{"b": 2}')
+    watcher = repository.watchers.values()[0]
+    ok_(waitFor(lambda: watcher._index >= client.index))
+    eq_(db["b"], 1)
+    repository.watch(db)
+    eq_(db["b"], 2)
+    client.write(Path + "db", '{"b": 3}')
+    ok_(waitFor(lambda: db.get("b") == 3))
@@ -0,0 +1,105 @@
+# encoding=utf8
+
+""" The tests of resilience policies
+    Author: lipixun
+    Created Time : 日 10/18 23:52:14 2026
+
+    File Name: test_resilience.py
+    Description:
+
+"""
+
+import sys
+import time
+import socket
+
+from os.path import dirname, abspath, join
+from threading import Thread
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_, assert_raises
+
+from configmslib.resilience import CircuitBreaker, Bulkhead, CircuitOpenError, BulkheadFullError
+
+from test_section import createSection
+
+def testBreakerOpenAndProbe():
+    """The breaker opens by the error rate, then closes by a successful probe
+    """
+    breaker = CircuitBreaker(window = 4, minCalls = 4, errorRate = 0.5, openTime = 0.05)
+    for failed in (False, True, False, True):
+        breaker.record(failed, 0.0, breaker.allow())
+    eq_(breaker.state, CircuitBreaker.Open)
+    assert_raises(CircuitOpenError, breaker.allow)
+    time.sleep(0.06)
+    ok_(breaker.allow())
+    # Only one probe is allowed
+    assert_raises(CircuitOpenError, breaker.allow)
+    breaker.record(False, 0.0, True)
+    eq_(breaker.state, CircuitBreaker.Closed)
+
+def testBulkheadTimeout():
+    """The bulkhead rejects after waiting
+    """
+    bulkhead = Bulkhead(1, 0.05)
+    bulkhead.acquire()
+    start = time.time()
+    assert_raises(BulkheadFullError, bulkhead.acquire)
+    ok_(time.time() - start >= 0.05)
+    bulkhead.release()
+    bulkhead.acquire()
+    eq_(bulkhead.stats()["rejections"], 1)
+
+def enterInThread(section):
+    """Enter instance() in another thread
+    Returns:
+        The error raised, None if entered
+    """
+    errors = []
+    def run():
+        """Enter and exit
+        """
+        try:
+            with section.instance():
+                pass
+        except Exception as error:
+            errors.append(error)
+    thread = Thread(target = run)
+    thread.start()
+    thread.join()
+    return errors[0] if errors else None
+
+def testBulkheadRejectionNotRecorded():
+    """The calls rejected by the bulkhead are not recorded by the breaker, and release the probe slot
+    """
+    section = createSection({ "breaker": { "window": 10, "minCalls": 2, "openTime": 0.05 }, "bulkhead": 1 })
+    breaker = section._breaker
+    with section.instance():
+        for _ in range(3):
+            ok_(isinstance(enterInThread(section), BulkheadFullError))
+    eq_(breaker.stats()["calls"], 1)
+    # Half open, the probe slot is released when rejected
+    breaker.trip()
+    time.sleep(0.06)
+    section._bulkhead.acquire()
+    ok_(isinstance(enterInThread(section), BulkheadFullError))
+    section._bulkhead.release()
+    eq_(enterInThread(section), None)
+    eq_(breaker.state, CircuitBreaker.Closed)
+
+def testApplicationErrorNotRecorded():
+    """The errors raised by the application in the with statements do not open the breaker, the socket errors do
+    """
+    section = createSection({ "breaker": { "minCalls": 2, "openTime": 10 } })
+    for _ in range(3):
+        with assert_raises(KeyError):
+            with section.instance():
+                raise KeyError("key")
+    eq_(section._breaker.state, CircuitBreaker.Closed)
+    for _ in range(3):
+        with assert_raises(socket.error):
+            with section.instance():
+                raise socket.error("Connection refused")
+    eq_(section._breaker.state, CircuitBreaker.Open)
+    ok_(isinstance(enterInThread(section), CircuitOpenError))
@@ -0,0 +1,161 @@
+# encoding=utf8
+
+""" The tests of the task scheduler
+    Author: lipixun
+    Created Time : 日 10/18 23:59:40 2026
+
+    File Name: test_scheduler.py
+    Description:
+
+"""
+
+import sys
+import time
+
+from os.path import dirname, abspath, join
+from threading import Event, Lock
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_
+
+from configmslib.scheduler import Scheduler
+
+from test_etcd import waitFor
+
+class Task(object):
+    """The task records its runs
+    """
+    def __init__(self, func = None):
+        """Create a new Task
+        Parameters:
+            func                            Called by each run with the run count, returns the result of the run
+        """
+        self.func = func
+        self.times = []
+        self.running = 0
+        self.concurrency = 0
+        self._lock = Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.times.append(time.time())
+            self.running += 1
+            self.concurrency = max(self.concurrency, self.running)
+        try:
+            if self.func:
+                return self.func(len(self.times))
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    @property
+    def runs(self):
+        """The run count
+        """
+        return len(self.times)
+
+def testCoalesce():
+    """Submitting a pending key runs the task once
+    """
+    scheduler = Scheduler()
+    task = Task()
+    for _ in range(5):
+        scheduler.submit("key", task, 0.05)
+    ok_(waitFor(lambda: task.runs == 1))
+    time.sleep(0.1)
+    eq_(task.runs, 1)
+
+def testEarlierDue():
+    """Submitting a pending key with a shorter delay runs it earlier
+    """
+    scheduler = Scheduler()
+    task = Task()
+    start = time.time()
+    scheduler.submit("key", task, 10.0)
+    scheduler.submit("key", task, 0.0)
+    ok_(waitFor(lambda: task.runs == 1))
+    ok_(task.times[0] - start < 1.0)
+
+def testRerun():
+    """The key submitted when running runs again after it's done, never concurrently
+    """
+    scheduler = Scheduler()
+    started, done = Event(), Event()
+    def run(runs):
+        """Block the first run
+        """
+        if runs == 1:
+            started.set()
+            done.wait(2.0)
+    task = Task(run)
+    scheduler.submit("key", task)
+    ok_(started.wait(2.0))
+    for _ in range(3):
+        scheduler.submit("key", task)
+    time.sleep(0.05)
+    eq_(task.runs, 1)
+    done.set()
+    ok_(waitFor(lambda: task.runs == 2))
+    time.sleep(0.1)
+    eq_(task.runs, 2)
+    eq_(task.concurrency, 1)
+
+def testRepeat():
+    """The task returns a number is scheduled again after that seconds
+    """
+    scheduler = Scheduler()
+    task = Task(lambda runs: 0.01 if runs < 3 else None)
+    scheduler.submit("key", task)
+    ok_(waitFor(lambda: task.runs == 3))
+    time.sleep(0.1)
+    eq_(task.runs, 3)
+
+def testBackoff():
+    """The failed task is retried with exponential backoff
+    """
+    def run(runs):
+        """Fail the first 3 runs
+        """
+        if runs <= 3:
+            raise ValueError("Failed")
+    scheduler = Scheduler(backoff = 0.05, maxBackoff = 1.0)
+    task = Task(run)
+    scheduler.submit("key", task)
+    ok_(waitFor(lambda: task.runs == 4))
+    delays = [ y - x for x, y in zip(task.times, task.times[1:]) ]
+    # Equal jitter, the delay is in [ backoff / 2, backoff ]
+    for delay, backoff in zip(delays, (0.05, 0.1, 0.2)):
+        ok_(backoff / 2.0 <= delay < backoff + 0.1, "Delay [%s] of backoff [%s]" % (delay, backoff))
+    # Succeeded, the failures are reset
+    eq_(scheduler._failures, {})
+
+def testMaxBackoff():
+    """The backoff is bounded by maxBackoff
+    """
+    scheduler = Scheduler(backoff = 1.0, maxBackoff = 60.0)
+    for failures in (1, 2, 3, 10, 100):
+        backoff = min(2 ** (failures - 1), 60.0)
+        delay = scheduler.getBackoff(failures)
+        ok_(backoff / 2.0 <= delay <= backoff)
+
+def testDebounce():
+    """The debounced task is postponed by each submit, but no longer than debounce seconds
+    """
+    scheduler = Scheduler()
+    task = Task()
+    # Settled
+    for _ in range(5):
+        scheduler.submit("settled", task, 0.05, debounce = 1.0)
+        time.sleep(0.02)
+    eq_(task.runs, 0)
+    ok_(waitFor(lambda: task.runs == 1))
+    eq_(task.runs, 1)
+    # Never settled
+    task = Task()
+    start = time.time()
+    while time.time() - start < 0.5:
+        scheduler.submit("busy", task, 0.05, debounce = 0.2)
+        time.sleep(0.01)
+    ok_(task.runs >= 1)
+    ok_(task.times[0] - start < 0.4)
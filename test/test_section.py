@@ -0,0 +1,296 @@
+# encoding=utf8
+
+""" The tests of refer config sections
+    Author: lipixun
+    Created Time : 日 10/18 23:41:26 2026
+
+    File Name: test_section.py
+    Description:
+
+"""
+
+import sys
+import time
+
+from os.path import dirname, abspath, join
+from threading import Thread
+
+sys.path.insert(0, join(dirname(abspath(__file__)), ".."))
+
+from nose.tools import eq_, ok_, assert_raises
+
+from configmslib.repository import ConfigRepository
+from configmslib.section import ConfigSection, ReferConfigSection, ReferencedValue
+from configmslib.util import diffPaths
+
+from test_etcd import waitFor
+
+class ObjectConfigSection(ReferConfigSection):
+    """The section references a dict of the config id
+    """
+    Type = "object"
+    ReloadRequired = True
+
+    def __init__(self, *args, **kwargs):
+        """Create a new ObjectConfigSection
+        """
+        self.created = 0
+        self.released = []
+        super(ObjectConfigSection, self).__init__(*args, **kwargs)
+
+    def reference(self, config):
+        """Create the referenced value
+        """
+        self.created += 1
+        return { "id": config.get("id"), "serial": self.created }
+
+    def release(self, value):
+        """Release the referenced value
+        """
+        self.released.append(value["serial"])
+
+class SlowConfigSection(ObjectConfigSection):
+    """The section takes a while to create the referenced value
+    """
+    def reference(self, config):
+        """Create the referenced value slowly
+        """
+        time.sleep(0.1)
+        return super(SlowConfigSection, self).reference(config)
+
+class WarmupConfigSection(ObjectConfigSection):
+    """The section fails to warm up the referenced value of the bad id
+    """
+    def warmup(self, value, connections):
+        """Check the referenced value
+        """
+        if value["id"] == "bad":
+            raise ValueError("Bad value")
+
+class GeneratorConfigSection(ObjectConfigSection):
+    """The section returns the instance value by a generator, and records how the generator is closed
+    """
+    def __init__(self, *args, **kwargs):
+        """Create a new GeneratorConfigSection
+        """
+        self.closes = []
+        self.errors = []
+        super(GeneratorConfigSection, self).__init__(*args, **kwargs)
+
+    def withinError(self, error):
+        """Record the error
+        """
+        self.errors.append(error)
+
+    def getInstanceValue(self, value):
+        """Yield the instance value
+        """
+        try:
+            yield value
+        except Exception as error:
+            self.closes.append(error)
+            raise
+        self.closes.append(None)
+
+def createSection(config, key = "object"):
+    """Create a loaded section
+    """
+    return ObjectConfigSection(key, dict(config, settle = 0), ConfigRepository(enableEtcd = False), wait = True)
+
+def updateSection(section, config, timeout = 2.0):
+    """Update the section and wait for it reloaded
+    """
+    section.update(dict(config, settle = 0))
+    deadline = time.time() + timeout
+    while section._reloadedGeneration < section.snapshot().generation and time.time() < deadline:
+        time.sleep(0.01)
+    eq_(section._reloadedGeneration, section.snapshot().generation)
+
+def testHoldMetricsOptIn():
+    """The hold time is only recorded with holdMetrics
+    """
+    section = createSection({ "id": 1 })
+    with section.instance():
+        pass
+    ok_(not "instance_hold_seconds" in section.repository.metrics.stats())
+    updateSection(section, { "id": 1, "holdMetrics": True })
+    eq_(section.created, 1)
+    with section.instance():
+        pass
+    ok_(section.repository.metrics.stats()["instance_hold_seconds"]["object"])
+
+def testReferencedValueRetire():
+    """The referenced value is only retired when not referenced, and could not be referenced after retired
+    """
+    value = ReferencedValue("value")
+    ok_(value.increase())
+    ok_(value.increase())
+    eq_(value.refcount, 2)
+    ok_(not value.retire())
+    value.decrease()
+    value.decrease()
+    ok_(value.notReferenced)
+    ok_(value.retire())
+    ok_(not value.increase())
+    ok_(value.notReferenced)
+
+def testReapSuperseded():
+    """The superseded value is released by the reaper after the holders exit
+    """
+    section = createSection({ "id": 1 })
+    section.ReapInterval = 0.05
+    with section.instance() as value:
+        updateSection(section, { "id": 2 })
+        eq_(section.created, 2)
+        time.sleep(0.1)
+        eq_(section.released, [])
+        eq_(value["serial"], 1)
+        eq_(len(section._superseded), 1)
+        eq_(section._value.value["serial"], 2)
+    ok_(waitFor(lambda: section.released == [ 1 ]))
+    eq_(section._superseded, [])
+
+def testReleaseTimeout():
+    """The superseded value still referenced after releaseTimeout is released by force
+    """
+    section = createSection({ "id": 1, "releaseTimeout": 0.1 })
+    section.ReapInterval = 0.05
+    with section.instance():
+        updateSection(section, { "id": 2, "releaseTimeout": 0.1 })
+        ok_(waitFor(lambda: section.released == [ 1 ]))
+    time.sleep(0.1)
+    eq_(section.released, [ 1 ])
+
+def testSnapshotImmutable():
+    """The snapshot is never modified, an update publishes a new one
+    """
+    section = ConfigSection("plain", { "a": { "b": 1 } }, ConfigRepository(enableEtcd = False))
+    snapshot = section.snapshot()
+    eq_(snapshot.generation, 1)
+    assert_raises(TypeError, snapshot.__setitem__, "a", 2)
+    assert_raises(TypeError, snapshot.update, { "a": 2 })
+    assert_raises(TypeError, snapshot.pop, "a")
+    ok_(section.update({ "a": { "b": 2 }, "c": 3 }))
+    eq_(snapshot, { "a": { "b": 1 } })
+    eq_(snapshot.generation, 1)
+    eq_(section.snapshot(), { "a": { "b": 2 }, "c": 3 })
+    eq_(section.snapshot().generation, 2)
+    eq_(section.first("a.b"), 2)
+    eq_(dict(section), { "a": { "b": 2 }, "c": 3 })
+
+def testDiffPaths():
+    """The dotted paths of the added, removed and changed values are found
+    """
+    eq_(diffPaths({ "a": { "b": 1, "c": 2 }, "d": [ 1 ], "e": 1 }, { "a": { "b": 1, "c": 3 }, "d": [ 2 ], "f": 1 }), set([ "a.c", "d", "e", "f" ]))
+    eq_(diffPaths({ "a": { "b": 1 } }, { "a": { "b": 1 } }), set())
+
+def testSkipUnchanged():
+    """The unchanged update is skipped, and the behavior keys never create a new referenced value
+    """
+    section = createSection({ "id": 1 })
+    generation = section.snapshot().generation
+    ok_(section.update({ "id": 1, "settle": 0 }))
+    eq_(section.snapshot().generation, generation)
+    updateSection(section, { "id": 1, "releaseTimeout": 10 })
+    eq_(section.snapshot().changes, frozenset([ "releaseTimeout" ]))
+    eq_(section.created, 1)
+    updateSection(section, { "id": 2, "releaseTimeout": 10 })
+    eq_(section.snapshot().changes, frozenset([ "id" ]))
+    eq_(section.created, 2)
+    eq_(section._value.value["id"], 2)
+
+def testSettle():
+    """A burst of updates within the settle window is reloaded once by the last config
+    """
+    section = ObjectConfigSection("object", { "id": 0, "settle": 0.2 }, ConfigRepository(enableEtcd = False), wait = True)
+    eq_(section.created, 1)
+    for i in range(1, 6):
+        section.update({ "id": i, "settle": 0.2 })
+        time.sleep(0.05)
+    eq_(section.created, 1)
+    ok_(waitFor(lambda: section._reloadedGeneration == section.snapshot().generation))
+    eq_(section.created, 2)
+    eq_(section._value.value["id"], 5)
+
+def testInstanceHandle():
+    """The handle is reused, and the error raised in the with block is thrown into the generator
+    """
+    section = createSection({ "id": 1 })
+    eq_(section.instance(), section.instance())
+    with section.instance() as value:
+        eq_(section._value.refcount, 1)
+    eq_(section._value.refcount, 0)
+    section = GeneratorConfigSection("generator", { "id": 1, "settle": 0 }, ConfigRepository(enableEtcd = False), wait = True)
+    with section.instance() as value:
+        eq_(value["id"], 1)
+    eq_(section.closes, [ None ])
+    error = ValueError("Failed")
+    try:
+        with section.instance():
+            raise error
+    except ValueError:
+        pass
+    eq_(section.closes, [ None, error ])
+    eq_(section._value.refcount, 0)
+
+def testInstanceReentrant():
+    """The nested instance() reuses the outermost value, which is unreferenced and closed when the outermost exits
+    """
+    section = GeneratorConfigSection("generator", { "id": 1, "settle": 0 }, ConfigRepository(enableEtcd = False), wait = True)
+    error = ValueError("Failed")
+    try:
+        with section.instance() as outer:
+            with section.instance() as inner:
+                ok_(inner is outer)
+                eq_(section._value.refcount, 1)
+                updateSection(section, { "id": 2 })
+                with section.instance() as nested:
+                    eq_(nested["id"], 1)
+                eq_(section.closes, [])
+                raise error
+    except ValueError:
+        pass
+    eq_(section.closes, [ error ])
+    eq_(section.errors, [ error ])
+    with section.instance() as value:
+        eq_(value["id"], 2)
+    eq_(section.closes, [ error, None ])
+
+def testLazySingleFlight():
+    """The lazy section is ready without the referenced value, which is created once by the concurrent first instance() calls
+    """
+    section = SlowConfigSection("slow", { "id": 1, "lazy": True, "settle": 0 }, ConfigRepository(enableEtcd = False), wait = True)
+    eq_(section.created, 0)
+    values = []
+    def run():
+        """Enter instance()
+        """
+        with section.instance() as value:
+            values.append(value)
+    threads = [ Thread(target = run) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    eq_(section.created, 1)
+    eq_(len(values), 8)
+    ok_(all(value is values[0] for value in values))
+    # Changes after created are reloaded eagerly
+    updateSection(section, { "id": 2, "lazy": True })
+    eq_(section.created, 2)
+    eq_(section._value.value["id"], 2)
+
+def testWarmupFailed():
+    """The new referenced value failed to warm up is released, and the current one keeps serving
+    """
+    section = WarmupConfigSection("warmup", { "id": 1, "warmup": True, "settle": 0 }, ConfigRepository(enableEtcd = False), wait = True)
+    section.update({ "id": "bad", "warmup": True, "settle": 0 })
+    ok_(waitFor(lambda: section.released == [ 2 ]))
+    eq_(section._value.value["id"], 1)
+    with section.instance() as value:
+        eq_(value["serial"], 1)
+    ok_(section._reloadedGeneration < section.snapshot().generation)
+    ok_(section.repository.metrics.stats()["reload_failures"]["warmup"] >= 1)
+    # Recovered
+    updateSection(section, { "id": 3, "warmup": True }, 5.0)
+    eq_(section._value.value["id"], 3)